@@ -11,6 +11,7 @@ import time
 
 from functools import partial
 from collections import defaultdict
+from itertools import zip_longest
 import numpy as np
 import cv2
 
@@ -30,10 +31,18 @@ from libs.labelDialog import LabelDialog
 from libs.colorDialog import ColorDialog
 from libs.labelFile import LabelFile, LabelFileError
 from libs.toolBar import ToolBar
-from libs.common_io import CommonReader, COMM_EXT
+from libs.common_io import COMM_EXT, CommonReaderError
 from libs.ustr import ustr
-from libs.hashableQListWidgetItem import HashableQListWidgetItem, HashableQTableWidgetItem
-from libs.image3d import read3d, Image3d, DSKey, write_nii, read_nii, computeMetrics
+from libs.hashableQListWidgetItem import HashableQListWidgetItem
+from libs.image3d import read3d, Image3d, write_nii, read_nii, computeMetrics, gather_seg_inputs, SEG_ALGS, \
+    label_path
+from libs.tracing import tracer, span
+from libs.labelTable import LabelTableModel
+from libs.annotationStore import AnnotationStore
+from libs.fileList import DirScanner, FileListModel, FileFilterProxyModel
+from libs.annotationIndex import AnnotationIndex, IndexUpdater
+from libs.prefetch import Prefetcher, VolumePrefetcher, PREFETCH_COUNT, VOLUME_PREFETCH_COUNT
+from libs.tiledImage import TiledImage, openTiled
 
 
 __appname__ = 'labelImg'
@@ -81,7 +90,15 @@ class MainWindow(QMainWindow, WindowMixin):
         self.defaultSegDir = None
 
         # For loading all image under a directory
-        self.mImgList = []
+        self.fileModel = FileListModel(self)
+        self.fileFilter = FileFilterProxyModel(self)
+        self.fileFilter.setSourceModel(self.fileModel)
+        self.dirScanner = None
+        self.annotationIndex = None
+        self.indexUpdater = None
+        self.indexedImages = {}     # Annotation path being indexed -> its image, see updateFileFilter()
+        self.prefetcher = Prefetcher()
+        self.volumePrefetcher = VolumePrefetcher()
         self.dirname = None
         self.labelHist = []
         self.lastOpenDir = None
@@ -113,7 +130,6 @@ class MainWindow(QMainWindow, WindowMixin):
 
         self.itemsToShapes = {}
         self.shapesToItems = {}
-        self.shapesToOthers = {}
         self.prevLabelText = ''
 
         listLayout = QVBoxLayout()
@@ -183,8 +199,7 @@ class MainWindow(QMainWindow, WindowMixin):
 
         # segmentation algorithmDann
         segAlgLabel = QLabel(getStr("segAlgLabel"))
-        self.segAlg = ["DIN", "EDT", "GDT", "Graph Cut 3D", "Random Walk 3D"]
-        self.segName = ["din", "euc", "geo", "GraphCut3D", "RandomWalk3D"]
+        self.segAlg = list(SEG_ALGS)
         self.segAlgComboBox = QComboBox()
         self.segAlgComboBox.addItems(self.segAlg)
         self.gtShowCheckBox = QCheckBox("GT:")
@@ -204,6 +219,10 @@ class MainWindow(QMainWindow, WindowMixin):
         self.stddev = QSpinBox()
         self.stddev.setRange(1, 50)
         self.stddev.setValue(settings.get(SETTING_STDDEV, 7))
+        self.segTiledCheckBox = QCheckBox("Tiled:")
+        self.segTiledCheckBox.setToolTip("Segment large boxes tile by tile at native resolution")
+        self.segTiledCheckBox.setChecked(settings.get(SETTING_SEG_TILED, False))
+        self.segTiledCheckBox.setLayoutDirection(Qt.RightToLeft)
 
         segAlgLayout = QHBoxLayout()
         segAlgLayout.addWidget(segAlgLabel)
@@ -213,6 +232,7 @@ class MainWindow(QMainWindow, WindowMixin):
         segAlgLayout.addWidget(self.segComputeDiceButton)
         segAlgLayout.addWidget(self.stddev_str)
         segAlgLayout.addWidget(self.stddev)
+        segAlgLayout.addWidget(self.segTiledCheckBox)
         segAlgLayout.addItem(QSpacerItem(20, 10, QSizePolicy.Expanding, QSizePolicy.Minimum))
         self.segAlgContainer = QWidget()
         self.segAlgContainer.setLayout(segAlgLayout)
@@ -286,11 +306,15 @@ class MainWindow(QMainWindow, WindowMixin):
         listLayout.addWidget(self.labelList)
 
         # For multiple columns
-        table = QTableWidget()
-        table.itemActivated.connect(self.labelSelectionChanged)
-        table.itemSelectionChanged.connect(self.labelSelectionChanged)
-        # table.itemDoubleClicked.connect(self.editLabel)
-        table.itemChanged.connect(self.labelItemChanged)
+        self.labelModel = LabelTableModel([getStr('tableHeaderAxis'), getStr('tableHeaderSlice'),
+                                           getStr('tableHeaderZ1'), getStr('tableHeaderZ2'),
+                                           getStr('tableHeaderLabel')], self)
+        self.labelModel.shapeEdited.connect(self.labelTableEdited)
+        table = QTableView()
+        table.setModel(self.labelModel)
+        table.activated.connect(self.labelSelectionChanged)
+        table.selectionModel().selectionChanged.connect(self.labelSelectionChanged)
+        # table.doubleClicked.connect(self.editLabel)
         font = QFont()
         font.setBold(True)
         table.horizontalHeader().setFont(font)
@@ -299,14 +323,11 @@ class MainWindow(QMainWindow, WindowMixin):
         table.horizontalHeader().setStretchLastSection(True)
         table.setSelectionMode(QAbstractItemView.SingleSelection)
         table.setSelectionBehavior(QAbstractItemView.SelectRows)
-        table.setColumnCount(5)
         table.horizontalHeader().resizeSection(0, 40)
         table.horizontalHeader().resizeSection(1, 80)
         table.horizontalHeader().resizeSection(2, 80)
         table.horizontalHeader().resizeSection(3, 80)
-        table.setHorizontalHeaderLabels([getStr('tableHeaderAxis'), getStr('tableHeaderSlice'),
-                                         getStr('tableHeaderZ1'), getStr('tableHeaderZ2'),
-                                         getStr('tableHeaderLabel')])
+        table.verticalHeader().setSectionResizeMode(QHeaderView.Fixed)
         table.horizontalHeader().setSectionsClickable(True)
         # table.setEditTriggers(QAbstractItemView.NoEditTriggers)
         self.labelTable = table
@@ -316,11 +337,25 @@ class MainWindow(QMainWindow, WindowMixin):
         self.dock.setObjectName(getStr('labels'))
         self.dock.setWidget(labelListContainer)
 
-        self.fileListWidget = QListWidget()
-        self.fileListWidget.itemDoubleClicked.connect(self.fileitemDoubleClicked)
+        self.fileListView = QListView()
+        self.fileListView.setUniformItemSizes(True)
+        self.fileListView.setModel(self.fileFilter)
+        self.fileListView.doubleClicked.connect(self.fileitemDoubleClicked)
+        # Filter the files with the annotation index
+        self.fileFilterCombo = QComboBox()
+        self.fileFilterCombo.addItem("All images", ("all", None))
+        self.fileFilterCombo.currentIndexChanged.connect(self.applyFileFilter)
+        self.indexButton = QToolButton()
+        self.indexButton.setText("Index")
+        self.indexButton.setToolTip("Update the annotation index")
+        self.indexButton.clicked.connect(lambda: self.updateAnnotationIndex())
+        fileFilterLayout = QHBoxLayout()
+        fileFilterLayout.addWidget(self.fileFilterCombo, 1)
+        fileFilterLayout.addWidget(self.indexButton)
         filelistLayout = QVBoxLayout()
         filelistLayout.setContentsMargins(0, 0, 0, 0)
-        filelistLayout.addWidget(self.fileListWidget)
+        filelistLayout.addLayout(fileFilterLayout)
+        filelistLayout.addWidget(self.fileListView)
         fileListContainer = QWidget()
         fileListContainer.setLayout(filelistLayout)
         self.filedock = QDockWidget(getStr('fileList'), self)
@@ -423,6 +458,8 @@ class MainWindow(QMainWindow, WindowMixin):
 
         help = action(getStr('tutorial'), self.showTutorialDialog, None, 'help', getStr('tutorialDetail'))
         showInfo = action(getStr('info'), self.showInfoDialog, None, 'help', getStr('info'))
+        exportTrace = action('Export Seg Trace', self.exportTraceDialog, None, 'save-as',
+                             'Export timings of the segmentation pipeline as Chrome trace JSON')
 
         zoom = QWidgetAction(self)
         zoom.setDefaultWidget(self.zoomWidget)
@@ -467,13 +504,17 @@ class MainWindow(QMainWindow, WindowMixin):
                                 icon='color', tip=getStr('shapeFillColorDetail'),
                                 enabled=False)
 
+        labelColor = action('Label Color', self.chLabelColor,
+                            icon='color', tip='Change the color of all the shapes with this label',
+                            enabled=False)
+
         labels = self.dock.toggleViewAction()
         labels.setText(getStr('showHide'))
         labels.setShortcut('Ctrl+Shift+L')
 
         # Label list context menu.
         labelMenu = QMenu()
-        addActions(labelMenu, (edit, delete))
+        addActions(labelMenu, (edit, delete, labelColor))
         self.labelList.setContextMenuPolicy(Qt.CustomContextMenu)
         self.labelList.customContextMenuRequested.connect(
             self.popLabelListMenu)
@@ -492,6 +533,7 @@ class MainWindow(QMainWindow, WindowMixin):
                               createPointMode=createPointMode,
                               advancedMode=advancedMode,
                               shapeLineColor=shapeLineColor, shapeFillColor=shapeFillColor,
+                              labelColor=labelColor,
                               zoom=zoom, zoomIn=zoomIn, zoomOut=zoomOut, zoomOrg=zoomOrg,
                               fitWindow=fitWindow, fitWidth=fitWidth,
                               zoomActions=zoomActions,
@@ -499,10 +541,10 @@ class MainWindow(QMainWindow, WindowMixin):
                                   open, opendir, save, saveAs, close, resetAll, quit),
                               beginner=(), advanced=(),
                               editMenu=(edit, copy, delete,
-                                        None, color1, self.drawSquaresOption),
+                                        None, color1, labelColor, self.drawSquaresOption),
                               beginnerContext=(createRect, createPoint, edit, copy, delete),
                               advancedContext=(createRect, createPointMode, edit, copy,
-                                               delete, shapeLineColor, shapeFillColor),
+                                               delete, shapeLineColor, shapeFillColor, labelColor),
                               onLoadActive=(
                                   close, createRect, createPoint,
                                   createRect, createPointMode),
@@ -535,6 +577,10 @@ class MainWindow(QMainWindow, WindowMixin):
         self.displayLabelOption.setCheckable(True)
         self.displayLabelOption.setChecked(settings.get(SETTING_PAINT_LABEL, False))
         self.displayLabelOption.triggered.connect(self.togglePaintLabelsOption)
+        # Save annotations as the compact .npz sidecar instead of .cxml
+        self.saveNpzOption = QAction('Save Compact Annotations (.npz)', self)
+        self.saveNpzOption.setCheckable(True)
+        self.saveNpzOption.setChecked(settings.get(SETTING_SAVE_NPZ, False))
 
         addActions(self.menus.file,
                    (open, opendir, changeSavedir, openAnnotation, self.menus.recentFiles,
@@ -544,10 +590,12 @@ class MainWindow(QMainWindow, WindowMixin):
             self.autoSaving,
             self.singleClassMode,
             self.displayLabelOption,
+            self.saveNpzOption,
             labels, advancedMode, None,
             hideAll, showAll, None,
             zoomIn, zoomOut, zoomOrg, None,
-            fitWindow, fitWidth))
+            fitWindow, fitWidth, None,
+            exportTrace))
 
         self.menus.file.aboutToShow.connect(self.updateFileMenu)
 
@@ -602,8 +650,9 @@ class MainWindow(QMainWindow, WindowMixin):
             self.statusBar().show()
 
         self.restoreState(settings.get(SETTING_WIN_STATE, QByteArray()))
-        Shape.line_color = self.lineColor = QColor(settings.get(SETTING_LINE_COLOR, DEFAULT_LINE_COLOR))
-        Shape.fill_color = self.fillColor = QColor(settings.get(SETTING_FILL_COLOR, DEFAULT_FILL_COLOR))
+        Shape.default_line_color = self.lineColor = QColor(settings.get(SETTING_LINE_COLOR, DEFAULT_LINE_COLOR))
+        Shape.default_fill_color = self.fillColor = QColor(settings.get(SETTING_FILL_COLOR, DEFAULT_FILL_COLOR))
+        labelColors.setPalette(settings.get(SETTING_LABEL_COLORS, {}))
         self.canvas.setDrawingColor(self.lineColor)
 
         def xbool(x):
@@ -634,6 +683,10 @@ class MainWindow(QMainWindow, WindowMixin):
         self.sliceNumber.setMinimumWidth(150)
         self.statusBar().addPermanentWidget(self.sliceNumber)
 
+        # Display stage timings of the last segmentation, for 3d image
+        self.segTiming = QLabel('')
+        self.statusBar().addPermanentWidget(self.segTiming)
+
         # Display cursor coordinates at the right of status bar
         self.labelCoordinates = QLabel('')
         self.labelCoordinates.setMinimumWidth(200)
@@ -653,7 +706,7 @@ class MainWindow(QMainWindow, WindowMixin):
             self.canvas.setDrawingShapeToSquare(True)
 
     def noShapes(self):
-        return not self.itemsToShapes
+        return not self.itemsToShapes and not self.labelModel.rowCount()
 
     def toggleAdvancedMode(self, value=True):
         self._beginner = not value
@@ -713,7 +766,7 @@ class MainWindow(QMainWindow, WindowMixin):
         self.itemsToShapes.clear()
         self.shapesToItems.clear()
         self.labelList.clear()
-        self.labelTable.setRowCount(0)      # Keep table header
+        self.labelModel.clear()
         self.filePath = None
         self.imageData = None
         self.labelFile = None
@@ -721,20 +774,17 @@ class MainWindow(QMainWindow, WindowMixin):
         self.labelCoordinates.clear()
 
     def currentItem(self):
-        if self.dim == TWO_D:
-            items = self.labelList.selectedItems()
-            if items:
-                return items[0]
-        else:
-            items = self.labelTable.selectedItems()
-            if items:
-                # We only choice `label` cell for indexing
-                if len(items) > 2:
-                    return items[-1]
-                else:   # Only `label` cell is selected
-                    return items[0]
+        items = self.labelList.selectedItems()
+        if items:
+            return items[0]
         return None
 
+    def currentTableRow(self):
+        rows = self.labelTable.selectionModel().selectedRows()
+        if rows:
+            return rows[0].row()
+        return -1
+
     def addRecentFile(self, filePath):
         if filePath in self.recentFiles:
             self.recentFiles.remove(filePath)
@@ -830,20 +880,29 @@ class MainWindow(QMainWindow, WindowMixin):
     def editLabel(self):
         if not self.canvas.editing():
             return
+        if self.dim == THREE_D:
+            row = self.currentTableRow()
+            if row < 0:
+                return
+            text = self.labelDialog.popUp(self.labelModel.shapes[row].label)
+            if text is not None:
+                self.labelModel.setData(self.labelModel.index(row, LabelTableModel.LABEL), text)
+                self.setDirty()
+            return
         item = self.currentItem()
         if not item:
             return
         text = self.labelDialog.popUp(item.text())
         if text is not None:
             item.setText(text)
-            item.setBackground(generateColorByText(text))
+            item.setBackground(labelColors.get(text))
             self.setDirty()
 
     # Tzutalin 20160906 : Add file list and dock to move faster
-    def fileitemDoubleClicked(self, item=None):
-        currIndex = self.mImgList.index(ustr(item.text()))
-        if currIndex < len(self.mImgList):
-            filename = self.mImgList[currIndex]
+    def fileitemDoubleClicked(self, index=None):
+        index = self.fileFilter.mapToSource(index)
+        if index.isValid() and index.row() < len(self.mImgList):
+            filename = self.mImgList[index.row()]
             if filename:
                 self.loadFile(filename)
 
@@ -854,10 +913,10 @@ class MainWindow(QMainWindow, WindowMixin):
         else:
             shape = self.canvas.selectedShape
             if shape:
-                self.shapesToItems[shape].setSelected(True)
-                if self.dim == THREE_D and shape in self.shapesToItems:
-                    for item in self.shapesToOthers[shape]:
-                        item.setSelected(True)
+                if self.dim == TWO_D:
+                    self.shapesToItems[shape].setSelected(True)
+                elif self.labelModel.rowOf(shape) >= 0:
+                    self.labelTable.selectRow(self.labelModel.rowOf(shape))
             else:
                 if self.dim == TWO_D:
                     self.labelList.clearSelection()
@@ -868,6 +927,7 @@ class MainWindow(QMainWindow, WindowMixin):
         self.actions.edit.setEnabled(selected)
         self.actions.shapeLineColor.setEnabled(selected)
         self.actions.shapeFillColor.setEnabled(selected)
+        self.actions.labelColor.setEnabled(selected)
 
     def addLabel(self, shape, axis=None, idx=None):
         if self.dim == TWO_D:
@@ -875,7 +935,7 @@ class MainWindow(QMainWindow, WindowMixin):
             item = HashableQListWidgetItem(shape.label)
             item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
             item.setCheckState(Qt.Checked)
-            item.setBackground(generateColorByText(shape.label))
+            item.setBackground(labelColors.get(shape.label))
             self.itemsToShapes[item] = shape
             self.shapesToItems[shape] = item
             self.labelList.addItem(item)
@@ -885,39 +945,7 @@ class MainWindow(QMainWindow, WindowMixin):
             if idx is None:
                 idx = self.idx
             shape.paintLabel = self.displayLabelOption.isChecked()
-            row = self.labelTable.rowCount()
-            self.labelTable.setRowCount(row + 1)
-            color = generateColorByText(shape.label)
-            item0 = QTableWidgetItem(str(axis))
-            item0.setBackground(color)
-            item0.setFlags(item0.flags() ^ Qt.ItemIsEditable)
-            self.labelTable.setItem(row, 0, item0)
-            item1 = QTableWidgetItem(str(idx))
-            item1.setBackground(color)
-            item1.setFlags(item1.flags() ^ Qt.ItemIsEditable)
-            self.labelTable.setItem(row, 1, item1)
-
-            z1 = shape.z1 if shape.z1 >= 0 else idx
-            item2 = HashableQTableWidgetItem(2, str(z1))
-            item2.setBackground(color)
-            self.itemsToShapes[item2] = shape
-            self.labelTable.setItem(row, 2, item2)
-            z2 = shape.z2 if shape.z2 >= 0 else idx
-            item3 = HashableQTableWidgetItem(3, str(z2))
-            item3.setBackground(color)
-            self.itemsToShapes[item3] = shape
-            self.labelTable.setItem(row, 3, item3)
-            shape.z1 = z1
-            shape.z2 = z2
-
-            item = HashableQTableWidgetItem(4, shape.label)
-            item.setFlags(item.flags() | Qt.ItemIsUserCheckable)
-            item.setCheckState(Qt.Checked)
-            item.setBackground(color)
-            self.itemsToShapes[item] = shape
-            self.shapesToItems[shape] = item
-            self.shapesToOthers[shape] = [item0, item1, item2, item3]
-            self.labelTable.setItem(row, 4, item)
+            self.labelModel.addShapes([(shape, axis, idx)])
 
         for action in self.actions.onShapesPresent:
             action.setEnabled(True)
@@ -926,19 +954,17 @@ class MainWindow(QMainWindow, WindowMixin):
         if shape is None:
             # print('rm empty label')
             return
-        item = self.shapesToItems[shape]
         if self.dim == TWO_D:
+            item = self.shapesToItems[shape]
             self.labelList.takeItem(self.labelList.row(item))
             del self.shapesToItems[shape]
             del self.itemsToShapes[item]
         else:
-            self.labelTable.removeRow(item.row())
-            del self.shapesToItems[shape]
-            del self.itemsToShapes[item]
-            del self.shapesToOthers[shape]
+            self.labelModel.removeShape(shape)
 
     def loadLabels(self, shapes):
-        shapes_3d = {}
+        store = AnnotationStore()
+        rows = []       # Rows of the label table, inserted at once
         for case in shapes:
             if isinstance(case, (list, tuple)):
                 label, points, line_color, fill_color = case
@@ -977,40 +1003,45 @@ class MainWindow(QMainWindow, WindowMixin):
                 shape.addPoint(QPointF(x, y))
             shape.close()
 
-            key = DSKey.ds2key(axis, sidx)
-            if key not in shapes_3d:
-                shapes_3d[key] = []
-            shapes_3d[key].append(shape)
+            store.add(shape, axis, sidx)
 
             if line_color:
                 shape.line_color = QColor(*line_color)
             else:
-                shape.line_color = generateColorByText(label)
+                shape.line_color = labelColors.get(label)
 
             if fill_color:
                 shape.fill_color = QColor(*fill_color)
             else:
-                shape.fill_color = generateColorByText(label)
+                shape.fill_color = labelColors.get(label)
 
-            self.addLabel(shape, axis, sidx)
+            if self.dim == TWO_D:
+                self.addLabel(shape, axis, sidx)
+            else:
+                shape.paintLabel = self.displayLabelOption.isChecked()
+                rows.append((shape, axis, sidx))
 
-        self.canvas.loadShapes(shapes_3d)
+        if rows:
+            self.labelModel.addShapes(rows)
+            for action in self.actions.onShapesPresent:
+                action.setEnabled(True)
+        self.canvas.loadShapes(store)
 
     def saveLabels(self, annotationFilePath):
         annotationFilePath = ustr(annotationFilePath)
         if self.labelFile is None:
             self.labelFile = LabelFile()
             self.labelFile.verified = self.canvas.verified
+        self.labelFile.useNpz = self.saveNpzOption.isChecked()
 
         def format_shape(s, key=None):
-            items = self.shapesToOthers[s]
             formatted = dict(label=s.label,
                              dtype=s.type_,
                              line_color=s.line_color.getRgb(),
                              fill_color=s.fill_color.getRgb(),
                              points=[(p.x(), p.y()) for p in s.points],
-                             z1=int(items[2].text()),
-                             z2=int(items[3].text()),
+                             z1=s.z1,
+                             z2=s.z2,
                              )
             if key:
                 formatted["axis"] = key[0]
@@ -1020,15 +1051,17 @@ class MainWindow(QMainWindow, WindowMixin):
             return formatted
 
         if self.dim == TWO_D:
-            shapes = [format_shape(shape) for shape in self.canvas.shapes_3d[DSKey.ds2key(0, 0)]]
+            shapes = [format_shape(shape) for shape in self.canvas.store.shapes(0, 0)]
         else:
-            shapes = [format_shape(shape, DSKey.key2ds(key))
-                      for key, shapes in self.canvas.shapes_3d.items() for shape in shapes]
+            shapes = [format_shape(shape, key) for key, shapes in self.canvas.store.items() for shape in shapes]
         # Can add differrent annotation formats here
         try:
             if annotationFilePath[-5:].lower() != ".cxml":
                 annotationFilePath += COMM_EXT
-            self.labelFile.saveCommonFormat(annotationFilePath, shapes, self.filePath)
+            imageShape = None
+            if self.dim == TWO_D and not self.image.isNull():
+                imageShape = [self.image.height(), self.image.width(), 1 if self.image.isGrayscale() else 3]
+            self.labelFile.saveCommonFormat(annotationFilePath, shapes, self.filePath, imageShape)
             print('Image:{0} -> Annotation:{1}'.format(self.filePath, annotationFilePath))
             return True
         except LabelFileError as e:
@@ -1042,46 +1075,60 @@ class MainWindow(QMainWindow, WindowMixin):
             # fix copy and delete
             self.shapeSelectionChanged(True)
 
-    def labelSelectionChanged(self):
-        item = self.currentItem()
-        if not isinstance(item, (HashableQTableWidgetItem, HashableQListWidgetItem)):
+    def labelSelectionChanged(self, *args):
+        if not self.canvas.editing():
             return
-        if item and self.canvas.editing():
+        if self.dim == TWO_D:
+            item = self.currentItem()
+            if not isinstance(item, HashableQListWidgetItem):
+                return
             self._noSelectionSlot = True    # Avoid selection loop between shape <-> item
-            shape = self.itemsToShapes[item]
-            if self.dim != TWO_D:
-                slice_index = int(self.shapesToOthers[shape][1].text())
-                self.idx = slice_index
-                self.canvas.setPtr(self.axis, self.idx)
-                self.canvas.deSelectShape()
-                self.updateCanvasImage()
+            self.canvas.selectShape(self.itemsToShapes[item])
+        else:
+            row = self.currentTableRow()
+            if row < 0:
+                return
+            self._noSelectionSlot = True
+            shape = self.labelModel.shapes[row]
+            self.idx = self.labelModel.place(shape)[1]
+            self.canvas.setPtr(self.axis, self.idx)
+            self.canvas.deSelectShape()
+            self.updateCanvasImage()
             self.canvas.selectShape(shape)
 
     def labelItemChanged(self, item):
-        if not isinstance(item, (HashableQTableWidgetItem, HashableQListWidgetItem)):
+        if not isinstance(item, HashableQListWidgetItem):
             return
         shape = self.itemsToShapes[item]
 
-        if item.col_ == 4 and item.text() != shape.label:
+        if item.text() != shape.label:
             shape.label = item.text()
-            shape.line_color = generateColorByText(shape.label)
+            shape.line_color = labelColors.get(shape.label)
             self.setDirty()
-        elif item.col_ == 2:
-            shape.z1 = int(item.text())
-        elif item.col_ == 3:
-            shape.z2 = int(item.text())
         else:  # User probably changed item visibility
             self.canvas.setShapeVisible(shape, item.checkState() == Qt.Checked)
 
+    def labelTableEdited(self, shape, column):
+        if column == LabelTableModel.VISIBLE:
+            self.canvas.setShapeVisible(shape, self.labelModel.checked[self.labelModel.rowOf(shape)])
+            return
+        if column == LabelTableModel.LABEL:
+            shape.line_color = labelColors.get(shape.label)
+        self.setDirty()
+
     def labelShowStateChanged(self):
-        state = self.labelShowCheckBox.checkState()
-        for i in range(self.labelTable.rowCount()):
-            self.labelTable.item(i, 4).setCheckState(state)
+        self.setAllLabelsVisible(self.labelShowCheckBox.checkState() == Qt.Checked)
+
+    def setAllLabelsVisible(self, value):
+        self.labelModel.setAllChecked(value)
+        for shape in self.labelModel.shapes:
+            shape.visible = value
+        self.canvas.repaint()
 
     # Callback functions:
     def newRect(self):
         text = "rectangle"
-        generate_color = generateColorByText(text)
+        generate_color = labelColors.get(text)
         shape = self.canvas.setLastLabel(text, generate_color, generate_color)
         self.addLabel(shape)
         self.canvas.setEditing(True)
@@ -1108,7 +1155,7 @@ class MainWindow(QMainWindow, WindowMixin):
 
         if text is not None:
             self.prevLabelText = text
-            generate_color = generateColorByText(text)
+            generate_color = labelColors.get(text)
             shape = self.canvas.setLastLabel(text, generate_color, generate_color)
             self.addLabel(shape)
             if self.beginner():  # Switch to edit mode.
@@ -1216,6 +1263,7 @@ class MainWindow(QMainWindow, WindowMixin):
     def togglePolygons(self, value):
         for item, shape in self.itemsToShapes.items():
             item.setCheckState(Qt.Checked if value else Qt.Unchecked)
+        self.setAllLabelsVisible(value)
 
     def loadFile(self, filePath=None):
         """Load the specified file, or the last opened file if None."""
@@ -1232,23 +1280,25 @@ class MainWindow(QMainWindow, WindowMixin):
         unicodeFilePath = os.path.abspath(unicodeFilePath)
         # Tzutalin 20160906 : Add file list and dock to move faster
         # Highlight the file item
-        if unicodeFilePath and self.fileListWidget.count() > 0:
-            if unicodeFilePath in self.mImgList:
-                index = self.mImgList.index(unicodeFilePath)
-                fileWidgetItem = self.fileListWidget.item(index)
-                fileWidgetItem.setSelected(True)
+        if unicodeFilePath and self.fileModel.rowCount() > 0:
+            index = self.fileModel.indexOf(unicodeFilePath)
+            if index >= 0:
+                self.fileModel.setCurrentRow(index)
+                self.fileListView.setCurrentIndex(self.fileFilter.mapFromSource(self.fileModel.index(index)))
             else:
-                self.fileListWidget.clear()
-                self.mImgList.clear()
+                self.stopDirScan()
+                self.fileModel.clear()
                 
         if unicodeFilePath and os.path.exists(unicodeFilePath):
             # Load image:
-            # read data first and store for saving into label file.
+            # 2d images are decoded (or taken from the prefetch cache) below.
             if not self.is3dimage(unicodeFilePath):
-                self.imageData = read(unicodeFilePath, None)
                 self.dim = TWO_D
             else:
-                self.i3d = read3d(unicodeFilePath)
+                # Taken from the prefetcher if it was read in the background
+                self.i3d = self.volumePrefetcher.take(unicodeFilePath)
+                if self.i3d is None:
+                    self.i3d = read3d(unicodeFilePath)
                 self.i3d.setIntensityClip(low=self.int_low.value(), high=self.int_high.value())
                 self.dim = THREE_D
                 self.ref = self.i3d.label
@@ -1257,7 +1307,10 @@ class MainWindow(QMainWindow, WindowMixin):
 
             if self.dim == TWO_D:
                 self.sliceNumber.setText("")
-                image = QImage.fromData(self.imageData)
+                # Too large images are read by tiles when they are painted
+                image = openTiled(unicodeFilePath)
+                if image is None:
+                    image = self.prefetcher.image(unicodeFilePath)
                 self.labelList.setVisible(True)
                 self.labelTable.setVisible(False)
                 self.settingDock.setVisible(False)
@@ -1272,6 +1325,8 @@ class MainWindow(QMainWindow, WindowMixin):
                 self.segAlgButtonRun.setEnabled(True)
                 self.segAlgButtonSave.setEnabled(True)
                 self.total_time = 0
+                self.segTiming.clear()
+                tracer.reset()
             if image.isNull():
                 self.errorMessage(u'Error opening file',
                                   u"<p>Make sure <i>%s</i> is a valid image file." % unicodeFilePath)
@@ -1280,7 +1335,10 @@ class MainWindow(QMainWindow, WindowMixin):
             self.status("Loaded %s" % os.path.basename(unicodeFilePath))
             self.image = image
             self.filePath = unicodeFilePath
-            self.canvas.loadPixmap(QPixmap.fromImage(image))
+            if isinstance(image, TiledImage):
+                self.canvas.loadTiledImage(image)
+            else:
+                self.canvas.loadPixmap(QPixmap.fromImage(image), image)
             if self.labelFile:
                 self.loadLabels(self.labelFile.shapes)
             self.setClean()
@@ -1291,25 +1349,8 @@ class MainWindow(QMainWindow, WindowMixin):
             self.toggleActions(True)
 
             # Label xml file and show bound box according to its filename
-            if self.defaultSaveDir is not None:
-                basename = os.path.basename(os.path.splitext(self.filePath)[0])
-                if "." in basename:
-                    basename = basename.split(".")[0]
-                cxmlPath = os.path.join(self.defaultSaveDir, basename + COMM_EXT)
-                
-                """Annotation file priority: Common """
-                if os.path.isfile(cxmlPath):
-                    print("Load annotation: ", cxmlPath)
-                    self.loadCommonXMLByFilename(cxmlPath)
-                else:
-                    self.canvas.loadShapes({})
-            else:
-                cxmlPath = os.path.splitext(filePath)[0] + COMM_EXT
-                if os.path.isfile(cxmlPath):
-                    print("Load annotation: ", cxmlPath)
-                    self.loadCommonXMLByFilename(cxmlPath)
-                else:
-                    self.canvas.loadShapes({})
+            if not self.loadCommonXMLByFilename(self.annotationPath(self.filePath)):
+                self.canvas.loadShapes(AnnotationStore())
 
             self.setWindowTitle(__appname__ + ' ' + filePath)
 
@@ -1317,14 +1358,41 @@ class MainWindow(QMainWindow, WindowMixin):
             if self.dim == TWO_D and self.labelList.count():
                 self.labelList.setCurrentItem(self.labelList.item(self.labelList.count()-1))
                 self.labelList.item(self.labelList.count()-1).setSelected(True)
-            if self.dim == THREE_D and self.labelTable.rowCount():
-                self.labelTable.setCurrentItem(self.labelTable.item(self.labelTable.rowCount() - 1, 4))
-                self.labelTable.item(self.labelTable.rowCount() - 1, 4).setSelected(True)
+            if self.dim == THREE_D and self.labelModel.rowCount():
+                self.labelTable.selectRow(self.labelModel.rowCount() - 1)
 
             self.canvas.setFocus(True)
+            self.prefetchNeighbours()
             return True
         return False
 
+    def annotationPath(self, filePath):
+        """ Path of the annotation file loaded with the image `filePath` """
+        if self.defaultSaveDir is not None:
+            basename = os.path.basename(os.path.splitext(filePath)[0])
+            if "." in basename:
+                basename = basename.split(".")[0]
+            return os.path.join(self.defaultSaveDir, basename + COMM_EXT)
+        return os.path.splitext(filePath)[0] + COMM_EXT
+
+    def prefetchNeighbours(self):
+        """
+        Decode the next/previous 2d images and parse their annotations, or read the next
+        3d volumes, in the background
+        """
+        if self.fileModel.indexOf(self.filePath) < 0:
+            return
+        # The images opened next, skipping those hidden by the file filter like the navigation
+        if self.dim == THREE_D:
+            self.volumePrefetcher.prefetch([self.mImgList[i] for i in self.neighbourRows(1, VOLUME_PREFETCH_COUNT)
+                                            if self.is3dimage(self.mImgList[i])])
+            return
+        rows = []
+        for pair in zip_longest(self.neighbourRows(1, PREFETCH_COUNT), self.neighbourRows(-1, PREFETCH_COUNT)):
+            rows.extend(i for i in pair if i is not None)
+        self.prefetcher.prefetch([(self.mImgList[i], self.annotationPath(self.mImgList[i])) for i in rows
+                                  if not self.is3dimage(self.mImgList[i])])
+
     def resizeEvent(self, event):
         if self.canvas and not self.image.isNull()\
            and self.zoomMode != self.MANUAL_ZOOM:
@@ -1348,19 +1416,23 @@ class MainWindow(QMainWindow, WindowMixin):
         h1 = self.centralWidget().height() - e
         a1 = w1 / h1
         # Calculate a new scale value based on the pixmap's aspect ratio.
-        w2 = self.canvas.pixmap.width() - 0.0
-        h2 = self.canvas.pixmap.height() - 0.0
+        w2 = self.canvas.imageSize().width() - 0.0
+        h2 = self.canvas.imageSize().height() - 0.0
         a2 = w2 / h2
         return w1 / w2 if a2 >= a1 else h1 / h2
 
     def scaleFitWidth(self):
         # The epsilon does not seem to work too well here.
         w = self.centralWidget().width() - 2.0
-        return w / self.canvas.pixmap.width()
+        return w / self.canvas.imageSize().width()
 
     def closeEvent(self, event):
         if not self.mayContinue():
             event.ignore()
+        else:
+            self.stopDirScan(wait=True)
+            for updater in self.findChildren(IndexUpdater):
+                updater.wait()
         settings = self.settings
         # If it loads images from dir, don't load it at the begining
         if self.dirname is None:
@@ -1373,6 +1445,7 @@ class MainWindow(QMainWindow, WindowMixin):
         settings[SETTING_WIN_STATE] = self.saveState()
         settings[SETTING_LINE_COLOR] = self.lineColor
         settings[SETTING_FILL_COLOR] = self.fillColor
+        settings[SETTING_LABEL_COLORS] = labelColors.palette()
         settings[SETTING_RECENT_FILES] = self.recentFiles
         settings[SETTING_ADVANCE_MODE] = not self._beginner
         if self.defaultSaveDir and os.path.exists(self.defaultSaveDir):
@@ -1398,33 +1471,14 @@ class MainWindow(QMainWindow, WindowMixin):
         settings[SETTING_ALPHA] = self.segResSlider.value()
         settings[SETTING_INT_MIN] = self.int_low.value()
         settings[SETTING_INT_MAX] = self.int_high.value()
+        settings[SETTING_SEG_TILED] = self.segTiledCheckBox.isChecked()
+        settings[SETTING_SAVE_NPZ] = self.saveNpzOption.isChecked()
         settings.save()
 
     def loadRecent(self, filename):
         if self.mayContinue():
             self.loadFile(filename)
 
-    def scanAllImages(self, folderPath):
-        # Priorities: 3d > 2d
-        extensions = ['.%s' % fmt.data().decode("ascii").lower() for fmt in QImageReader.supportedImageFormats()]
-        extensions_3d = self.get3dformats()
-        images = []
-        images_3d = []
-
-        for root, dirs, files in os.walk(folderPath):
-            for file in files:
-                if file.lower().endswith(tuple(extensions)):
-                    relativePath = os.path.join(root, file)
-                    path = ustr(os.path.abspath(relativePath))
-                    images.append(path)
-                elif file.lower().endswith(tuple(extensions_3d)):
-                    relativePath = os.path.join(root, file)
-                    path = ustr(os.path.abspath(relativePath))
-                    images_3d.append(path)
-        natural_sort(images, key=lambda x: x.lower())
-        natural_sort(images_3d, key=lambda x: x.lower())
-        return images + images_3d
-
     def changeSavedirDialog(self, _value=False):
         if self.defaultSaveDir is not None:
             path = ustr(self.defaultSaveDir)
@@ -1437,6 +1491,7 @@ class MainWindow(QMainWindow, WindowMixin):
 
         if dirpath is not None and len(dirpath) > 1:
             self.defaultSaveDir = dirpath
+            self.updateAnnotationIndex()
 
         self.statusBar().showMessage('%s . Annotation will be saved to %s' %
                                      ('Change saved folder', self.defaultSaveDir))
@@ -1483,12 +1538,132 @@ class MainWindow(QMainWindow, WindowMixin):
         self.lastOpenDir = dirpath
         self.dirname = dirpath
         self.filePath = None
-        self.fileListWidget.clear()
-        self.mImgList = self.scanAllImages(dirpath)
-        self.openNextImg()
-        for imgPath in self.mImgList:
-            item = QListWidgetItem(imgPath)
-            self.fileListWidget.addItem(item)
+        self.stopDirScan()
+        self.fileModel.clear()
+        extensions = ['.%s' % fmt.data().decode("ascii").lower() for fmt in QImageReader.supportedImageFormats()]
+        self.dirScanner = DirScanner(dirpath, extensions, self.get3dformats(), parent=self)
+        self.dirScanner.found.connect(self.dirScanFound)
+        self.dirScanner.finished.connect(self.dirScanFinished)
+        self.dirScanner.finished.connect(self.dirScanner.deleteLater)
+        self.status("Scanning %s ..." % dirpath)
+        self.dirScanner.start()
+
+    def dirScanFound(self, items):
+        if self.sender() is not self.dirScanner:
+            return
+        empty = self.fileModel.rowCount() == 0
+        self.fileModel.addPaths(items)
+        if empty and self.filePath is None:
+            self.openNextImg()
+
+    def dirScanFinished(self):
+        if self.sender() is not self.dirScanner:
+            return
+        self.dirScanner = None
+        self.status("Found %d images in %s" % (len(self.mImgList), self.dirname))
+        self.updateAnnotationIndex()
+
+    def stopDirScan(self, wait=False):
+        if self.dirScanner is not None:
+            self.dirScanner.requestInterruption()
+            if wait:
+                self.dirScanner.wait()
+            self.dirScanner = None
+
+    @property
+    def mImgList(self):
+        return self.fileModel.paths
+
+    def neighbourRow(self, step):
+        """ Row of the next (step=1) or previous (step=-1) image shown by the file filter """
+        row = self.fileModel.indexOf(self.filePath) + step
+        while 0 <= row < len(self.mImgList) and not self.fileFilter.acceptsPath(self.mImgList[row]):
+            row += step
+        return row
+
+    def neighbourRows(self, step, count):
+        """ Rows of the `count` next (step=1) or previous (step=-1) images shown by the file filter """
+        rows = []
+        row = self.fileModel.indexOf(self.filePath)
+        while len(rows) < count:
+            row += step
+            while 0 <= row < len(self.mImgList) and not self.fileFilter.acceptsPath(self.mImgList[row]):
+                row += step
+            if not 0 <= row < len(self.mImgList):
+                break
+            rows.append(row)
+        return rows
+
+    def updateAnnotationIndex(self, saved=None):
+        """
+        Update the annotation index of the save dir (or the image dir) in the background,
+        only for `saved` ({annotation path: image path}) if given
+        """
+        root = self.defaultSaveDir or self.dirname
+        if not root or not os.path.isdir(root):
+            return
+        paths = None
+        if self.annotationIndex is None or self.annotationIndex.folderPath != os.path.abspath(root):
+            self.annotationIndex = AnnotationIndex(root)
+        elif saved is not None:
+            paths = [os.path.abspath(path) for path in saved]
+            self.indexedImages.update(zip(paths, saved.values()))
+        if paths is None:
+            self.status("Indexing annotations in %s ..." % root)
+        updater = self.indexUpdater
+        if updater is not None and updater.index is self.annotationIndex and updater.enqueue(paths):
+            return
+        updater = self.indexUpdater = IndexUpdater(self.annotationIndex, paths, parent=self)
+        updater.updated.connect(self.annotationIndexUpdated)
+        updater.finished.connect(updater.deleteLater)
+        updater.start()
+
+    def annotationIndexUpdated(self, count, labelCounts, fileLabels):
+        if self.annotationIndex is None or labelCounts is None:
+            return
+        current = self.fileFilterCombo.currentData()
+        self.fileFilterCombo.blockSignals(True)
+        self.fileFilterCombo.clear()
+        self.fileFilterCombo.addItem("All images", ("all", None))
+        self.fileFilterCombo.addItem("Unannotated", ("unannotated", None))
+        for label, objects, files in labelCounts:
+            self.fileFilterCombo.addItem("%s (%d files, %d objects)" % (label, files, objects), ("label", label))
+        # Not findData(), which compares the python objects by identity
+        items = [self.fileFilterCombo.itemData(i) for i in range(self.fileFilterCombo.count())]
+        self.fileFilterCombo.setCurrentIndex(items.index(current) if current in items else 0)
+        self.fileFilterCombo.blockSignals(False)
+        if self.fileFilterCombo.currentData() != current or fileLabels is None:
+            self.applyFileFilter()
+        else:
+            self.updateFileFilter(fileLabels)
+        if count > 1:
+            self.status("Indexed %d annotation files" % count)
+
+    def applyFileFilter(self, _value=None):
+        kind, label = self.fileFilterCombo.currentData() or ("all", None)
+        if kind == "all" or self.annotationIndex is None:
+            self.fileFilter.setFilter(None)
+            return
+        if kind == "unannotated":
+            files = self.annotationIndex.annotatedFiles()
+        else:
+            files = self.annotationIndex.filesWithLabel(label)
+        images = set(path for path in self.mImgList if os.path.abspath(self.annotationPath(path)) in files)
+        self.fileFilter.setFilter(images, exclude=kind == "unannotated")
+
+    def updateFileFilter(self, fileLabels):
+        """ Filter again only the images of the annotations in `fileLabels` ({path: labels}), after a save """
+        images = {}
+        for path, labels in fileLabels.items():
+            image = self.indexedImages.pop(path, None)
+            # The filter matches the images by the annotation they load
+            if image is not None and os.path.abspath(self.annotationPath(image)) == path:
+                images[image] = labels
+        kind, label = self.fileFilterCombo.currentData() or ("all", None)
+        if kind == "all":
+            return
+        for image, labels in images.items():
+            self.fileFilter.setContains(image, bool(labels) if kind == "unannotated" else label in labels)
 
     def openPrevImg(self, _value=False):
         # Proceding prev image without dialog if having any label
@@ -1509,9 +1684,9 @@ class MainWindow(QMainWindow, WindowMixin):
         if self.filePath is None:
             return
 
-        currIndex = self.mImgList.index(self.filePath)
-        if currIndex - 1 >= 0:
-            filename = self.mImgList[currIndex - 1]
+        prevIndex = self.neighbourRow(-1)
+        if prevIndex >= 0:
+            filename = self.mImgList[prevIndex]
             if filename:
                 self.loadFile(filename)
 
@@ -1535,9 +1710,9 @@ class MainWindow(QMainWindow, WindowMixin):
         if self.filePath is None:
             filename = self.mImgList[0]
         else:
-            currIndex = self.mImgList.index(self.filePath)
-            if currIndex + 1 < len(self.mImgList):
-                filename = self.mImgList[currIndex + 1]
+            nextIndex = self.neighbourRow(1)
+            if nextIndex < len(self.mImgList):
+                filename = self.mImgList[nextIndex]
 
         if filename:
             self.loadFile(filename)
@@ -1602,6 +1777,10 @@ class MainWindow(QMainWindow, WindowMixin):
             self.setClean()
             self.statusBar().showMessage('Saved to  %s' % annotationFilePath)
             self.statusBar().show()
+            if not annotationFilePath.endswith(COMM_EXT):
+                annotationFilePath += COMM_EXT
+            if self.annotationIndex is not None:
+                self.updateAnnotationIndex({annotationFilePath: self.filePath})
 
     def closeFile(self, _value=False):
         if not self.mayContinue():
@@ -1638,7 +1817,7 @@ class MainWindow(QMainWindow, WindowMixin):
                                           default=DEFAULT_LINE_COLOR)
         if color:
             self.lineColor = color
-            Shape.line_color = color
+            Shape.default_line_color = color
             self.canvas.setDrawingColor(color)
             self.canvas.update()
             self.setDirty()
@@ -1666,6 +1845,30 @@ class MainWindow(QMainWindow, WindowMixin):
             self.canvas.update()
             self.setDirty()
 
+    def chLabelColor(self):
+        label = self.canvas.selectedShape.label
+        old = labelColors.get(label)
+        color = self.colorDialog.getColor(old, u'Choose color of %s' % label,
+                                          default=generateColorByText(label))
+        if not color:
+            return
+        labelColors.setColor(label, None if color == generateColorByText(label) else color)
+        color = labelColors.get(label)
+        # Recolor the shapes which use the color of their label
+        for shape in self.canvas.store:
+            if shape.label != label:
+                continue
+            if shape.line_color == old:
+                shape.line_color = color
+            if shape.fill_color == old:
+                shape.fill_color = color
+        for item, shape in self.itemsToShapes.items():
+            if shape.label == label:
+                item.setBackground(color)
+        self.labelModel.colorsChanged()
+        self.canvas.update()
+        self.setDirty()
+
     def copyShape(self):
         self.canvas.endMove(copy=True)
         self.addLabel(self.canvas.selectedShape)
@@ -1687,14 +1890,21 @@ class MainWindow(QMainWindow, WindowMixin):
 
     def loadCommonXMLByFilename(self, cxmlPath):
         if self.filePath is None:
-            return
-        if os.path.isfile(cxmlPath) is False:
-            return
+            return False
 
-        tCommonParserReader = CommonReader(cxmlPath)
+        # Parsed in the background if it was prefetched, None if the file does not exist
+        try:
+            tCommonParserReader = self.prefetcher.annotation(cxmlPath)
+        except CommonReaderError as e:
+            self.errorMessage(u'Error opening annotation', u'<b>%s</b>' % e)
+            return False
+        if tCommonParserReader is None:
+            return False
+        print("Load annotation: ", cxmlPath)
         shapes = tCommonParserReader.getShapes()
         self.loadLabels(shapes)
         self.canvas.verified = tCommonParserReader.verified
+        return True
 
     def togglePaintLabelsOption(self):
         for shape in self.canvas.shapes:
@@ -1729,7 +1939,7 @@ class MainWindow(QMainWindow, WindowMixin):
             self.image = self.i3d.at(self.idx, self.axis, self.segShowCheckBox.isChecked(),
                                      self.gtShowCheckBox.isChecked())
         self.sliceNumber.setText("Slice: {:3d} / Total: {:3d}".format(self.idx, self.i3d.shape[self.axis]))
-        self.canvas.loadPixmap(QPixmap.fromImage(self.image))
+        self.canvas.loadPixmap(QPixmap.fromImage(self.image), self.image)
 
     def update3dImageLow(self, value):
         if self.i3d and isinstance(value, int):
@@ -1742,47 +1952,23 @@ class MainWindow(QMainWindow, WindowMixin):
             self.updateCanvasImage()
 
     def segRun(self):
+        if self.i3d is not None:
+            mark = tracer.mark()
+            with span("segRun", alg=self.segAlgComboBox.currentText()):
+                self._segRun()
+            summary = tracer.summary(mark)
+            # The slice rendering after segmentation is not a part of the pipeline
+            summary.pop("Image3d.at", None)
+            self.segTiming.setText("%s %.0f ms" % (self.segAlgComboBox.currentText(), summary["segRun"]))
+            self.segTiming.setToolTip("\n".join("%s: %.1f ms" % (k, v) for k, v in summary.items()))
+
+    def _segRun(self):
         segAlg = self.segAlgComboBox.currentText()
         if self.i3d is not None:
             start = time.time()
-            name = self.segName[self.segAlg.index(segAlg)]
-            centers = {"fg": [], "bg": []}
-            stddevs = {"fg": [], "bg": []}
-            bbox = [None] * 6
-            for key, shapes in self.canvas.shapes_3d.items():
-                for shape in shapes:
-                    if not self.canvas.isVisible(shape):
-                        continue
-                    if shape.type_ == Shape.RECTANGLE:
-                        x1, y1, w, h = shape.rect()
-                        bbox[0] = int(shape.z1)
-                        bbox[1] = int(y1)
-                        bbox[2] = int(x1)
-                        bbox[3] = int(shape.z2) + 1
-                        bbox[4] = int(y1 + h)
-                        bbox[5] = int(x1 + w)
-                    if shape.type_ == Shape.POINT:
-                        if shape.fg:
-                            k = "fg"
-                            stddevs[k].append([2., self.stddev.value(), self.stddev.value()])
-                        else:
-                            k = "bg"
-                            stddevs[k].append([1., self.stddev.value(), self.stddev.value()])
-                        centers[k].append([int(DSKey.key2ds(key)[1]), int(shape.points[0].y()), int(shape.points[0].x())])
-            if segAlg == "Test":
-                success = self.i3d.seg_test(bbox, centers, stddevs)
-            elif segAlg == "DIN":
-                success = self.i3d.seg_din(bbox, centers, stddevs, name, guide_type="exp")
-            elif segAlg == "EDT":
-                success = self.i3d.seg_din(bbox, centers, stddevs, name, guide_type="euc")
-            elif segAlg == "GDT":
-                success = self.i3d.seg_din(bbox, centers, stddevs, name, guide_type="geo")
-            elif segAlg == "Random Walk 3D":
-                success = self.i3d.seg_RW(bbox, centers)
-            elif segAlg == "Graph Cut 3D":
-                success = self.i3d.seg_GraphCut(bbox, centers)
-            else:
-                success = 1
+            tiled = self.segTiledCheckBox.isChecked()
+            bbox, centers, stddevs = gather_seg_inputs(self.canvas.store, self.stddev.value())
+            success = self.i3d.segment(segAlg, bbox, centers, stddevs, tiled=tiled)
             diff = time.time() - start
             if success == 0:
                 self.updateCanvasImage()
@@ -1829,6 +2015,21 @@ class MainWindow(QMainWindow, WindowMixin):
                         seg = self.i3d.segCache
                     write_nii(seg, self.i3d.meta.meta, saveFile)
 
+    def exportTraceDialog(self, _value=False):
+        caption = '%s - Export Trace' % __appname__
+        filters = 'Chrome trace (*.json)'
+        openDialogPath = self.currentPath()
+        dlg = QFileDialog(self, caption, openDialogPath, filters)
+        dlg.setDefaultSuffix("json")
+        dlg.setAcceptMode(QFileDialog.AcceptSave)
+        if self.filePath:
+            dlg.selectFile(os.path.basename(self.filePath).split(".")[0] + ".trace")
+        dlg.setOption(QFileDialog.DontUseNativeDialog, False)
+        if dlg.exec_():
+            traceFile = ustr(dlg.selectedFiles()[0])
+            count = tracer.exportChrome(traceFile)
+            self.status("Exported %d spans to %s" % (count, traceFile))
+
     def saveSegDialog(self, suffix, removeExt=True):
         caption = '%s - Choose File' % __appname__
         filters = 'Segmentation (*.nii.gz)'
@@ -1887,24 +2088,17 @@ class MainWindow(QMainWindow, WindowMixin):
         if len(self.i3d.segCache) == 0:
             return
         if self.ref is None:
-            ref_file = os.path.join(os.path.dirname(self.filePath),
-                                    os.path.basename(self.filePath).replace("img", "mask")
-                                    .replace("volume", "segmentation"))
+            ref_file = label_path(self.filePath)
             header, self.ref = read_nii(ref_file, out_dtype=np.uint8)
 
         # get bbox
         bbox = (slice(None), slice(None), slice(None))
-        find = False
-        for _, shapes in self.canvas.shapes_3d.items():
-            for shape in shapes:
-                if shape.type_ == Shape.RECTANGLE and self.canvas.isVisible(shape):
-                    x1, y1, w, h = shape.rect()
-                    bbox = (slice(int(shape.z1), int(shape.z2 + 1)),
-                            slice(int(y1), int(y1 + h)),
-                            slice(int(x1), int(x1 + w)))
-                    find = True
-                    break
-            if find:
+        for shape in self.canvas.store:
+            if shape.type_ == Shape.RECTANGLE and self.canvas.isVisible(shape):
+                x1, y1, w, h = shape.rect()
+                bbox = (slice(int(shape.z1), int(shape.z2 + 1)),
+                        slice(int(y1), int(y1 + h)),
+                        slice(int(x1), int(x1 + w)))
                 break
         dice, vd, rvd = computeMetrics(self.ref, self.i3d.segCache, bbox, self.i3d.unit)
         QMessageBox.information(self, "Info", f"{os.path.basename(self.filePath)}\n\nDice: {dice}\nVD: {vd:.0f}\nRVD: {rvd * 100:.2f}",
@@ -1921,14 +2115,6 @@ def inverted(color):
     return QColor(*[255 - v for v in color.getRgb()])
 
 
-def read(filename, default=None):
-    try:
-        with open(filename, 'rb') as f:
-            return f.read()
-    except:
-        return default
-
-
 def get_main_app(argv=[]):
     """
     Standard boilerplate Qt application code.
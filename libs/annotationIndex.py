@@ -0,0 +1,235 @@
+import hashlib
+import itertools
+import multiprocessing
+import os
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+try:
+    from PyQt5.QtCore import *
+except ImportError:
+    from PyQt4.QtCore import *
+
+from libs.common_io import COMM_EXT, NPZ_EXT, COLUMNS, CommonReaderError, latestAnnotation, openAnnotation
+
+"""
+    SQLite index of all the annotations under a directory, for searching the
+    dataset by label and for per-label statistics without opening every image.
+
+    The index of a directory lives in ~/.labelImgIndex/ and is updated
+    incrementally: only the annotation files whose mtime changed are parsed again.
+"""
+
+INDEX_DIR = os.path.join(os.path.expanduser("~"), ".labelImgIndex")
+POOL_THRESHOLD = 64     # Parse with a process pool when more files than this have changed
+STORE_CHUNK = 256       # Files written per transaction, so a long scan does not lock the index
+DB_TIMEOUT = 30.        # Seconds to wait for the lock of another connection
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,      -- .cxml path, also for the annotations saved as .cxml.npz
+    mtime INTEGER,
+    count INTEGER               -- number of objects, -1 if the file can not be parsed
+);
+CREATE TABLE IF NOT EXISTS objects (
+    file TEXT, label TEXT, type INTEGER, axis INTEGER, slice INTEGER,
+    x1 INTEGER, y1 INTEGER, x2 INTEGER, y2 INTEGER, z1 INTEGER, z2 INTEGER, fg INTEGER
+);
+CREATE INDEX IF NOT EXISTS objects_file ON objects (file);
+CREATE INDEX IF NOT EXISTS objects_label ON objects (label);
+"""
+
+
+def readAnnotation(cxmlPath):
+    """ Return (cxml path, mtime, object rows) of an annotation, rows is None if it is malformed """
+    found = latestAnnotation(cxmlPath)
+    if found is None:
+        return cxmlPath, None, []
+    try:
+        reader = openAnnotation(found[0])
+    except CommonReaderError as e:
+        print(e)
+        return cxmlPath, found[1], None
+    c = reader.columns
+    rows = [(cxmlPath, reader.labels[label], int(dtype), int(axis), int(slice_),
+             int(x1), int(y1), int(x2), int(y2), int(z1), int(z2), int(fg))
+            for dtype, label, x1, y1, x2, y2, z1, z2, axis, slice_, fg in zip(*(c[k] for k in COLUMNS))]
+    return cxmlPath, found[1], rows
+
+
+def scanAnnotations(folderPath):
+    """ Return {cxml path: mtime} of the annotations (.cxml or .cxml.npz) under `folderPath` """
+    found = {}
+    stack = [os.path.abspath(folderPath)]
+    while stack:
+        try:
+            with os.scandir(stack.pop()) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    stack.append(entry.path)
+                    continue
+                if entry.name.endswith(COMM_EXT):
+                    path = entry.path
+                elif entry.name.endswith(COMM_EXT + NPZ_EXT):
+                    path = entry.path[:-len(NPZ_EXT)]
+                else:
+                    continue
+                mtime = entry.stat().st_mtime_ns
+            except OSError:
+                continue
+            found[path] = max(mtime, found.get(path, mtime))
+    return found
+
+
+class AnnotationIndex(object):
+
+    def __init__(self, folderPath, dbPath=None):
+        self.folderPath = os.path.abspath(folderPath)
+        if dbPath is None:
+            os.makedirs(INDEX_DIR, exist_ok=True)
+            name = hashlib.sha1(self.folderPath.encode("utf-8")).hexdigest()[:16]
+            dbPath = os.path.join(INDEX_DIR, name + ".sqlite")
+        self.dbPath = dbPath
+        with self.connect() as db:
+            # Readers do not wait for the writer and the other way round
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+
+    @contextmanager
+    def connect(self):
+        # One connection per call, so the index can be used from the updater thread
+        db = sqlite3.connect(self.dbPath, timeout=DB_TIMEOUT)
+        try:
+            with db:
+                yield db
+        finally:
+            db.close()
+
+    def update(self, paths=None, workers=None):
+        """
+        Parse the new and modified annotations under the folder (or only `paths`)
+        and drop the deleted ones. Return the number of parsed files.
+        """
+        with self.connect() as db:
+            indexed = dict(db.execute("SELECT path, mtime FROM files"))
+        if paths is None:
+            current = scanAnnotations(self.folderPath)
+            removed = [path for path in indexed if path not in current]
+            changed = [path for path, mtime in current.items() if indexed.get(path) != mtime]
+        else:
+            removed = []
+            changed = [os.path.abspath(path) for path in paths]
+
+        if len(changed) > POOL_THRESHOLD:
+            # spawn: do not fork the Qt process
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+                results = executor.map(readAnnotation, changed, chunksize=32)
+                self.store(results, removed)
+        else:
+            self.store(map(readAnnotation, changed), removed)
+        return len(changed)
+
+    def store(self, results, removed):
+        """
+        Write the results of readAnnotation(), STORE_CHUNK files per transaction, which
+        is opened once they are parsed so other connections wait at most for one chunk
+        """
+        results = iter(results)
+        with self.connect() as db:
+            with db:
+                for path in removed:
+                    db.execute("DELETE FROM objects WHERE file = ?", (path,))
+                    db.execute("DELETE FROM files WHERE path = ?", (path,))
+            while True:
+                chunk = list(itertools.islice(results, STORE_CHUNK))
+                if not chunk:
+                    break
+                with db:
+                    for path, mtime, rows in chunk:
+                        db.execute("DELETE FROM objects WHERE file = ?", (path,))
+                        if mtime is None:
+                            db.execute("DELETE FROM files WHERE path = ?", (path,))
+                            continue
+                        db.execute("INSERT OR REPLACE INTO files VALUES (?, ?, ?)",
+                                   (path, mtime, -1 if rows is None else len(rows)))
+                        if rows:
+                            db.executemany("INSERT INTO objects VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def labelCounts(self):
+        """ Return [(label, number of objects, number of files)] """
+        with self.connect() as db:
+            return db.execute("SELECT label, COUNT(*), COUNT(DISTINCT file) FROM objects "
+                              "GROUP BY label ORDER BY label").fetchall()
+
+    def annotatedFiles(self):
+        """ Return the set of annotation paths with at least one object """
+        with self.connect() as db:
+            return set(path for path, in db.execute("SELECT path FROM files WHERE count > 0"))
+
+    def filesWithLabel(self, label):
+        with self.connect() as db:
+            return set(path for path, in db.execute("SELECT DISTINCT file FROM objects WHERE label = ?", (label,)))
+
+    def fileLabels(self, paths):
+        """ Return {path: set of the labels of its objects} of the annotation `paths` """
+        labels = dict((path, set()) for path in paths)
+        paths = list(labels)
+        with self.connect() as db:
+            # Below the limit of the sqlite parameters
+            for i in range(0, len(paths), 500):
+                chunk = paths[i:i + 500]
+                for path, label in db.execute("SELECT DISTINCT file, label FROM objects WHERE file IN (%s)"
+                                              % ", ".join("?" * len(chunk)), chunk):
+                    labels[path].add(label)
+        return labels
+
+
+class IndexUpdater(QThread):
+    """
+    Run AnnotationIndex.update() in the background. The paths queued while it
+    runs are indexed by the same thread, so the updates never compete for the lock.
+    """
+    # Number of parsed files (-1 on failure), AnnotationIndex.labelCounts() and
+    # AnnotationIndex.fileLabels() of the parsed paths, None after a folder scan
+    updated = pyqtSignal(int, object, object)
+
+    def __init__(self, index, paths=None, parent=None):
+        super(IndexUpdater, self).__init__(parent)
+        self.index = index
+        self.queue = [paths]    # Lists of paths, None for the whole folder
+        self.lock = threading.Lock()
+        self.done = False
+
+    def enqueue(self, paths=None):
+        """ Index `paths` (None for the whole folder) after the current update, False if the thread has finished """
+        with self.lock:
+            if self.done:
+                return False
+            self.queue.append(paths)
+            return True
+
+    def run(self):
+        while True:
+            with self.lock:
+                if not self.queue:
+                    self.done = True
+                    return
+                queue, self.queue = self.queue, []
+            if any(paths is None for paths in queue):
+                paths = None
+            else:
+                paths = sorted(set(path for part in queue for path in part))
+            try:
+                count = self.index.update(paths)
+                # Queried here rather than in the GUI thread
+                self.updated.emit(count, self.index.labelCounts(),
+                                  None if paths is None else self.index.fileLabels(paths))
+            except Exception as e:
+                print("Index update failed:", e)
+                self.updated.emit(-1, None, None)
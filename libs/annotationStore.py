@@ -0,0 +1,199 @@
+import numpy as np
+
+from libs.shape import Shape
+
+"""
+    Shapes of an image grouped by (axis, slice), mirrored in numpy structured arrays.
+
+    The canvas edits the Shape objects of the current slice through per-slice lists,
+    and every change of a shape is written through to its row (see Shape._sync), so
+    the segmentation reads the boxes and clicks with array operations instead of a
+    loop over all the shapes. The columns follow common_io.COLUMNS.
+
+    The inputs of a segmentation are kept up to date along: the row of the active
+    (last visible) rectangle is tracked on every change, and the fg/bg [slice, y, x]
+    arrays of the clicks are cached until a point changes, so starting a
+    segmentation does not depend on the number of shapes.
+"""
+
+RECT_DTYPE = np.dtype([("axis", np.int8), ("slice", np.int32),
+                       ("x1", np.float64), ("y1", np.float64), ("x2", np.float64), ("y2", np.float64),
+                       ("z1", np.int32), ("z2", np.int32), ("label", np.int32),
+                       ("visible", np.bool_), ("alive", np.bool_)])
+POINT_DTYPE = np.dtype([("axis", np.int8), ("slice", np.int32), ("x", np.float64), ("y", np.float64),
+                        ("zyx", np.int32, (3,)), ("fg", np.bool_), ("label", np.int32), ("visible", np.bool_), ("alive", np.bool_)])
+DTYPES = {Shape.RECTANGLE: RECT_DTYPE, Shape.POINT: POINT_DTYPE}
+COMPACT_ROWS = 1024     # Drop the removed rows when there are more than this and than the alive ones
+
+
+class AnnotationStore(object):
+
+    def __init__(self):
+        self.slices = {}                                # (axis, slice) -> [Shape] in drawing order
+        self.arrays = {}                                # type -> structured array, see DTYPES
+        self.counts = {}                                # type -> used rows, the removed ones included
+        self.rowShapes = {}                             # type -> [Shape of each row, None once removed]
+        self.removed = {}                               # type -> number of removed rows
+        self.labels = []                                # label id -> label
+        self.labelIds = {}
+        self.versions = {}                              # type -> counter bumped on every change of the rows
+        self.activeRow = -1                             # Row of the last visible rectangle, -1 if none
+        self._guides = None                             # (points version, {"fg": zyx, "bg": zyx})
+        self.clear()
+
+    def clear(self):
+        for shapes in self.slices.values():
+            for shape in shapes:
+                shape._store = shape._row = None
+        self.slices = {}
+        self.arrays = {t: np.zeros(64, dtype) for t, dtype in DTYPES.items()}
+        self.counts = {t: 0 for t in DTYPES}
+        self.rowShapes = {t: [] for t in DTYPES}
+        self.removed = {t: 0 for t in DTYPES}
+        self.labels = []
+        self.labelIds = {}
+        self.versions = {t: 0 for t in DTYPES}
+        self.activeRow = -1
+        self._guides = None
+
+    def shapes(self, axis, index):
+        """ The list of the shapes of a slice, created empty if the slice has none """
+        key = (axis, index)
+        shapes = self.slices.get(key)
+        if shapes is None:
+            shapes = self.slices[key] = []
+        return shapes
+
+    def items(self):
+        """ [((axis, slice), shapes)] of the slices with shapes """
+        return [(key, shapes) for key, shapes in self.slices.items() if shapes]
+
+    def __iter__(self):
+        for shapes in self.slices.values():
+            for shape in shapes:
+                yield shape
+
+    def __len__(self):
+        return sum(self.counts[t] - self.removed[t] for t in DTYPES)
+
+    def labelId(self, label):
+        label = label or ""
+        i = self.labelIds.get(label)
+        if i is None:
+            i = self.labelIds[label] = len(self.labels)
+            self.labels.append(label)
+        return i
+
+    def add(self, shape, axis, index):
+        """ Append `shape` to the slice (axis, index) """
+        self.shapes(axis, index).append(shape)
+        t = shape.type_
+        row = self.counts[t]
+        if row == len(self.arrays[t]):
+            grown = np.zeros(2 * row, DTYPES[t])
+            grown[:row] = self.arrays[t]
+            self.arrays[t] = grown
+        self.counts[t] = row + 1
+        self.rowShapes[t].append(shape)
+        self.arrays[t][row]["axis"] = axis
+        self.arrays[t][row]["slice"] = index
+        shape._store, shape._row = self, row
+        self.update(shape)
+
+    def remove(self, shape):
+        """ Remove `shape` from its slice, return the (axis, slice) it was in """
+        if shape._store is not self:
+            raise ValueError("The shape is not in this store")
+        key = self.place(shape)
+        self.slices[key].remove(shape)
+        t = shape.type_
+        self.arrays[t][shape._row]["alive"] = False
+        self.rowShapes[t][shape._row] = None
+        self.versions[t] += 1
+        if t == Shape.RECTANGLE:
+            self.trackActive(shape._row, False)
+        shape._store = shape._row = None
+        self.removed[t] += 1
+        if self.removed[t] > max(COMPACT_ROWS, self.counts[t] - self.removed[t]):
+            self.compact(t)
+        return key
+
+    def compact(self, t):
+        rows = self.arrays[t][:self.counts[t]]
+        rows = rows[rows["alive"]]
+        self.arrays[t] = np.zeros(max(64, 2 * len(rows)), DTYPES[t])
+        self.arrays[t][:len(rows)] = rows
+        self.rowShapes[t] = [shape for shape in self.rowShapes[t] if shape is not None]
+        for row, shape in enumerate(self.rowShapes[t]):
+            shape._row = row
+        self.counts[t] = len(rows)
+        self.removed[t] = 0
+        self.versions[t] += 1
+        if t == Shape.RECTANGLE:
+            self.activeRow = self.lastVisible()
+
+    def place(self, shape):
+        """ (axis, slice) of `shape` """
+        record = self.arrays[shape.type_][shape._row]
+        return int(record["axis"]), int(record["slice"])
+
+    def update(self, shape):
+        """ Write the columns of `shape` to its row, called on every change of the shape """
+        record = self.arrays[shape.type_][shape._row]
+        record["label"] = self.labelId(shape.label)
+        record["visible"] = shape.visible
+        record["alive"] = True
+        self.versions[shape.type_] += 1
+        if shape.type_ == Shape.RECTANGLE:
+            self.trackActive(shape._row, shape.visible)
+        if not shape.points:
+            return
+        if shape.type_ == Shape.POINT:
+            x, y = shape.points[0].x(), shape.points[0].y()
+            record["x"], record["y"] = x, y
+            # Truncated like int() of the coordinates
+            record["zyx"] = (record["slice"], int(y), int(x))
+            record["fg"] = shape.fg
+        else:
+            rect = shape.bounds()
+            record["x1"], record["y1"] = rect.left(), rect.top()
+            record["x2"], record["y2"] = rect.right(), rect.bottom()
+            record["z1"], record["z2"] = shape.z1, shape.z2
+
+    def trackActive(self, row, visible):
+        """ Follow the last visible rectangle after the rectangle of `row` changed """
+        if visible and row > self.activeRow:
+            self.activeRow = row
+        elif not visible and row == self.activeRow:
+            self.activeRow = self.lastVisible()
+
+    def lastVisible(self):
+        rows = self.arrays[Shape.RECTANGLE][:self.counts[Shape.RECTANGLE]]
+        index = np.flatnonzero(rows["alive"] & rows["visible"])
+        return int(index[-1]) if len(index) else -1
+
+    def activeRect(self):
+        """ Record of the last visible rectangle, None if there is none """
+        if self.activeRow < 0:
+            return None
+        return self.arrays[Shape.RECTANGLE][self.activeRow]
+
+    def guides(self):
+        """
+        {"fg": centers, "bg": centers} of the visible points, (n, 3) int32 [slice, y, x]
+        arrays shared between the calls until a point changes (read only)
+        """
+        version = self.versions[Shape.POINT]
+        if self._guides is None or self._guides[0] != version:
+            points = self.columns(Shape.POINT, visibleOnly=True)
+            guides = {"fg": points["zyx"][points["fg"]], "bg": points["zyx"][~points["fg"]]}
+            for centers in guides.values():
+                centers.flags.writeable = False
+            self._guides = (version, guides)
+        return self._guides[1]
+
+    def columns(self, t, visibleOnly=False):
+        """ Structured array (a copy) of the shapes of type `t`, in the order they were added """
+        rows = self.arrays[t][:self.counts[t]]
+        mask = rows["alive"] & rows["visible"] if visibleOnly else rows["alive"]
+        return rows[mask]
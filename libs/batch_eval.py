@@ -0,0 +1,153 @@
+import argparse
+import csv
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import nibabel as nib
+
+from libs.image3d import computeMetrics, computeSurfaceDistances, label_path
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = pq = None
+
+"""
+    Dataset-wide evaluation of the predicted masks.
+
+    Each prediction in <pred dir> is paired with the reference in <ref dir> named by
+    the same rule as the GUI ('img' -> 'mask', 'volume' -> 'segmentation'). Results
+    are written to a .csv (or .parquet with pyarrow) row by row while the cases are
+    evaluated.
+
+    Usage:
+        python -m libs.batch_eval <pred dir> <ref dir> -o metrics.csv --workers 8
+"""
+
+FIELDS = ["case", "dice", "vd", "rvd", "hd", "assd"]
+VOLUME_EXTS = ('.nii', '.nii.gz')
+
+
+def loadMask(filePath):
+    """ Read a mask in its on-disk orientation, memory-mapped if the file is not compressed """
+    nib_vol = nib.load(str(filePath), mmap=True)
+    return np.asanyarray(nib_vol.dataobj), nib_vol.header
+
+
+def pairCases(predDir, refDir):
+    pairs, missing = [], []
+    for file in sorted(os.listdir(predDir)):
+        if not file.lower().endswith(VOLUME_EXTS):
+            continue
+        refPath = os.path.join(refDir, label_path(file).name)
+        if os.path.isfile(refPath):
+            pairs.append((os.path.join(predDir, file), refPath))
+        else:
+            missing.append(file)
+    return pairs, missing
+
+
+def evaluateOne(predPath, refPath):
+    pred, header = loadMask(predPath)
+    ref, _ = loadMask(refPath)
+    if pred.shape != ref.shape:
+        raise ValueError("Shape mismatch: {} vs {}".format(pred.shape, ref.shape))
+    spacing = tuple(float(x) for x in header.get_zooms()[:3])
+    unit = np.prod(spacing) / 1000
+    dice, vd, rvd = computeMetrics(ref, pred, (slice(None),) * 3, unit)
+    hd, assd = computeSurfaceDistances(ref, pred, spacing)
+    return {"case": os.path.basename(predPath), "dice": dice, "vd": vd, "rvd": rvd, "hd": hd, "assd": assd}
+
+
+class CsvSink(object):
+
+    def __init__(self, path):
+        self.file = open(path, "w", newline="")
+        self.writer = csv.DictWriter(self.file, FIELDS)
+        self.writer.writeheader()
+
+    def write(self, row):
+        self.writer.writerow(row)
+        self.file.flush()
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetSink(object):
+    """ Write the rows in row groups of `groupSize` """
+
+    def __init__(self, path, groupSize=256):
+        schema = pa.schema([("case", pa.string())] + [(k, pa.float64()) for k in FIELDS[1:]])
+        self.writer = pq.ParquetWriter(path, schema)
+        self.groupSize = groupSize
+        self.rows = []
+
+    def write(self, row):
+        self.rows.append(row)
+        if len(self.rows) >= self.groupSize:
+            self.flush()
+
+    def flush(self):
+        if self.rows:
+            self.writer.write_table(pa.Table.from_pylist(self.rows, schema=self.writer.schema))
+            self.rows = []
+
+    def close(self):
+        self.flush()
+        self.writer.close()
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Evaluate predicted masks against the references.")
+    parser.add_argument("pred_dir", help="Directory of the predicted masks")
+    parser.add_argument("ref_dir", help="Directory of the reference masks")
+    parser.add_argument("-o", "--output", default="metrics.csv", help="Output .csv or .parquet file")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="Number of worker processes")
+    args = parser.parse_args(argv)
+    if args.output.lower().endswith(".parquet") and pa is None:
+        parser.error("pyarrow is required to write .parquet files")
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    pairs, missing = pairCases(args.pred_dir, args.ref_dir)
+    for file in missing:
+        print("No reference for", file)
+    print("Evaluate %d cases" % len(pairs))
+
+    sink = ParquetSink(args.output) if args.output.lower().endswith(".parquet") else CsvSink(args.output)
+    scores = {k: [] for k in FIELDS[1:]}
+    failed = 0
+    start = time.time()
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, args.workers)) as executor:
+            futures = {executor.submit(evaluateOne, predPath, refPath): predPath for predPath, refPath in pairs}
+            for i, future in enumerate(as_completed(futures), 1):
+                try:
+                    row = future.result()
+                except Exception as e:
+                    failed += 1
+                    print("[%d/%d] %s: error: %s" % (i, len(pairs), futures[future], e))
+                    continue
+                sink.write(row)
+                for k in scores:
+                    scores[k].append(row[k])
+                if i % 100 == 0:
+                    print("[%d/%d] %.1fs" % (i, len(pairs), time.time() - start))
+    finally:
+        sink.close()
+
+    print("Done in %.1fs, %d failed" % (time.time() - start, failed))
+    for k, v in scores.items():
+        if v:
+            print("%-5s mean %.4f" % (k, np.nanmean(v)))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
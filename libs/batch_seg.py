@@ -0,0 +1,171 @@
+import argparse
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+try:
+    from PyQt5.QtCore import QPointF
+except ImportError:
+    from PyQt4.QtCore import QPointF
+
+from libs import serving
+from libs.common_io import COMM_EXT, latestAnnotation, openAnnotation
+from libs.image3d import read3d, write_nii, gather_seg_inputs, SEG_ALGS
+from libs.annotationStore import AnnotationStore
+from libs.shape import Shape, Point
+
+"""
+    Headless batch segmentation driven by the saved .cxml interactions.
+
+    Every volume under <image dir> which has an annotation in <annotation dir> is
+    segmented with the same bbox/points as `Segment` in the GUI would use, and the
+    mask is written to <output dir>/<basename>.nii.gz.
+
+    The volumes are read and preprocessed in worker processes, while their
+    TensorFlow Serving requests are relayed to this process, where one batcher
+    coalesces the concurrent requests of all the workers (see serving.relay).
+
+    Usage:
+        python -m libs.batch_seg <image dir> <annotation dir> <output dir> --method DIN --workers 4
+"""
+
+VOLUME_EXTS = ('.nii', '.nii.gz')
+
+
+def baseName(filePath):
+    """ 'case-001.nii.gz' -> 'case-001', the same rule as MainWindow.loadFile() """
+    basename = os.path.basename(os.path.splitext(filePath)[0])
+    if "." in basename:
+        basename = basename.split(".")[0]
+    return basename
+
+
+def scanVolumes(imageDir):
+    volumes = []
+    for root, dirs, files in os.walk(imageDir):
+        for file in files:
+            if file.lower().endswith(VOLUME_EXTS):
+                volumes.append(os.path.join(root, file))
+    volumes.sort()
+    return volumes
+
+
+def loadShapes(cxmlPath):
+    """ Rebuild the AnnotationStore of an annotation file (or its .npz sidecar) like MainWindow.loadLabels() """
+    store = AnnotationStore()
+    for case in openAnnotation(latestAnnotation(cxmlPath)[0]).getShapes():
+        dtype, label, points = case["type"], case["label"], case["shape"]
+        axis = case.get("axis", 0)
+        sidx = case.get("slice", 0)
+        if dtype == Shape.RECTANGLE:
+            shape = Shape(label=label)
+            shape.z1 = case.get("z1", sidx)
+            shape.z2 = case.get("z2", sidx)
+        elif dtype == Shape.POINT:
+            shape = Point(label=label, foreground=case.get("fg", True))
+        else:
+            raise TypeError("Not recognized shape type:", dtype)
+        for x, y in points:
+            shape.addPoint(QPointF(x, y))
+        shape.close()
+        store.add(shape, axis, sidx)
+    return store
+
+
+def segmentOne(imagePath, cxmlPath, outPath, method, stddev, tiled):
+    """ Segment a single volume, return (imagePath, message, seconds) """
+    start = time.time()
+    i3d = read3d(imagePath, with_label=False)
+    bbox, centers, stddevs = gather_seg_inputs(loadShapes(cxmlPath), stddev)
+    if None in bbox:
+        return imagePath, "skipped: no bounding box", time.time() - start
+    if i3d.segment(method, bbox, centers, stddevs, tiled=tiled) != 0:
+        return imagePath, "failed", time.time() - start
+    write_nii(i3d.segCache, i3d.meta.meta, outPath)
+    return imagePath, "ok", time.time() - start
+
+
+def initWorker(slots, requests, responses):
+    slot = slots.get()
+    serving.configure(window=0, client=serving.RelayClient(requests, responses[slot], slot))
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Segment volumes with the interactions saved in .cxml files.")
+    parser.add_argument("image_dir", help="Directory of the volumes (searched recursively)")
+    parser.add_argument("anno_dir", nargs="?", help="Directory of the .cxml files, default next to the volumes")
+    parser.add_argument("out_dir", nargs="?", help="Output directory, default <image_dir>/seg")
+    parser.add_argument("-m", "--method", default="DIN", choices=list(SEG_ALGS), help="Segmentation method")
+    parser.add_argument("-s", "--stddev", type=int, default=7, help="Stddev of the click guides")
+    parser.add_argument("-j", "--workers", type=int, default=os.cpu_count(), help="Number of worker processes")
+    parser.add_argument("--tiled", action="store_true", help="Sliding-window inference without zooming")
+    parser.add_argument("--overwrite", action="store_true", help="Segment again if the output exists")
+    parser.add_argument("--host", default=serving.HOST, help="TensorFlow Serving host")
+    parser.add_argument("--port", type=int, default=serving.PORT, help="TensorFlow Serving port")
+    parser.add_argument("--batch-window", type=float, default=serving.BATCH_RUN_WINDOW,
+                        help="Seconds to coalesce the requests of all the workers into a batch")
+    parser.add_argument("--max-batch", type=int, default=serving.MAX_BATCH, help="Largest batch of a request")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    outDir = args.out_dir or os.path.join(args.image_dir, "seg")
+    os.makedirs(outDir, exist_ok=True)
+
+    jobs = []
+    for imagePath in scanVolumes(args.image_dir):
+        if os.path.abspath(imagePath).startswith(os.path.abspath(outDir) + os.sep):
+            continue
+        basename = baseName(imagePath)
+        if args.anno_dir:
+            cxmlPath = os.path.join(args.anno_dir, basename + COMM_EXT)
+        else:
+            cxmlPath = os.path.join(os.path.dirname(imagePath), basename + COMM_EXT)
+        outPath = os.path.join(outDir, basename + ".nii.gz")
+        if latestAnnotation(cxmlPath) is None:
+            continue
+        if os.path.isfile(outPath) and not args.overwrite:
+            continue
+        jobs.append((imagePath, cxmlPath, outPath))
+    print("Segment %d volumes with %s" % (len(jobs), args.method))
+
+    failed = 0
+    start = time.time()
+    workers = max(1, args.workers)
+    # spawn: do not fork a process with a live gRPC channel and threads
+    context = multiprocessing.get_context("spawn")
+    requests = context.Queue()
+    responses = [context.Queue() for _ in range(workers)]
+    slots = context.Queue()
+    for slot in range(workers):
+        slots.put(slot)
+    batcher = serving.configure(args.host, args.port, args.batch_window, args.max_batch)
+    relay = threading.Thread(target=serving.relay, args=(requests, responses, batcher), name="relay", daemon=True)
+    relay.start()
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=initWorker,
+                                 initargs=(slots, requests, responses)) as executor:
+            futures = {executor.submit(segmentOne, imagePath, cxmlPath, outPath, args.method, args.stddev,
+                                       args.tiled): imagePath for imagePath, cxmlPath, outPath in jobs}
+            for i, future in enumerate(as_completed(futures), 1):
+                try:
+                    imagePath, message, seconds = future.result()
+                except Exception as e:
+                    imagePath, message, seconds = futures[future], "error: %s" % e, 0.
+                if message != "ok":
+                    failed += 1
+                print("[%d/%d] %s: %s (%.1fs)" % (i, len(jobs), imagePath, message, seconds))
+    finally:
+        requests.put(None)
+        relay.join()
+        batcher.close()
+    print("Done in %.1fs, %d failed" % (time.time() - start, failed))
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -12,7 +12,9 @@ except ImportError:
 import time
 from libs.shape import Shape, Point
 from libs.utils import distance
-from libs.image3d import DSKey
+from libs.annotationStore import AnnotationStore
+from libs.shapeIndex import ShapeGrid
+from libs.pyramid import ImagePyramid
 
 CURSOR_DEFAULT = Qt.ArrowCursor
 CURSOR_POINT = Qt.PointingHandCursor
@@ -41,9 +43,10 @@ class Canvas(QWidget):
         super(Canvas, self).__init__(*args, **kwargs)
         # Initialise local state.
         self.mode = self.EDIT
-        self.shapes_3d = {DSKey.ds2key(0, 0): []}
-        self.ptr = DSKey.ds2key(0, 0)
-        self.shapes = self.shapes_3d[self.ptr]
+        self.store = AnnotationStore()
+        self.ptr = (0, 0)           # (axis, slice) shown
+        self.shapes = self.store.shapes(*self.ptr)
+        self.grids = {}             # (axis, slice) -> ShapeGrid of the slice, for hit-testing
         self.current = None         # A Shape instance, if you are drawing a shape
         self.selectedShape = None  # save the selected shape here
         self.selectedShapeCopy = None
@@ -54,7 +57,8 @@ class Canvas(QWidget):
         self.offsets = QPointF(), QPointF()
         self.scale = 1.0
         self.pixmap = QPixmap()
-        self.visible = {}
+        self.pyramid = None         # Downscaled levels of the image, to draw it zoomed out
+        self.tiles = None           # TiledImage of an image too large for a pixmap
         self.hShape = None          # Shape highlight   --> rectangle face
         self.hVertex = None         # Vertex highlight  --> rectangle vertex
         self.hPoint = None          # Point highlight   --> point
@@ -66,14 +70,13 @@ class Canvas(QWidget):
         # Set widget options.
         self.setMouseTracking(True)
         self.setFocusPolicy(Qt.WheelFocus)
+        self.setAutoFillBackground(True)
         self.verified = False
         self.drawSquare = False
 
     def setPtr(self, axis, index):
-        self.ptr = DSKey.ds2key(axis, index)
-        if self.ptr not in self.shapes_3d:
-            self.shapes_3d[self.ptr] = []
-        self.shapes = self.shapes_3d[self.ptr]
+        self.ptr = (axis, index)
+        self.shapes = self.store.shapes(axis, index)
 
     def setDrawingColor(self, qColor):
         self.drawingLineColor = qColor
@@ -89,7 +92,24 @@ class Canvas(QWidget):
         self.restoreCursor()
 
     def isVisible(self, shape):
-        return self.visible.get(shape, True)
+        return shape.visible
+
+    def shapeGrid(self):
+        """ Grid of the current slice, rebuilt if the shapes were changed from outside """
+        grid = self.grids.get(self.ptr)
+        if grid is None or grid.shapes is not self.shapes or len(grid) != len(self.shapes):
+            grid = self.grids[self.ptr] = ShapeGrid(self.shapes, pad=self.epsilon)
+        return grid
+
+    def updateGrid(self, shape, removed=False):
+        """ Keep the grid of the current slice in sync after `shape` is added, moved or removed """
+        grid = self.grids.get(self.ptr)
+        if grid is None or grid.shapes is not self.shapes:
+            return
+        if removed:
+            grid.remove(shape)
+        else:
+            grid.add(shape)
 
     def drawing(self):
         return self.mode == self.CREATE
@@ -132,6 +152,7 @@ class Canvas(QWidget):
 
         # Polygon drawing.
         if self.drawing():
+            damaged = self.drawingRegion()
             self.overrideCursor(CURSOR_DRAW)
             if self.current and self.current.type_ == Shape.RECTANGLE:
                 color = self.drawingLineColor
@@ -163,20 +184,22 @@ class Canvas(QWidget):
                 self.current.highlightClear()
             else:
                 self.prevPoint = pos
-            self.repaint()
+            self.update(damaged + self.drawingRegion())
             return
 
         # Polygon/Vertex moving.
         if Qt.LeftButton & ev.buttons():
             if self.selectedVertex():
+                damaged = self.shapeRegion(self.hShape)
                 self.boundedMoveVertex(pos)
                 self.shapeMoved.emit()
-                self.repaint()
+                self.update(damaged + self.shapeRegion(self.hShape))
             elif self.selectedShape and self.prevPoint:
+                damaged = self.shapeRegion(self.selectedShape)
                 self.overrideCursor(CURSOR_MOVE)
                 self.boundedMoveShape(self.selectedShape, pos)
                 self.shapeMoved.emit()
-                self.repaint()
+                self.update(damaged + self.shapeRegion(self.selectedShape))
             return
 
         # Just hovering over the canvas, 2 posibilities:
@@ -184,7 +207,10 @@ class Canvas(QWidget):
         # - Highlight vertex
         # Update shape/vertex fill and tooltip value accordingly.
         self.setToolTip("Image")
-        for shape in reversed([s for s in self.shapes if self.isVisible(s)]):
+        previous = self.hShape
+        for shape in self.shapeGrid().candidates(pos):
+            if not self.isVisible(shape):
+                continue
             # Look for a nearby vertex to highlight. If that fails,
             # check if we happen to be inside a shape.
             index = shape.nearestVertex(pos, self.epsilon)
@@ -197,7 +223,7 @@ class Canvas(QWidget):
                     self.overrideCursor(CURSOR_POINT)
                     self.setToolTip("Click & drag to move point")
                     self.setStatusTip(self.toolTip())
-                    self.update()
+                    self.update(self.shapeRegion(previous, shape))
                     break
                 elif shape.type_ == Shape.POINT:
                     if self.selectedVertex():
@@ -208,7 +234,7 @@ class Canvas(QWidget):
                     self.setToolTip("Click & drag to move '%s'" % shape.label)
                     self.setStatusTip(self.toolTip())
                     self.overrideCursor(CURSOR_POINT)
-                    self.update()
+                    self.update(self.shapeRegion(previous, shape))
                     break
             # elif shape.containsPoint(pos):
             #     if self.selectedVertex():
@@ -223,7 +249,7 @@ class Canvas(QWidget):
         else:  # Nothing found, clear highlights, reset state.
             if self.hShape and (self.hShape.type_ != Shape.POINT or not self.hShape.selected):
                 self.hShape.highlightClear()
-                self.update()
+                self.update(self.shapeRegion(self.hShape))
             self.hVertex, self.hShape, self.hPoint = None, None, None
 
     def mousePressEvent(self, ev):
@@ -283,12 +309,14 @@ class Canvas(QWidget):
         assert self.selectedShape and self.selectedShapeCopy
         shape = self.selectedShapeCopy
         if copy:
-            self.shapes.append(shape)
+            self.store.add(shape, *self.ptr)
+            self.updateGrid(shape)
             self.selectedShape.selected = False
             self.selectedShape = shape
             self.repaint()
         else:
             self.selectedShape.points = [p for p in shape.points]
+            self.updateGrid(self.selectedShape)
         self.selectedShapeCopy = None
 
     def handleDrawingRec(self, pos):
@@ -317,7 +345,7 @@ class Canvas(QWidget):
         elif not self.outOfPixmap(pos):
             self.current = Point(foreground=fg)
             self.current.addPoint(pos)
-            self.line_r.points.clear()
+            self.line_r.points = []
             self.drawingPolygon.emit(True)
             self.update()
 
@@ -346,7 +374,7 @@ class Canvas(QWidget):
             shape.highlightVertex(index, shape.MOVE_VERTEX)
             self.selectShape(shape)
             return
-        for shape in reversed(self.shapes):
+        for shape in self.shapeGrid().candidates(point):
             if self.isVisible(shape):
                 if shape.type_ == Shape.RECTANGLE and shape.containsPoint(point):
                     self.selectShape(shape)
@@ -369,11 +397,11 @@ class Canvas(QWidget):
         Moves a point x,y to within the boundaries of the canvas.
         :return: (x,y,snapped) where snapped is True if x or y were changed, False if not.
         """
-        if x < 0 or x > self.pixmap.width() or y < 0 or y > self.pixmap.height():
+        if x < 0 or x > self.imageSize().width() or y < 0 or y > self.imageSize().height():
             x = max(x, 0)
             y = max(y, 0)
-            x = min(x, self.pixmap.width())
-            y = min(y, self.pixmap.height())
+            x = min(x, self.imageSize().width())
+            y = min(y, self.imageSize().height())
             return x, y, True
 
         return x, y, False
@@ -410,6 +438,7 @@ class Canvas(QWidget):
             rshift = QPointF(0, shiftPos.y())
         shape.moveVertexBy(rindex, rshift)
         shape.moveVertexBy(lindex, lshift)
+        self.updateGrid(shape)
 
     def boundedMoveShape(self, shape, pos):
         if self.outOfPixmap(pos):
@@ -420,8 +449,8 @@ class Canvas(QWidget):
                 pos -= QPointF(min(0, o1.x()), min(0, o1.y()))
             o2 = pos + self.offsets[1]
             if self.outOfPixmap(o2):
-                pos += QPointF(min(0, self.pixmap.width() - o2.x()),
-                               min(0, self.pixmap.height() - o2.y()))
+                pos += QPointF(min(0, self.imageSize().width() - o2.x()),
+                               min(0, self.imageSize().height() - o2.y()))
         # For Point, self.offsets is 0 and don't need to check
 
         # The next line tracks the new position of the cursor
@@ -432,6 +461,7 @@ class Canvas(QWidget):
         dp = pos - self.prevPoint
         if dp:
             shape.moveBy(dp)
+            self.updateGrid(shape)
             self.prevPoint = pos
             return True
         return False
@@ -448,13 +478,11 @@ class Canvas(QWidget):
     def deleteSelected(self):
         if self.selectedShape:
             shape = self.selectedShape
-            if shape in self.shapes:
-                self.shapes.remove(self.selectedShape)
+            key = self.store.remove(shape)
+            if key == self.ptr:
+                self.updateGrid(shape, removed=True)
             else:
-                for _, shapes in self.shapes_3d.items():
-                    if shape in shapes:
-                        shapes.remove(shape)
-                        break
+                self.grids.pop(key, None)
             self.selectedShape = None
             self.update()
             return shape
@@ -463,7 +491,8 @@ class Canvas(QWidget):
         if self.selectedShape:
             shape = self.selectedShape.copy()
             self.deSelectShape()
-            self.shapes.append(shape)
+            self.store.add(shape, *self.ptr)
+            self.updateGrid(shape)
             shape.selected = True
             self.selectedShape = shape
             self.boundedShiftShape(shape)
@@ -480,7 +509,7 @@ class Canvas(QWidget):
             self.boundedMoveShape(shape, point + offset)
 
     def paintEvent(self, event):
-        if not self.pixmap:
+        if self.imageSize().isEmpty():
             return super(Canvas, self).paintEvent(event)
 
         p = self._painter
@@ -489,16 +518,36 @@ class Canvas(QWidget):
         p.setRenderHint(QPainter.HighQualityAntialiasing)
         p.setRenderHint(QPainter.SmoothPixmapTransform)
 
+        self.drawBackground(p, event.rect())
+
         p.scale(self.scale, self.scale)
         #  Painter origin: (0, 0) if image is larger than canvas; (x, y) otherwise
         p.translate(self.offsetToCenter())
 
-        p.drawPixmap(0, 0, self.pixmap)
         Shape.scale = self.scale
+        # Skip the shapes out of the exposed area, the margin covers the largest highlighted vertex
+        exposed = QRectF(self.transformPos(QPointF(event.rect().topLeft())),
+                         self.transformPos(QPointF(event.rect().bottomRight() + QPoint(1, 1))))
+        margin = (2 * Shape.point_size + 2) / self.scale
+        left, top = exposed.left() - margin, exposed.top() - margin
+        right, bottom = exposed.right() + margin, exposed.bottom() + margin
+        points = []
         for shape in self.shapes:
-            if self.isVisible(shape):
-                shape.fill = shape.selected or shape == self.hShape
-                shape.paint(p)
+            if not shape.points or not self.isVisible(shape):
+                continue
+            if shape.paintLabel:
+                if not exposed.intersects(shape.paintBounds(margin)):
+                    continue
+            else:
+                rect = shape.bounds()
+                if rect.left() > right or rect.right() < left or rect.top() > bottom or rect.bottom() < top:
+                    continue
+            if shape.type_ == Shape.POINT and not shape.selected and not shape.highlighted():
+                points.append(shape)
+                continue
+            shape.fill = shape.selected or shape == self.hShape
+            shape.paint(p)
+        Point.paintBatch(p, points)
         if self.current:
             self.current.paint(p)
             if self._drawType == Shape.RECTANGLE:
@@ -520,20 +569,75 @@ class Canvas(QWidget):
         # Cross line
         if self.drawing() and not self.prevPoint.isNull() and not self.outOfPixmap(self.prevPoint):
             p.setPen(QColor(0, 0, 0))
-            p.drawLine(int(self.prevPoint.x()), 0, int(self.prevPoint.x()), int(self.pixmap.height()))
-            p.drawLine(0, int(self.prevPoint.y()), int(self.pixmap.width()), int(self.prevPoint.y()))
+            p.drawLine(int(self.prevPoint.x()), 0, int(self.prevPoint.x()), int(self.imageSize().height()))
+            p.drawLine(0, int(self.prevPoint.y()), int(self.imageSize().width()), int(self.prevPoint.y()))
 
-        self.setAutoFillBackground(True)
-        if self.verified:
-            pal = self.palette()
+        p.end()
+
+    def drawBackground(self, p, rect):
+        """ Draw the part of the image inside `rect` (widget coordinates) from the nearest pyramid level """
+        s = self.scale
+        offset = self.offsetToCenter() * s
+        target = QRectF(rect).intersected(
+            QRectF(offset.x(), offset.y(), self.imageSize().width() * s, self.imageSize().height() * s))
+        if target.isEmpty():
+            return
+        source = QRectF((target.x() - offset.x()) / s, (target.y() - offset.y()) / s,
+                        target.width() / s, target.height() / s)
+        if self.tiles is not None:
+            for tileRect, image, tileSource in self.tiles.tiles(self.tiles.levelFor(s), source):
+                # Rounded to whole pixels, so that no seam shows between the tiles
+                x1, y1 = round(offset.x() + tileRect.left() * s), round(offset.y() + tileRect.top() * s)
+                x2, y2 = round(offset.x() + tileRect.right() * s), round(offset.y() + tileRect.bottom() * s)
+                p.drawImage(QRectF(x1, y1, x2 - x1, y2 - y1), image, tileSource)
+            return
+        level = self.pyramid.level(s) if self.pyramid is not None else None
+        if level is None:
+            p.drawPixmap(target, self.pixmap, source)
+        else:
+            image, fx, fy = level
+            p.drawImage(target, image, QRectF(source.x() * fx, source.y() * fy,
+                                              source.width() * fx, source.height() * fy))
+
+    @property
+    def verified(self):
+        return self._verified
+
+    @verified.setter
+    def verified(self, value):
+        # The background shows the verified state
+        self._verified = value
+        pal = self.palette()
+        if value:
             pal.setColor(self.backgroundRole(), QColor(184, 239, 38, 128))
-            self.setPalette(pal)
         else:
-            pal = self.palette()
             pal.setColor(self.backgroundRole(), QColor(232, 232, 232, 255))
-            self.setPalette(pal)
+        self.setPalette(pal)
 
-        p.end()
+    def widgetRect(self, rect):
+        """ Widget rect covering `rect` given in image coordinates """
+        rect = rect.translated(self.offsetToCenter())
+        s = self.scale
+        return QRectF(rect.x() * s, rect.y() * s, rect.width() * s, rect.height() * s) \
+            .toAlignedRect().adjusted(-2, -2, 2, 2)
+
+    def shapeRegion(self, *shapes):
+        """ Widget region painted by `shapes`, to repaint only that after they change """
+        region = QRegion()
+        margin = (2 * Shape.point_size + 2) / self.scale
+        for shape in shapes:
+            if shape is not None and shape.points:
+                region += self.widgetRect(shape.paintBounds(margin))
+        return region
+
+    def drawingRegion(self):
+        """ Widget region of the shape being drawn and of the cross lines """
+        region = self.shapeRegion(self.current, self.line_r)
+        if not self.imageSize().isEmpty() and not self.prevPoint.isNull():
+            w, h = self.imageSize().width(), self.imageSize().height()
+            region += self.widgetRect(QRectF(self.prevPoint.x() - 1, 0, 2, h))
+            region += self.widgetRect(QRectF(0, self.prevPoint.y() - 1, w, 2))
+        return region
 
     def transformPos(self, point):
         """Convert from widget-logical coordinates to painter-logical coordinates."""
@@ -542,14 +646,14 @@ class Canvas(QWidget):
     def offsetToCenter(self):
         s = self.scale
         area = super(Canvas, self).size()
-        w, h = self.pixmap.width() * s, self.pixmap.height() * s
+        w, h = self.imageSize().width() * s, self.imageSize().height() * s
         aw, ah = area.width(), area.height()
         x = (aw - w) / (2 * s) if aw > w else 0
         y = (ah - h) / (2 * s) if ah > h else 0
         return QPointF(x, y)
 
     def outOfPixmap(self, p):
-        w, h = self.pixmap.width(), self.pixmap.height()
+        w, h = self.imageSize().width(), self.imageSize().height()
         return not (0 <= p.x() <= w and 0 <= p.y() <= h)
 
     def finalise(self):
@@ -563,7 +667,8 @@ class Canvas(QWidget):
             return
 
         self.current.close()
-        self.shapes.append(self.current)
+        self.store.add(self.current, *self.ptr)
+        self.updateGrid(self.current)
         if self.current.type_ == Shape.POINT:
             self.newPoint.emit()
         else:
@@ -581,7 +686,7 @@ class Canvas(QWidget):
         # Cycle through each image edge in clockwise fashion,
         # and find the one intersecting the current line segment.
         # http://paulbourke.net/geometry/lineline2d/
-        size = self.pixmap.size()
+        size = self.imageSize()
         points = [(0, 0),
                   (size.width(), 0),
                   (size.width(), size.height()),
@@ -635,8 +740,8 @@ class Canvas(QWidget):
         return self.minimumSizeHint()
 
     def minimumSizeHint(self):
-        if self.pixmap:
-            return self.scale * self.pixmap.size()
+        if not self.imageSize().isEmpty():
+            return self.scale * self.imageSize()
         return super(Canvas, self).minimumSizeHint()
 
     def wheelEvent(self, ev):
@@ -683,37 +788,17 @@ class Canvas(QWidget):
             self.moveOnePixel('Down')
 
     def moveOnePixel(self, direction):
-        # print(self.selectedShape.points)
-        if direction == 'Left' and not self.moveOutOfBound(QPointF(-1.0, 0)):
-            # print("move Left one pixel")
-            self.selectedShape.points[0] += QPointF(-1.0, 0)
-            self.selectedShape.points[1] += QPointF(-1.0, 0)
-            self.selectedShape.points[2] += QPointF(-1.0, 0)
-            self.selectedShape.points[3] += QPointF(-1.0, 0)
-        elif direction == 'Right' and not self.moveOutOfBound(QPointF(1.0, 0)):
-            # print("move Right one pixel")
-            self.selectedShape.points[0] += QPointF(1.0, 0)
-            self.selectedShape.points[1] += QPointF(1.0, 0)
-            self.selectedShape.points[2] += QPointF(1.0, 0)
-            self.selectedShape.points[3] += QPointF(1.0, 0)
-        elif direction == 'Up' and not self.moveOutOfBound(QPointF(0, -1.0)):
-            # print("move Up one pixel")
-            self.selectedShape.points[0] += QPointF(0, -1.0)
-            self.selectedShape.points[1] += QPointF(0, -1.0)
-            self.selectedShape.points[2] += QPointF(0, -1.0)
-            self.selectedShape.points[3] += QPointF(0, -1.0)
-        elif direction == 'Down' and not self.moveOutOfBound(QPointF(0, 1.0)):
-            # print("move Down one pixel")
-            self.selectedShape.points[0] += QPointF(0, 1.0)
-            self.selectedShape.points[1] += QPointF(0, 1.0)
-            self.selectedShape.points[2] += QPointF(0, 1.0)
-            self.selectedShape.points[3] += QPointF(0, 1.0)
+        step = {'Left': QPointF(-1.0, 0), 'Right': QPointF(1.0, 0),
+                'Up': QPointF(0, -1.0), 'Down': QPointF(0, 1.0)}[direction]
+        damaged = self.shapeRegion(self.selectedShape)
+        if not self.moveOutOfBound(step):
+            self.selectedShape.moveBy(step)
+            self.updateGrid(self.selectedShape)
         self.shapeMoved.emit()
-        self.repaint()
+        self.update(damaged + self.shapeRegion(self.selectedShape))
 
     def moveOutOfBound(self, step):
-        points = [p1+p2 for p1, p2 in zip(self.selectedShape.points, [step]*4)]
-        return True in map(self.outOfPixmap, points)
+        return any(self.outOfPixmap(p + step) for p in self.selectedShape.points)
 
     def setLastLabel(self, text, line_color  = None, fill_color = None):
         assert text
@@ -735,7 +820,9 @@ class Canvas(QWidget):
 
     def resetAllLines(self):
         assert self.shapes
-        self.current = self.shapes.pop()
+        self.current = self.shapes[-1]
+        self.store.remove(self.current)
+        self.updateGrid(self.current, removed=True)
         self.current.setOpen()
         self.line_r.points = [self.current[-1], self.current[0]]
         self.drawingPolygon.emit(True)
@@ -743,21 +830,54 @@ class Canvas(QWidget):
         self.drawingPolygon.emit(False)
         self.update()
 
-    def loadPixmap(self, pixmap):
-        """ Make sure call setPtr() before this method"""
+    def loadPixmap(self, pixmap, image=None):
+        """
+        Make sure call setPtr() before this method. `image` is the QImage of the pixmap,
+        the zoomed out levels are built from it.
+        """
         self.pixmap = pixmap
-        self.shapes = self.shapes_3d[self.ptr]
+        self.cancelImage()
+        if image is not None:
+            self.pyramid = ImagePyramid(image)
+            self.pyramid.levelReady.connect(self.update)
+        self.shapes = self.store.shapes(*self.ptr)
         self.repaint()
 
-    def loadShapes(self, shapes_3d):
-        self.shapes_3d = shapes_3d
+    def loadTiledImage(self, tiles):
+        """ Show a TiledImage, its tiles are decoded when they are painted """
+        self.pixmap = QPixmap()
+        self.cancelImage()
+        self.tiles = tiles
+        self.tiles.tileReady.connect(self.update)
+        self.shapes = self.store.shapes(*self.ptr)
+        self.repaint()
+
+    def cancelImage(self):
+        """ Stop building the pyramid or decoding the tiles of the previous image """
+        if self.pyramid is not None:
+            self.pyramid.cancel()
+        self.pyramid = None
+        if self.tiles is not None:
+            self.tiles.cancel()
+            self.tiles.tileReady.disconnect(self.update)
+        self.tiles = None
+
+    def imageSize(self):
+        """ Size of the image in image pixels, empty if there is none """
+        if self.tiles is not None:
+            return self.tiles.size()
+        return self.pixmap.size() if self.pixmap else QSize()
+
+    def loadShapes(self, store):
+        self.store = store
+        self.grids = {}
         self.setPtr(0, 0)
         self.current = None
         self.repaint()
 
     def setShapeVisible(self, shape, value):
-        self.visible[shape] = value
-        self.repaint()
+        shape.visible = value
+        self.update(self.shapeRegion(shape))
 
     def currentCursor(self):
         cursor = QApplication.overrideCursor()
@@ -778,6 +898,7 @@ class Canvas(QWidget):
     def resetState(self):
         self.restoreCursor()
         self.pixmap = None
+        self.cancelImage()
         self.update()
 
     def setDrawingShapeToSquare(self, status):
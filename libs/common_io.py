@@ -1,26 +1,64 @@
 #!/usr/bin/env python
 # -*- coding: utf8 -*-
+import json
+import os
 import sys
-from xml.etree import ElementTree
-from xml.etree.ElementTree import Element, SubElement
+import tempfile
+import time
+from array import array
+from collections import OrderedDict
+import numpy as np
 from lxml import etree
-import codecs
+from lxml.etree import Element, SubElement
 from libs.constants import DEFAULT_ENCODING
 from libs.ustr import ustr
 from libs.shape import Shape
 
 
 COMM_EXT = '.cxml'  # common xml
+NPZ_EXT = '.npz'    # compact sidecar of a .cxml: <name>.cxml.npz
 ENCODE_METHOD = DEFAULT_ENCODING
+COLUMNS = ("type", "label", "x1", "y1", "x2", "y2", "z1", "z2", "axis", "slice", "fg")
+# Read once at import: os.umask() is read by setting it, which would change the mode
+# of the files created meanwhile by other threads
+UMASK = os.umask(0)
+os.umask(UMASK)
 
 """
     CommonWriter/CommonReader removes 'difficult' property and adds 
     more types of interactions:
         - rectangle
         - point
+
+    The same annotation can be saved as a compact .npz sidecar (CommonWriter.saveNpz,
+    CommonNpzReader) which stores the objects as typed columns (COLUMNS).
 """
 
 
+def atomicWrite(targetFile, write):
+    """
+        Call write(file) on a temporary file and rename it to `targetFile`, so the
+        annotation is never left half-written.
+    """
+    fd, tmpFile = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=os.path.dirname(os.path.abspath(targetFile)))
+    try:
+        # mkstemp creates the file with 0600, keep the mode of the replaced file or of a normally created one
+        try:
+            mode = os.stat(targetFile).st_mode & 0o777
+        except OSError:
+            mode = 0o666 & ~UMASK
+        if hasattr(os, 'fchmod'):
+            os.fchmod(fd, mode)
+        else:
+            os.chmod(tmpFile, mode)
+        with os.fdopen(fd, 'wb') as out_file:
+            write(out_file)
+        os.replace(tmpFile, targetFile)
+    except BaseException:
+        os.remove(tmpFile)
+        raise
+
+
 class CommonWriter:
 
     def __init__(self, foldername, filename, imgSize,databaseSrc='Unknown', localImgPath=None):
@@ -38,12 +76,9 @@ class CommonWriter:
         """
             Return a pretty-printed XML string for the Element.
         """
-        rough_string = ElementTree.tostring(elem, 'utf8')
-        root = etree.fromstring(rough_string)
-        return etree.tostring(root, pretty_print=True, encoding=ENCODE_METHOD).replace("  ".encode(), "\t".encode())
-        # minidom does not support UTF-8
-        '''reparsed = minidom.parseString(rough_string)
-        return reparsed.toprettyxml(indent="\t", encoding=ENCODE_METHOD)'''
+        # Indent in place with tabs and serialize once
+        etree.indent(elem, space="\t")
+        return etree.tostring(elem, encoding=ENCODE_METHOD) + b"\n"
 
     def genXML(self):
         """
@@ -162,110 +197,282 @@ class CommonWriter:
     def save(self, targetFile=None):
         root = self.genXML()
         self.appendObjects(root)
-        out_file = None
         if targetFile is None:
-            out_file = codecs.open(
-                self.filename + COMM_EXT, 'w', encoding=ENCODE_METHOD)
-        else:
-            out_file = codecs.open(targetFile, 'w', encoding=ENCODE_METHOD)
+            targetFile = self.filename + COMM_EXT
 
         prettifyResult = self.prettify(root)
-        out_file.write(prettifyResult.decode('utf8'))
-        out_file.close()
+        atomicWrite(targetFile, lambda out_file: out_file.write(prettifyResult))
+
+    def header(self):
+        return {
+            "folder": self.foldername,
+            "filename": self.filename,
+            "path": self.localImgPath,
+            "database": self.databaseSrc,
+            "size": [int(x) for x in self.imgSize],
+            "verified": self.verified,
+        }
+
+    def saveNpz(self, targetFile=None):
+        """ Save the objects as typed columns in a compressed .npz """
+        if targetFile is None:
+            targetFile = self.filename + COMM_EXT + NPZ_EXT
+        labelIds = {}
+        rows = []
+        for box in self.boxlist:
+            label = labelIds.setdefault(box['name'], len(labelIds))
+            rows.append((Shape.RECTANGLE, label, box['xmin'], box['ymin'], box['xmax'], box['ymax'],
+                         box.get('z1', -1), box.get('z2', -1), box.get('axis', -1), box.get('slice', -1), 1))
+        for pnt in self.pntlist:
+            label = labelIds.setdefault(pnt['name'], len(labelIds))
+            rows.append((Shape.POINT, label, pnt['x'], pnt['y'], pnt['x'], pnt['y'],
+                         -1, -1, pnt.get('axis', -1), pnt.get('slice', -1), int(pnt.get('fg', True))))
+        table = np.array(rows, dtype=np.intc).reshape(-1, len(COLUMNS))
+        arrays = {k: table[:, i] for i, k in enumerate(COLUMNS)}
+        arrays["labels"] = np.array(sorted(labelIds, key=labelIds.get), dtype=np.str_)
+        arrays["header"] = np.array(json.dumps(self.header()))
+        atomicWrite(targetFile, lambda out_file: np.savez_compressed(out_file, **arrays))
+
+
+class CommonReaderError(Exception):
+    pass
 
 
 class CommonReader:
+    """
+        Stream the objects of a .cxml file with iterparse into compact columns
+        (see COLUMNS), the shape dicts are only built by getShapes(). Raise
+        CommonReaderError with the line number if the file is malformed.
+    """
+    COLUMNS = COLUMNS
 
     def __init__(self, filepath):
-        # shapes type:
-        # [labbel, [(x1,y1), (x2,y2), (x3,y3), (x4,y4)], color, color, difficult]
-        self.shapes = []
         self.filepath = filepath
         self.verified = False
-        try:
-            self.parseCXML()
-        except:
-            pass
+        self.header = {}        # folder, filename, path, database, size
+        self.labels = []        # label id -> label text
+        self.columns = OrderedDict()
+        self.shapes = None
+        self.parse()
+
+    def parse(self):
+        return self.parseCXML()
+
+    def __len__(self):
+        return len(self.columns["type"])
 
     def getShapes(self):
+        # shapes type:
+        # {"type", "label", "shape": [(x1, y1), ...], "color1", "color2", ("z1", "z2" | "fg"), ["axis", "slice"]}
+        if self.shapes is None:
+            self.shapes = [self.shape(i) for i in range(len(self))]
         return self.shapes
 
-    def addBndBox(self, label, bndbox, dtype):
-        xmin = int(float(bndbox.find('xmin').text))
-        ymin = int(float(bndbox.find('ymin').text))
-        zmin = int(float(bndbox.find('zmin').text))
-        xmax = int(float(bndbox.find('xmax').text))
-        ymax = int(float(bndbox.find('ymax').text))
-        zmax = int(float(bndbox.find('zmax').text))
-        points = [(xmin, ymin), (xmax, ymin), (xmax, ymax), (xmin, ymax)]
-
+    def shape(self, i):
+        c = self.columns
+        dtype = int(c["type"][i])
+        x1, y1, x2, y2 = int(c["x1"][i]), int(c["y1"][i]), int(c["x2"][i]), int(c["y2"][i])
         shape = {
             "type": dtype,
-            "label": label,
-            "shape": points,
+            "label": self.labels[c["label"][i]],
             "color1": None,
             "color2": None,
-            "z1": zmin,
-            "z2": zmax
         }
+        if dtype == Shape.RECTANGLE:
+            shape["shape"] = [(x1, y1), (x2, y1), (x2, y2), (x1, y2)]
+            shape["z1"] = int(c["z1"][i])
+            shape["z2"] = int(c["z2"][i])
+        else:
+            shape["shape"] = [(x1, y1)]
+            shape["fg"] = bool(c["fg"][i])
+        if c["axis"][i] >= 0:
+            shape["axis"] = int(c["axis"][i])
+        if c["slice"][i] >= 0:
+            shape["slice"] = int(c["slice"][i])
+        return shape
 
-        axis = bndbox.find("axis")
-        if axis is not None:
-            shape["axis"] = int(axis.text)
-
-        slice_ = bndbox.find("slice")
-        if slice_ is not None:
-            shape["slice"] = int(slice_.text)
+    def parseCXML(self):
+        if not self.filepath.endswith(COMM_EXT):
+            raise CommonReaderError("Unsupport file format: %s" % self.filepath)
+        columns = OrderedDict((k, array("i")) for k in self.COLUMNS)
+        labelIds = {}
 
-        self.shapes.append(shape)
+        try:
+            context = etree.iterparse(self.filepath, events=("start", "end"), encoding=ENCODE_METHOD,
+                                      tag=("annotation", "object") + self.HEADER_TAGS)
+            size = [None] * 3
+            for event, elem in context:
+                if elem.tag == "annotation":
+                    if event == "start":
+                        self.verified = elem.get("verified") == "yes"
+                    continue
+                if event == "start":
+                    continue
+                if elem.tag in ("width", "height", "depth"):
+                    size[("height", "width", "depth").index(elem.tag)] = elem.text
+                    continue
+                if elem.tag != "object":
+                    self.header[elem.tag] = elem.text
+                    continue
+                try:
+                    row = self.parseObject(elem, labelIds)
+                except (AttributeError, KeyError, TypeError, ValueError) as e:
+                    raise CommonReaderError("%s:%d: invalid object (%r)" % (self.filepath, elem.sourceline, e))
+                if row is not None:
+                    for k, v in zip(self.COLUMNS, row):
+                        columns[k].append(v)
+                # Drop the parsed objects to keep the memory constant
+                elem.clear()
+                while elem.getprevious() is not None:
+                    del elem.getparent()[0]
+        except etree.XMLSyntaxError as e:
+            raise CommonReaderError("%s:%d: %s" % (self.filepath, e.lineno, e.msg))
+        except OSError as e:
+            raise CommonReaderError("%s: %s" % (self.filepath, e))
+        try:
+            self.header["size"] = [int(float(x)) for x in size]
+        except (TypeError, ValueError):
+            pass
 
-    def addPnt(self, label, pnt):
-        x = int(float(pnt.find('x').text))
-        y = int(float(pnt.find('y').text))
-        points = [(x, y)]
+        self.labels = [None] * len(labelIds)
+        for label, i in labelIds.items():
+            self.labels[i] = label
+        for k, v in columns.items():
+            self.columns[k] = np.frombuffer(v, dtype=np.intc) if len(v) else np.zeros(0, np.intc)
+        self.shapes = None
+        return True
 
-        shape = {
-            "type": Shape.POINT,
-            "label": label,
-            "shape": points,
-            "color1": None,
-            "color2": None,
-            "fg": pnt.find('fg').text == "True"
-        }
+    HEADER_TAGS = ("folder", "filename", "path", "database", "width", "height", "depth")
+
+    @staticmethod
+    def parseObject(elem, labelIds):
+        """ Return the columns of an <object>, or None if it is neither a bndbox nor a pnt """
+        label = None
+        dtype = None
+        values = None
+        for child in elem:
+            if child.tag == "name":
+                label = child.text
+            elif child.tag in ("bndbox", "pnt"):
+                dtype = Shape.RECTANGLE if child.tag == "bndbox" else Shape.POINT
+                values = {c.tag: c.text for c in child}
+                break
+        if dtype is None:
+            return None
+        if label not in labelIds:
+            labelIds[label] = len(labelIds)
+        axis = int(values["axis"]) if "axis" in values else -1
+        slice_ = int(values["slice"]) if "slice" in values else -1
+        if dtype == Shape.RECTANGLE:
+            return (dtype, labelIds[label],
+                    int(float(values["xmin"])), int(float(values["ymin"])),
+                    int(float(values["xmax"])), int(float(values["ymax"])),
+                    int(float(values["zmin"])), int(float(values["zmax"])),
+                    axis, slice_, 1)
+        x, y = int(float(values["x"])), int(float(values["y"]))
+        return (dtype, labelIds[label], x, y, x, y, -1, -1, axis, slice_, int(values["fg"] == "True"))
+
+
+class CommonNpzReader(CommonReader):
+    """ Read the .npz sidecar saved by CommonWriter.saveNpz, same interface as CommonReader """
+
+    def parse(self):
+        try:
+            with np.load(self.filepath, allow_pickle=False) as data:
+                header = json.loads(str(data["header"]))
+                self.labels = [str(x) for x in data["labels"]]
+                for k in self.COLUMNS:
+                    self.columns[k] = data[k].astype(np.intc, copy=False)
+        except (OSError, KeyError, ValueError) as e:
+            raise CommonReaderError("%s: %s" % (self.filepath, e))
+        self.verified = header.pop("verified", False)
+        self.header = header
+        self.shapes = None
+        return True
 
-        axis = pnt.find("axis")
-        if axis is not None:
-            shape["axis"] = int(axis.text)
 
-        slice_ = pnt.find("slice")
-        if slice_ is not None:
-            shape["slice"] = int(slice_.text)
+def sidecarPath(cxmlPath):
+    return cxmlPath + NPZ_EXT
 
-        self.shapes.append(shape)
 
-    def parseCXML(self):
-        assert self.filepath.endswith(COMM_EXT), "Unsupport file format"
-        parser = etree.XMLParser(encoding=ENCODE_METHOD)
-        xmltree = ElementTree.parse(self.filepath, parser=parser).getroot()
-        filename = xmltree.find('filename').text
+def latestAnnotation(cxmlPath):
+    """
+        Return (path, mtime) of the newer one of `cxmlPath` and its .npz sidecar,
+        or None if neither exists
+    """
+    found = None
+    for path in (cxmlPath, sidecarPath(cxmlPath)):
         try:
-            verified = xmltree.attrib['verified']
-            if verified == 'yes':
-                self.verified = True
-        except KeyError:
-            self.verified = False
-
-        for object_iter in xmltree.findall('object'):
-            label = object_iter.find('name').text
-
-            bndbox = object_iter.find("bndbox")
-            if bndbox is not None:
-                self.addBndBox(label, bndbox, Shape.RECTANGLE)
-                continue
-            
-            pnt = object_iter.find("pnt")
-            if pnt is not None:
-                self.addPnt(label, pnt)
-                continue
-
-        return True
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            continue
+        if found is None or mtime > found[1]:
+            found = (path, mtime)
+    return found
+
+
+def openAnnotation(path):
+    if path.endswith(NPZ_EXT):
+        return CommonNpzReader(path)
+    return CommonReader(path)
+
+
+def writerFromReader(reader):
+    """ Return a CommonWriter holding the annotation of a CommonReader/CommonNpzReader """
+    header = reader.header
+    writer = CommonWriter(header.get("folder"), header.get("filename"), header.get("size"),
+                          databaseSrc=header.get("database") or 'Unknown', localImgPath=header.get("path"))
+    writer.verified = reader.verified
+    for shape in reader.getShapes():
+        ext_items = {k: shape[k] for k in ("axis", "slice", "z1", "z2", "fg") if k in shape}
+        if shape["type"] == Shape.RECTANGLE:
+            (xmin, ymin), _, (xmax, ymax), _ = shape["shape"]
+            writer.addBndBox(xmin, ymin, xmax, ymax, shape["label"], **ext_items)
+        else:
+            x, y = shape["shape"][0]
+            writer.addPnt(x, y, shape["label"], **ext_items)
+    return writer
+
+
+def cxml2npz(cxmlPath, npzPath=None):
+    writerFromReader(CommonReader(cxmlPath)).saveNpz(npzPath or sidecarPath(cxmlPath))
+
+
+def npz2cxml(npzPath, cxmlPath=None):
+    if cxmlPath is None:
+        cxmlPath = npzPath[:-len(NPZ_EXT)] if npzPath.endswith(COMM_EXT + NPZ_EXT) else npzPath + COMM_EXT
+    writerFromReader(CommonNpzReader(npzPath)).save(cxmlPath)
+
+
+def benchmark(numPoints=100000, repeat=3, workdir=None):
+    """ Compare the save/load time and file size of .cxml and the .npz sidecar """
+    workdir = workdir or tempfile.mkdtemp()
+    cxmlPath = os.path.join(workdir, "bench" + COMM_EXT)
+    npzPath = sidecarPath(cxmlPath)
+    writer = CommonWriter("bench", "bench.nii.gz", (512, 512, 200), localImgPath="bench.nii.gz")
+    writer.addBndBox(10, 20, 300, 400, "liver", z1=5, z2=150, axis=0, slice=5)
+    for i in range(numPoints):
+        writer.addPnt(i % 512, (i * 7) % 512, "liver", fg=bool(i % 2), axis=0, slice=i % 200)
+
+    def timeit(func, *args):
+        best = float("inf")
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func(*args)
+            best = min(best, time.perf_counter() - start)
+        return best
+
+    print("%d objects, best of %d" % (numPoints + 1, repeat))
+    print("%-6s %10s %10s %10s" % ("", "save (s)", "load (s)", "size (KB)"))
+    for name, save, reader, path in (("cxml", writer.save, CommonReader, cxmlPath),
+                                     ("npz", writer.saveNpz, CommonNpzReader, npzPath)):
+        saveTime = timeit(save, path)
+        loadTime = timeit(lambda: reader(path).getShapes())
+        print("%-6s %10.3f %10.3f %10.1f" % (name, saveTime, loadTime, os.path.getsize(path) / 1024))
+    for path in (cxmlPath, npzPath):
+        os.remove(path)
+
+
+if __name__ == "__main__":
+    # python -m libs.common_io [number of points]
+    benchmark(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
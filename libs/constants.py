@@ -22,4 +22,7 @@ SETTING_AUTO_SEG = 'autoSeg'
 SETTING_ALPHA = 'segAlpha'
 SETTING_INT_MIN = 'segIntMin'
 SETTING_INT_MAX = 'segIntMax'
-SETTING_STDDEV = 'segStddev'
\ No newline at end of file
+SETTING_STDDEV = 'segStddev'
+SETTING_SEG_TILED = 'segTiled'
+SETTING_SAVE_NPZ = 'saveNpz'
+SETTING_LABEL_COLORS = 'labelColors'
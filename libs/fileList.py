@@ -0,0 +1,168 @@
+import heapq
+import os
+
+try:
+    from PyQt5.QtGui import *
+    from PyQt5.QtCore import *
+except ImportError:
+    from PyQt4.QtGui import *
+    from PyQt4.QtCore import *
+
+from libs.utils import natural_sort_key
+
+"""
+    File list of the opened directory.
+
+    DirScanner walks the directory with os.scandir in a background thread and emits
+    the images in batches, FileListModel keeps them in natural order (2d images
+    first, then 3d images) so that the list can be used while the scan is running.
+    FileFilterProxyModel shows a subset of them, e.g. the images with a label.
+"""
+
+
+class DirScanner(QThread):
+    # [(path, is3d)]
+    found = pyqtSignal(list)
+
+    def __init__(self, folderPath, extensions, extensions_3d, batchSize=1000, parent=None):
+        super(DirScanner, self).__init__(parent)
+        self.folderPath = folderPath
+        self.extensions = tuple(ext.lower() for ext in extensions)
+        self.extensions_3d = tuple(ext.lower() for ext in extensions_3d)
+        self.batchSize = batchSize
+
+    def run(self):
+        stack = [os.path.abspath(self.folderPath)]
+        batch = []
+        while stack and not self.isInterruptionRequested():
+            try:
+                with os.scandir(stack.pop()) as it:
+                    entries = list(it)
+            except OSError:
+                continue
+            dirs = []
+            for entry in entries:
+                try:
+                    if entry.is_dir():
+                        # Same as os.walk(followlinks=False)
+                        if not entry.is_symlink():
+                            dirs.append(entry.path)
+                        continue
+                except OSError:
+                    continue
+                name = entry.name.lower()
+                if name.endswith(self.extensions):
+                    batch.append((entry.path, False))
+                elif name.endswith(self.extensions_3d):
+                    batch.append((entry.path, True))
+            # Visit the sub-directories in natural order, so most batches are appended at the end
+            dirs.sort(key=lambda x: natural_sort_key(x.lower()), reverse=True)
+            stack.extend(dirs)
+            if len(batch) >= self.batchSize:
+                self.found.emit(batch)
+                batch = []
+        if batch and not self.isInterruptionRequested():
+            self.found.emit(batch)
+
+
+class FileListModel(QAbstractListModel):
+
+    def __init__(self, parent=None):
+        super(FileListModel, self).__init__(parent)
+        self.paths = []
+        self.keys = []      # Sort keys of the paths, computed once
+        self.rows = {}      # path -> row
+        self.currentRow = -1
+        self.currentFont = QFont()
+        self.currentFont.setBold(True)
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.paths)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if index.isValid() and role in (Qt.DisplayRole, Qt.ToolTipRole):
+            return self.paths[index.row()]
+        if role == Qt.FontRole and index.isValid() and index.row() == self.currentRow:
+            return self.currentFont
+        return None
+
+    def indexOf(self, path):
+        """ Row of `path`, -1 if it is not in the list """
+        return self.rows.get(path, -1)
+
+    def setCurrentRow(self, row):
+        """ Highlight the row of the opened image """
+        old, self.currentRow = self.currentRow, row
+        for r in (old, row):
+            if 0 <= r < len(self.paths):
+                self.dataChanged.emit(self.index(r), self.index(r), [Qt.FontRole])
+
+    def clear(self):
+        self.beginResetModel()
+        self.paths = []
+        self.keys = []
+        self.rows = {}
+        self.currentRow = -1
+        self.endResetModel()
+
+    def addPaths(self, items):
+        """ Insert [(path, is3d)] at their sorted positions """
+        new = sorted(((is3d, natural_sort_key(path.lower())), path) for path, is3d in items)
+        if not new:
+            return
+        if not self.keys or new[0][0] >= self.keys[-1]:
+            first = len(self.paths)
+            self.beginInsertRows(QModelIndex(), first, first + len(new) - 1)
+            self.keys.extend(key for key, _ in new)
+            self.paths.extend(path for _, path in new)
+            self.rows.update((path, first + i) for i, (_, path) in enumerate(new))
+            self.endInsertRows()
+            return
+
+        self.layoutAboutToBeChanged.emit()
+        persistent = self.persistentIndexList()
+        persistentPaths = [self.paths[index.row()] for index in persistent]
+        currentPath = self.paths[self.currentRow] if self.currentRow >= 0 else None
+        merged = list(heapq.merge(zip(self.keys, self.paths), new))
+        self.keys = [key for key, _ in merged]
+        self.paths = [path for _, path in merged]
+        self.rows = {path: i for i, path in enumerate(self.paths)}
+        self.currentRow = self.indexOf(currentPath)
+        self.changePersistentIndexList(persistent, [self.index(self.rows[path]) for path in persistentPaths])
+        self.layoutChanged.emit()
+
+
+class FileFilterProxyModel(QSortFilterProxyModel):
+
+    def __init__(self, parent=None):
+        super(FileFilterProxyModel, self).__init__(parent)
+        self.paths = None       # Set of the shown (or hidden if `exclude`) paths, None for all
+        self.exclude = False
+
+    def setFilter(self, paths, exclude=False):
+        self.paths = paths
+        self.exclude = exclude
+        self.invalidateFilter()
+
+    def isActive(self):
+        return self.paths is not None
+
+    def setContains(self, path, contained):
+        """ Add `path` to the paths of the filter or remove it, only its row is filtered again """
+        if self.paths is None or (path in self.paths) == contained:
+            return
+        if contained:
+            self.paths.add(path)
+        else:
+            self.paths.discard(path)
+        model = self.sourceModel()
+        row = model.indexOf(path)
+        if row >= 0:
+            # Re-filtered by the dynamic filter of the proxy
+            model.dataChanged.emit(model.index(row), model.index(row))
+
+    def acceptsPath(self, path):
+        return self.paths is None or (path in self.paths) != self.exclude
+
+    def filterAcceptsRow(self, sourceRow, sourceParent):
+        return self.acceptsPath(self.sourceModel().paths[sourceRow])
@@ -1,21 +1,19 @@
 import os
 import cv2
-import grpc
 import numpy as np
 import nibabel as nib
 import qimage2ndarray as q2a
 import skimage.measure as measure
 from skimage import feature
 from skimage._shared import utils as skutils
-import tensorflow as tf
-from tensorflow_serving.apis import predict_pb2, prediction_service_pb2_grpc
 import matplotlib.pyplot as plt
 from scipy import ndimage as ndi
 from pathlib import Path
-from collections import OrderedDict
+from collections import OrderedDict, deque
 import subprocess
 
-from libs import image_np_ops
+from libs import image_np_ops, serving
+from libs.tracing import span, traced
 try:
     from libs.graph_cut import graph_cut3d
 except ImportError as e:
@@ -24,6 +22,14 @@ except ImportError as e:
 patch_cache = {}
 max_height_, max_width_ = 960, 320
 # max_height_, max_width_ = 256, 256
+# Tiled inference: tile size (multiples of 16), overlap ratio and tiles per request
+tile_height_, tile_width_ = 320, 320
+tile_overlap_ = 0.25
+tile_batch_ = 4
+
+# Segmentation methods shown in the GUI -> model/method name
+SEG_ALGS = OrderedDict([("DIN", "din"), ("EDT", "euc"), ("GDT", "geo"),
+                        ("Graph Cut 3D", "GraphCut3D"), ("Random Walk 3D", "RandomWalk3D")])
 
 
 class Image3d(object):
@@ -50,6 +56,7 @@ class Image3d(object):
         self.axis = 0  # 0, 1, 2
 
         self.segCache = {}
+        self.segBox = None      # Region of `segCache` which may be non-zero, None for the whole volume
         # if filePath:
         #     filePath = Path(filePath)
         #     # segPath = filePath.parent.parent / "Lasso_nii" / filePath.name.replace("volume", "segmentation")
@@ -108,6 +115,7 @@ class Image3d(object):
         if high is not None and isinstance(high, (int, float)) and self.high != high:
             self.high = high
 
+    @traced("Image3d.at")
     def at(self, i, axis=0, showSeg=True, showLab=False):
         # We don't check index out of bounds
         if axis == 0:
@@ -155,13 +163,16 @@ class Image3d(object):
     def undo(self):
         if self.backup is not None:
             self.segCache = self.backup
+            self.segBox = None
             self.backup = None
             return True
         return False
 
-    def preprocess(self, bbox, centers, stddevs, guide_type="exp"):
+    @traced("preprocess")
+    def preprocess(self, bbox, centers, stddevs, guide_type="exp", tiled=False):
+        """ With `tiled`, large boxes are kept at native resolution instead of being downsampled """
         z1, y1, x1, z2, y2, x2 = bbox
-        key = str(bbox) + str(self.filePath)
+        key = str(bbox) + str(self.filePath) + str(tiled)
         # Image
         if key in patch_cache:
             image, zoom_scale, self.slices = patch_cache[key]
@@ -169,11 +180,13 @@ class Image3d(object):
             patch = self.volume[z1:z2, y1:y2, x1:x2]
             if patch.min() < 0:
                 patch[patch < 0] = 0
-            patch = image_np_ops.z_score(patch)
+            with span("z_score"):
+                patch = image_np_ops.z_score(patch)
             p1, p2, p3 = 0, 0, 0
-            if y2 - y1 > max_height_ or x2 - x1 > max_width_:
+            if not tiled and (y2 - y1 > max_height_ or x2 - x1 > max_width_):
                 zoom_scale = np.array([1, max_height_ / patch.shape[1], max_width_ / patch.shape[2]])
-                patch = ndi.zoom(patch, zoom_scale, order=1)
+                with span("ndi.zoom", order=1):
+                    patch = ndi.zoom(patch, zoom_scale, order=1)
             else:
                 zoom_scale = None
                 if patch.shape[1] % 16 != 0:
@@ -189,86 +202,127 @@ class Image3d(object):
             
             patch_cache.clear()
             patch_cache[key] = [image.copy(), zoom_scale, self.slices]
+        self.zoom_scale = zoom_scale
 
-        if y2 - y1 > max_height_ or x2 - x1 > max_width_:
-            fg_pts = (np.array(centers['fg'], np.int32).reshape(-1, 3) - [z1, y1, x1]) * zoom_scale
-            bg_pts = (np.array(centers['bg'], np.int32).reshape(-1, 3) - [z1, y1, x1]) * zoom_scale
-            fg_std = np.array(stddevs['fg']).reshape(-1, 3) * zoom_scale
-            bg_std = np.array(stddevs['bg']).reshape(-1, 3) * zoom_scale
+        if zoom_scale is not None:
+            fg_pts = (np.asarray(centers['fg'], np.int32).reshape(-1, 3) - [z1, y1, x1]) * zoom_scale
+            bg_pts = (np.asarray(centers['bg'], np.int32).reshape(-1, 3) - [z1, y1, x1]) * zoom_scale
+            fg_std = np.asarray(stddevs['fg'], np.float64).reshape(-1, 3) * zoom_scale
+            bg_std = np.asarray(stddevs['bg'], np.float64).reshape(-1, 3) * zoom_scale
         else:
-            fg_pts = np.array(centers['fg'], np.int32).reshape(-1, 3) - [z1, y1, x1]
-            bg_pts = np.array(centers['bg'], np.int32).reshape(-1, 3) - [z1, y1, x1]
-            fg_std = np.array(stddevs['fg']).reshape(-1, 3)
-            bg_std = np.array(stddevs['bg']).reshape(-1, 3)
-
-        if guide_type == "exp":
-            fg_gd = image_np_ops.gen_guide_nd_v2(image.shape, fg_pts, fg_std)
-            bg_gd = image_np_ops.gen_guide_nd_v2(image.shape, bg_pts, bg_std) * 1.5
-        elif guide_type == "euc":
-            fg_gd = image_np_ops.gen_guide_nd_v2(image.shape, fg_pts, fg_std, euclidean=True)
-            bg_gd = image_np_ops.gen_guide_nd_v2(image.shape, bg_pts, bg_std, euclidean=True) * 1.5
-        elif guide_type == "geo":
-            fg_gd = image_np_ops.gen_guide_geo_nd(image, fg_pts, lamb=1.0, iter_=2)
-            bg_gd = image_np_ops.gen_guide_geo_nd(image, bg_pts, lamb=1.0, iter_=2)
-        guide = np.stack((fg_gd, bg_gd), axis=-1).astype(np.float32)
+            fg_pts = np.asarray(centers['fg'], np.int32).reshape(-1, 3) - [z1, y1, x1]
+            bg_pts = np.asarray(centers['bg'], np.int32).reshape(-1, 3) - [z1, y1, x1]
+            fg_std = np.asarray(stddevs['fg'], np.float64).reshape(-1, 3)
+            bg_std = np.asarray(stddevs['bg'], np.float64).reshape(-1, 3)
+
+        with span("guide", guide_type=guide_type):
+            if guide_type == "exp":
+                fg_gd = image_np_ops.gen_guide_nd_v2(image.shape, fg_pts, fg_std)
+                bg_gd = image_np_ops.gen_guide_nd_v2(image.shape, bg_pts, bg_std) * 1.5
+            elif guide_type == "euc":
+                fg_gd = image_np_ops.gen_guide_nd_v2(image.shape, fg_pts, fg_std, euclidean=True)
+                bg_gd = image_np_ops.gen_guide_nd_v2(image.shape, bg_pts, bg_std, euclidean=True) * 1.5
+            elif guide_type == "geo":
+                fg_gd = image_np_ops.gen_guide_geo_nd(image, fg_pts, lamb=1.0, iter_=2)
+                bg_gd = image_np_ops.gen_guide_geo_nd(image, bg_pts, lamb=1.0, iter_=2)
+            guide = np.stack((fg_gd, bg_gd), axis=-1).astype(np.float32)
 
         return image[None, ..., None], guide[None]
 
+    @traced("run_tf_serving")
     def run_tf_serving(self, image, guide, name):
-        host = "localhost"
-        port = 8500
-        options = [('grpc.max_send_message_length', 50 * 1536 * 512 * 4),
-                   ('grpc.max_receive_message_length', 50 * 1536 * 512 * 4)]
-        channel = grpc.insecure_channel('{host}:{port}'.format(host=host, port=port), options=options)
-        stub = prediction_service_pb2_grpc.PredictionServiceStub(channel)
-
-        request = predict_pb2.PredictRequest()
-        request.model_spec.name = name
-        request.model_spec.signature_name = "serving_default"
-        request.inputs['image'].CopyFrom(tf.make_tensor_proto(image))
-        request.inputs['guide'].CopyFrom(tf.make_tensor_proto(guide))
-
+        """ Return the logits of the whole batch, None if the request failed """
         try:
-            result = stub.Predict(request)
+            return serving.predict(image, guide, name)
         except Exception as e:
             print(e)
-            result = None
-
-        # Reference:
-        # How to access nested values
-        # https://stackoverflow.com/questions/44785847/how-to-retrieve-float-val-from-a-predictresponse-object
-        # logits = np.array(result.outputs["output_bytes2"].float_val).reshape(height, width, 2)
-        if result is not None:
-            output = np.array(result.outputs["output_0"].float_val).reshape(*guide.shape)
-            output = output[0]
-            return output
-        else:
             return None
 
-    def postprocess(self, mask, pts):
-        struct = ndi.generate_binary_structure(3, 1)
-        labeled, n_objs = ndi.label(mask)
-        slices = ndi.find_objects(labeled)
-        for i, sli in enumerate(slices, start=1):
-            patch = labeled[sli] == i
-            d, h, w = patch.shape
-            if np.count_nonzero(patch) < 10:
-                labeled[sli] -= patch * i
-            # if np.count_nonzero(patch) < 40:
-            #     has_pt = False
-            #     for z, y, x in pts:
-            #         if 0 <= z - sli[0].start < d and 0 <= y - sli[1].start < h and 0 <= x - sli[2].start < w:
-            #             if patch[z - sli[0].start, y - sli[1].start, x - sli[2].start]:
-            #                 has_pt = True
-            #                 break
-            #     if not has_pt:
-            #         labeled[sli] -= patch * i
-
-        labeled = np.clip(labeled, 0, 1)
-        # Fill hole
-        struct = ndi.generate_binary_structure(2, 1)
-        labeled[pts[0, 0]] = ndi.morphology.binary_fill_holes(labeled[pts[0, 0]], struct)
-        return labeled
+    @traced("run_tf_serving_tiled")
+    def run_tf_serving_tiled(self, image, guide, name):
+        """
+        Sliding-window inference over the height and width of a single patch.
+        Overlapping tiles are sent `tile_batch_` at a time and their logits are
+        blended with Gaussian weights, so the memory of each request is bounded.
+        Up to `maxInflight` of the batcher are sent concurrently, where they may
+        also be coalesced.
+        """
+        _, d, h, w, _ = image.shape
+        th, tw = min(tile_height_, h), min(tile_width_, w)
+        weight = gaussian_window(th, tw)
+        windows = [(y, x) for y in tile_starts(h, th, tile_overlap_) for x in tile_starts(w, tw, tile_overlap_)]
+        logits = np.zeros((d, h, w, guide.shape[-1]), np.float32)
+        norm = np.zeros((h, w), np.float32)
+        batcher = serving.getBatcher()
+        pending = deque()
+
+        def collect():
+            """ Blend the logits of the oldest batch sent, False if its request failed """
+            batch, future = pending.popleft()
+            try:
+                output = future.result()
+            except Exception as e:
+                print(e)
+                return False
+            for (y, x), out in zip(batch, output):
+                logits[:, y:y + th, x:x + tw] += out * weight[..., None]
+                norm[y:y + th, x:x + tw] += weight
+            return True
+
+        ok = True
+        for i in range(0, len(windows), tile_batch_):
+            batch = windows[i:i + tile_batch_]
+            pending.append((batch, batcher.submit(np.concatenate([image[:, :, y:y + th, x:x + tw] for y, x in batch]),
+                                                  np.concatenate([guide[:, :, y:y + th, x:x + tw] for y, x in batch]),
+                                                  name)))
+            if len(pending) >= batcher.maxInflight:
+                ok = collect()
+                if not ok:
+                    break
+        while ok and pending:
+            ok = collect()
+        if not ok:
+            return None
+        logits /= norm[..., None]
+        return logits[None]
+
+    @traced("postprocess")
+    def postprocess(self, mask, bbox=None, min_size=10):
+        """
+        Remove the connected components smaller than `min_size` voxels and fill the
+        holes of every slice. Only the region `bbox` (a tuple of slices) is processed,
+        which must contain all the foreground of `mask`. `mask` is updated in place.
+        """
+        if bbox is None:
+            bbox = (slice(None),) * mask.ndim
+        labeled, n_objs = ndi.label(mask[bbox])
+        # Component sizes in one pass, then remap all the labels with a lookup table
+        keep = np.bincount(labeled.ravel(), minlength=n_objs + 1) >= min_size
+        keep[0] = False
+        region = keep[labeled]
+        # Fill holes of all the slices at once. The structure element only connects
+        # voxels inside a slice, so each slice is filled independently.
+        struct = np.zeros((3, 3, 3), bool)
+        struct[1] = ndi.generate_binary_structure(2, 1)
+        mask[bbox] = ndi.binary_fill_holes(region, struct)
+        return mask
+
+    def segment(self, segAlg, bbox, centers, stddevs, tiled=False):
+        """ Run the method `segAlg` (a key of SEG_ALGS), return 0 on success """
+        name = SEG_ALGS.get(segAlg)
+        if segAlg == "Test":
+            return self.seg_test(bbox, centers, stddevs)
+        elif segAlg == "DIN":
+            return self.seg_din(bbox, centers, stddevs, name, guide_type="exp", tiled=tiled)
+        elif segAlg == "EDT":
+            return self.seg_din(bbox, centers, stddevs, name, guide_type="euc", tiled=tiled)
+        elif segAlg == "GDT":
+            return self.seg_din(bbox, centers, stddevs, name, guide_type="geo", tiled=tiled)
+        elif segAlg == "Random Walk 3D":
+            return self.seg_RW(bbox, centers)
+        elif segAlg == "Graph Cut 3D":
+            return self.seg_GraphCut(bbox, centers)
+        return 1
 
     def seg_test(self, bbox, centers, stddevs):
         z1, y1, x1, z2, y2, x2 = bbox
@@ -279,32 +333,45 @@ class Image3d(object):
         for c in centers['bg']:
             seg[c[0], c[1] - 7: c[1] + 7, c[2] - 7: c[2] + 7] = 0
         self.segCache = seg
+        self.segBox = None
         return 0
 
-    def seg_din(self, bbox, centers, stddevs, name, guide_type="exp"):
+    def seg_din(self, bbox, centers, stddevs, name, guide_type="exp", tiled=False):
         z1, y1, x1, z2, y2, x2 = bbox
         if z1 is None:
             s = self.volume.shape
             bbox = [0, 0, 0, s[0], s[1], s[2]]
             z1, y1, x1, z2, y2, x2 = bbox
-        image, guide = self.preprocess(bbox, centers, stddevs, guide_type)
-        print(image.shape, guide.shape)
-        logits = self.run_tf_serving(image, guide, name=name)
+        image, guide = self.preprocess(bbox, centers, stddevs, guide_type, tiled)
+        if tiled:
+            logits = self.run_tf_serving_tiled(image, guide, name=name)
+        else:
+            logits = self.run_tf_serving(image, guide, name=name)
         if logits is None:
             return 1
-        predict = np.argmax(logits, axis=-1)
-        predict = predict[self.slices]
-        if y2 - y1 > max_height_ or x2 - x1 > max_width_:
-            zoom_scale = np.array([1, (y2 - y1) / max_height_, (x2 - x1) / max_width_])
-            predict = ndi.zoom(predict, zoom_scale, order=0)
-        seg = np.zeros_like(self.volume, np.uint8)
-        seg[z1:z2, y1:y2, x1:x2] = predict
-        self.segCache = self.postprocess(seg, np.array(centers["fg"]).reshape(-1, 3))
+        with span("argmax"):
+            # Two classes: comparing the channels is the same as argmax (ties -> 0)
+            logits = logits[0][self.slices]
+            predict = np.greater(logits[..., 1], logits[..., 0]).view(np.uint8)
+        if self.zoom_scale is not None:
+            with span("resize_nearest"):
+                predict = resize_nearest(predict, (z2 - z1, y2 - y1, x2 - x1))
+        self.updateSegCache((slice(z1, z2), slice(y1, y2), slice(x1, x2)), self.postprocess(predict))
         return 0
 
+    def updateSegCache(self, bbox, patch):
+        """ Set the segmentation to `patch` inside `bbox` (a tuple of slices) and zeros elsewhere """
+        if not isinstance(self.segCache, np.ndarray) or self.segCache.dtype != np.uint8:
+            self.segCache = np.zeros(self.shape, np.uint8)
+        elif self.segBox != bbox:
+            # Only the region written last time needs to be cleared
+            self.segCache[self.segBox if self.segBox is not None else ...] = 0
+        self.segCache[bbox] = patch
+        self.segBox = bbox
+
     def seg_RW(self, bbox, centers):
-        fg_pts = np.array(centers["fg"], np.int32).reshape(-1, 3)
-        bg_pts = np.array(centers["bg"], np.int32).reshape(-1, 3)
+        fg_pts = np.asarray(centers["fg"], np.int32).reshape(-1, 3)
+        bg_pts = np.asarray(centers["bg"], np.int32).reshape(-1, 3)
         if fg_pts.shape[0] == 0 or bg_pts.shape[0] == 0:
             return 1
         z1, y1, x1, z2, y2, x2 = bbox
@@ -342,8 +409,7 @@ class Image3d(object):
             shape = np.fromfile(binread, dtype=np.int16, count=3, sep='')
             ctdata = np.fromfile(binread, dtype=np.int16, count=-1, sep='')
             ctdata = ctdata.reshape(shape)
-        self.segCache = np.zeros_like(self.volume, np.uint8)
-        self.segCache[z1:z2, y1:y2, x1:x2] = ctdata
+        self.updateSegCache((slice(z1, z2), slice(y1, y2), slice(x1, x2)), ctdata)
         os.remove(outfile)
         return 0
 
@@ -352,20 +418,61 @@ class Image3d(object):
         if len(centers['fg']) <= 1 or len(centers['bg']) <= 1:
             return 1
         seed = np.zeros_like(self.volume, np.uint8)
-        seg = np.zeros_like(self.volume, np.uint8)
         for key, values in centers.items():
             _type = 1 if key == 'fg' else 2
-            for point in values:
-                seed[point[0]][point[1]][point[2]] = _type
-            # print(1)
+            points = np.asarray(values, np.int32).reshape(-1, 3)
+            seed[points[:, 0], points[:, 1], points[:, 2]] = _type
         box_volume = self.volume[z1:z2 + 1, y1:y2 + 1, x1:x2 + 1]
         box_seed = seed[z1:z2 + 1, y1:y2 + 1, x1:x2 + 1]
         box_seg = 1 - graph_cut3d(box_volume, box_seed)
-        seg[z1:z2 + 1, y1:y2 + 1, x1:x2 + 1] = box_seg
-        self.segCache = seg
+        self.updateSegCache((slice(z1, z2 + 1), slice(y1, y2 + 1), slice(x1, x2 + 1)), box_seg)
         return 0
 
 
+def gather_seg_inputs(store, stddev):
+    """
+    Collect the segmentation inputs from the visible annotations of an AnnotationStore:
+    the bbox of the last rectangle and the [z, y, x] centers/stddevs of the foreground/
+    background points, kept up to date by the store so no shape is visited here.
+    """
+    bbox = [None] * 6
+    r = store.activeRect()
+    if r is not None:
+        bbox = [int(r["z1"]), int(r["y1"]), int(r["x1"]), int(r["z2"]) + 1, int(r["y2"]), int(r["x2"])]
+    centers = store.guides()
+    stddevs = {k: np.tile(np.array([first, stddev, stddev]), (len(centers[k]), 1))
+               for k, first in (("fg", 2.), ("bg", 1.))}
+    return bbox, centers, stddevs
+
+
+def tile_starts(size, tile, overlap):
+    """ Start positions of the tiles covering [0, size), the last tile is aligned to the end """
+    stride = max(int(tile * (1 - overlap)), 1)
+    starts = list(range(0, size - tile + 1, stride))
+    if starts[-1] != size - tile:
+        starts.append(size - tile)
+    return starts
+
+
+def gaussian_window(height, width, sigma_scale=1. / 8):
+    """ Gaussian importance map with peak 1 for blending overlapping tiles """
+    y = np.arange(height) - (height - 1) / 2
+    x = np.arange(width) - (width - 1) / 2
+    wy = np.exp(-y ** 2 / (2 * (height * sigma_scale) ** 2))
+    wx = np.exp(-x ** 2 / (2 * (width * sigma_scale) ** 2))
+    # Keep the borders above zero, they are the only cover of the image edges
+    return np.maximum(np.outer(wy, wx), 1e-3).astype(np.float32)
+
+
+def resize_nearest(arr, shape):
+    """ Nearest neighbor resampling by index arithmetic, pixel centers are aligned """
+    for axis, (n_in, n_out) in enumerate(zip(arr.shape, shape)):
+        if n_in != n_out:
+            # One axis at a time is much cheaper than indexing with np.ix_
+            arr = arr.take((2 * np.arange(n_out) + 1) * n_in // (2 * n_out), axis=axis)
+    return arr
+
+
 class Header(object):
     def __init__(self, meta, format):
         self.meta = meta
@@ -378,18 +485,6 @@ class Header(object):
             return [int(x) for x in self.meta.get_data_shape()[::-1]]
 
 
-class DSKey(object):
-    """ (Direction, Slice) <-> Key """
-
-    @staticmethod
-    def ds2key(di, sl):
-        return di * 10000 + sl
-
-    @staticmethod
-    def key2ds(key):
-        return key // 10000, key % 10000
-
-
 class Item3d(object):
     def __init__(self, label, axis, slice_):
         self.label = label
@@ -402,24 +497,55 @@ def computeMetrics(ref, pred, bbox, unit):
         print(ref.shape, pred.shape)
         return -1
 
-    ref_choose = np.clip(ref, 0, 1)[bbox]
-    pred_choose = pred[bbox]
-
-    v1 = np.count_nonzero(ref_choose * pred_choose)
-    v2 = np.count_nonzero(ref_choose) + np.count_nonzero(pred_choose)
-    dice = round(2 * v1 / (v2 + 1e-8), 4)
-
-    vd = np.sum(ref_choose - pred_choose) * unit
-    rvd = (np.sum(np.abs(ref_choose - pred_choose)) / 2) / (np.sum(ref_choose) / 2 + np.sum(pred_choose) / 2)
+    # Only two bool masks of the bbox are allocated, all the metrics come from the counts
+    ref_choose = ref[bbox] > 0
+    pred_choose = pred[bbox] > 0
+    n_ref = np.count_nonzero(ref_choose)
+    n_pred = np.count_nonzero(pred_choose)
+    tp = np.count_nonzero(np.logical_and(ref_choose, pred_choose, out=ref_choose))
+    fp = n_pred - tp
+    fn = n_ref - tp
+
+    dice = round(2 * tp / (n_ref + n_pred + 1e-8), 4)
+    vd = (fn - fp) * unit
+    rvd = (fp + fn) / (n_ref + n_pred) if n_ref + n_pred else 0.
     return dice, vd, rvd
 
 
-def read3d(filePath, out_dtype=np.int16, only_header=False):
+def computeSurfaceDistances(ref, pred, spacing=(1., 1., 1.)):
+    """
+    Hausdorff distance and average symmetric surface distance (ASSD) between two masks
+    of the same shape, in the unit of `spacing`. The distance transforms are computed
+    only in the (1-voxel padded) bbox of both objects. Return (nan, nan) if a mask is empty.
+    """
+    ref = ref > 0
+    pred = pred > 0
+    both = ref | pred
+    if not ref.any() or not pred.any():
+        return np.nan, np.nan
+    bbox = tuple(slice(max(s.start - 1, 0), s.stop + 1) for s in ndi.find_objects(both.view(np.uint8))[0])
+    ref, pred = ref[bbox], pred[bbox]
+
+    ref_border = ref ^ ndi.binary_erosion(ref)
+    pred_border = pred ^ ndi.binary_erosion(pred)
+    ref2pred = ndi.distance_transform_edt(~pred_border, sampling=spacing)[ref_border]
+    pred2ref = ndi.distance_transform_edt(~ref_border, sampling=spacing)[pred_border]
+    hd = max(ref2pred.max(), pred2ref.max())
+    assd = (ref2pred.sum() + pred2ref.sum()) / (ref2pred.size + pred2ref.size)
+    return hd, assd
+
+
+def label_path(filePath):
+    """ Reference segmentation of an image: 'volume' -> 'segmentation', 'img' -> 'mask' """
+    filePath = Path(filePath)
+    return filePath.parent / filePath.name.replace("volume", "segmentation").replace("img", "mask")
+
+
+def read3d(filePath, out_dtype=np.int16, only_header=False, with_label=True):
     if filePath.lower().endswith(('.nii', '.nii.gz')):
         hdr, volume = read_nii(filePath, out_dtype, only_header)
-        labPath = Path(filePath)
-        labPath = labPath.parent / labPath.name.replace("volume", "segmentation").replace("img", "mask")
-        if not only_header:
+        labPath = label_path(filePath)
+        if not only_header and with_label and labPath.exists():
             _, label = read_nii(labPath, out_dtype, only_header)
             label = np.clip(label, 0, 1)
         else:
@@ -3,9 +3,10 @@
 
 from PyQt5.QtGui import QImage
 from base64 import b64encode, b64decode
-from libs.common_io import CommonWriter
+from libs.common_io import CommonWriter, sidecarPath
 from libs.shape import Shape
 from libs.image3d import read3d
+from libs.tiledImage import imageShape as readImageShape
 import os.path
 import sys
 
@@ -22,8 +23,11 @@ class LabelFile(object):
         self.imagePath = None
         self.imageData = None
         self.verified = False
+        # Save the compact .npz sidecar (<name>.cxml.npz) instead of the .cxml
+        self.useNpz = False
 
-    def saveCommonFormat(self, filename, shapes, imagePath):
+    def saveCommonFormat(self, filename, shapes, imagePath, imageShape=None):
+        """ `imageShape` is [height, width, channels] of a 2d image, read from its header if not given """
         imgFolderPath = os.path.dirname(imagePath)
         imgFolderName = os.path.split(imgFolderPath)[-1]
         imgFileName = os.path.basename(imagePath)
@@ -32,11 +36,8 @@ class LabelFile(object):
         if is3d:
             z, y, x = read3d(imagePath, only_header=True).shape
             imageShape = y, x, z
-        else:
-            image = QImage()
-            image.load(imagePath)
-            imageShape = [image.height(), image.width(),
-                          1 if image.isGrayscale() else 3]
+        elif imageShape is None:
+            imageShape = readImageShape(imagePath)
         writer = CommonWriter(imgFolderName, imgFileName,
                               imageShape, localImgPath=imagePath)
         writer.verified = self.verified
@@ -59,7 +60,10 @@ class LabelFile(object):
             elif dtype == Shape.POINT:
                 pnt = points[0]
                 writer.addPnt(int(pnt[0]), int(pnt[1]), label, **ext_items)
-        writer.save(targetFile=filename)
+        if self.useNpz:
+            writer.saveNpz(targetFile=sidecarPath(filename))
+        else:
+            writer.save(targetFile=filename)
         return
 
     @staticmethod
@@ -0,0 +1,156 @@
+try:
+    from PyQt5.QtGui import *
+    from PyQt5.QtCore import *
+except ImportError:
+    from PyQt4.QtGui import *
+    from PyQt4.QtCore import *
+
+from libs.utils import labelColors
+
+"""
+    Table of the shapes of a 3d image (axis, slice, z1, z2, label).
+
+    The rows are read from the shapes themselves instead of one QTableWidgetItem
+    per cell, and the shapes of an annotation file are inserted at once, so that
+    opening a case with thousands of clicks does not relayout the table per shape.
+"""
+
+
+class LabelTableModel(QAbstractTableModel):
+    AXIS, SLICE, Z1, Z2, LABEL = range(5)
+    VISIBLE = 5     # Reported by shapeEdited for the check state of the label cell
+
+    # (shape, column) edited in the table
+    shapeEdited = pyqtSignal(object, int)
+
+    def __init__(self, headers, parent=None):
+        super(LabelTableModel, self).__init__(parent)
+        self.headers = headers
+        self.shapes = []
+        self.places = []        # (axis, slice) of each row
+        self.checked = []
+        self.rows = {}          # shape -> row
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.shapes)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.headers)
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        if orientation == Qt.Horizontal and role == Qt.DisplayRole:
+            return self.headers[section]
+        return super(LabelTableModel, self).headerData(section, orientation, role)
+
+    def data(self, index, role=Qt.DisplayRole):
+        if not index.isValid():
+            return None
+        row, col = index.row(), index.column()
+        shape = self.shapes[row]
+        if role in (Qt.DisplayRole, Qt.EditRole):
+            if col == self.LABEL:
+                return shape.label
+            if col == self.Z1:
+                return str(shape.z1)
+            if col == self.Z2:
+                return str(shape.z2)
+            return str(self.places[row][col])
+        if role == Qt.BackgroundRole:
+            return labelColors.get(shape.label)
+        if role == Qt.CheckStateRole and col == self.LABEL:
+            return Qt.Checked if self.checked[row] else Qt.Unchecked
+        return None
+
+    def flags(self, index):
+        flags = super(LabelTableModel, self).flags(index)
+        if index.column() in (self.Z1, self.Z2, self.LABEL):
+            flags |= Qt.ItemIsEditable
+        if index.column() == self.LABEL:
+            flags |= Qt.ItemIsUserCheckable
+        return flags
+
+    def setData(self, index, value, role=Qt.EditRole):
+        if not index.isValid():
+            return False
+        row, col = index.row(), index.column()
+        shape = self.shapes[row]
+        if role == Qt.CheckStateRole and col == self.LABEL:
+            self.checked[row] = value == Qt.Checked
+        elif role != Qt.EditRole:
+            return False
+        elif col == self.LABEL:
+            if not value or value == shape.label:
+                return False
+            shape.label = value
+        elif col in (self.Z1, self.Z2):
+            try:
+                value = int(value)
+            except ValueError:
+                return False
+            if col == self.Z1:
+                shape.z1 = value
+            else:
+                shape.z2 = value
+        else:
+            return False
+        self.dataChanged.emit(self.index(row, 0), self.index(row, self.LABEL))
+        self.shapeEdited.emit(shape, self.VISIBLE if role == Qt.CheckStateRole else col)
+        return True
+
+    def addShapes(self, items):
+        """
+        Append [(shape, axis, slice)] with a single insert. Rectangles without
+        a z range get the slice as their range.
+        """
+        if not items:
+            return
+        first = len(self.shapes)
+        self.beginInsertRows(QModelIndex(), first, first + len(items) - 1)
+        for i, (shape, axis, idx) in enumerate(items):
+            if shape.z1 < 0:
+                shape.z1 = idx
+            if shape.z2 < 0:
+                shape.z2 = idx
+            self.shapes.append(shape)
+            self.places.append((axis, idx))
+            self.checked.append(True)
+            self.rows[shape] = first + i
+        self.endInsertRows()
+
+    def removeShape(self, shape):
+        row = self.rows.get(shape)
+        if row is None:
+            return
+        self.beginRemoveRows(QModelIndex(), row, row)
+        del self.shapes[row], self.places[row], self.checked[row]
+        del self.rows[shape]
+        for r in range(row, len(self.shapes)):
+            self.rows[self.shapes[r]] = r
+        self.endRemoveRows()
+
+    def clear(self):
+        self.beginResetModel()
+        self.shapes = []
+        self.places = []
+        self.checked = []
+        self.rows = {}
+        self.endResetModel()
+
+    def rowOf(self, shape):
+        """ Row of `shape`, -1 if it is not in the table """
+        return self.rows.get(shape, -1)
+
+    def place(self, shape):
+        """ (axis, slice) where `shape` was drawn """
+        return self.places[self.rows[shape]]
+
+    def colorsChanged(self):
+        if self.shapes:
+            self.dataChanged.emit(self.index(0, 0), self.index(len(self.shapes) - 1, self.LABEL),
+                                  [Qt.BackgroundRole])
+
+    def setAllChecked(self, checked):
+        if not self.shapes:
+            return
+        self.checked = [checked] * len(self.shapes)
+        self.dataChanged.emit(self.index(0, self.LABEL), self.index(len(self.shapes) - 1, self.LABEL))
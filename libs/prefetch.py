@@ -0,0 +1,175 @@
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PyQt5.QtGui import *
+    from PyQt5.QtCore import *
+except ImportError:
+    from PyQt4.QtGui import *
+    from PyQt4.QtCore import *
+
+from libs.common_io import CommonReaderError, latestAnnotation, openAnnotation
+from libs.image3d import read3d
+from libs.tiledImage import largeImage
+from libs.utils import LRUCache
+
+"""
+    Decode cache and background prefetching of the 2d images and their annotations,
+    and of the next 3d volumes, so that the next image is already in memory when
+    it is opened.
+"""
+
+PREFETCH_COUNT = 3      # Images prefetched on each side of the current one
+CACHE_SIZE = 16
+VOLUME_PREFETCH_COUNT = 1   # Volumes prefetched after the current one, each one holds a full case in memory
+
+
+class _Task(QRunnable):
+
+    def __init__(self, func, path, cxmlPath):
+        super(_Task, self).__init__()
+        self.func = func
+        self.path = path
+        self.cxmlPath = cxmlPath
+        self.started = False
+        self.cancelled = False
+        self.done = threading.Event()
+
+    def run(self):
+        self.func(self)
+
+
+class Prefetcher(object):
+
+    def __init__(self, capacity=CACHE_SIZE, maxThreads=2):
+        self.images = LRUCache(capacity)          # image path -> (mtime, QImage)
+        self.annotations = LRUCache(capacity)     # cxml path -> ((path, mtime), CommonReader)
+        self.pending = {}                           # image path -> _Task
+        self.lock = threading.Lock()
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(maxThreads)
+
+    def image(self, path):
+        """ Return the decoded QImage of `path`, waiting for its prefetch if it is running """
+        with self.lock:
+            task = self.pending.get(path)
+            if task is not None and not task.started:
+                # Still queued, decode it here rather than waiting behind the other tasks
+                task.cancelled = True
+                del self.pending[path]
+                task = None
+        if task is not None:
+            task.done.wait()
+        image = self.cachedImage(path)
+        if image is None:
+            image = self._decode(path)
+        return image
+
+    def cachedImage(self, path):
+        """ Return the cached QImage of `path`, None if it is not cached or the file changed since """
+        cached = self.images.get(path)
+        if cached is None:
+            return None
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+        return cached[1] if cached[0] == mtime else None
+
+    def annotation(self, cxmlPath):
+        """
+        Return the parsed reader of `cxmlPath` or of its .npz sidecar, whichever is newer,
+        or None if neither exists
+        """
+        found = latestAnnotation(cxmlPath)
+        if found is None:
+            return None
+        cached = self.annotations.get(cxmlPath)
+        if cached is not None and cached[0] == found:
+            return cached[1]
+        reader = openAnnotation(found[0])
+        self.annotations.put(cxmlPath, (found, reader))
+        return reader
+
+    def prefetch(self, items):
+        """
+        Load [(image path, cxml path)] in the background, nearest first. Queued
+        tasks of the previous call which are not in `items` are dropped.
+        """
+        paths = set(path for path, _ in items)
+        with self.lock:
+            for path, task in list(self.pending.items()):
+                if not task.started and path not in paths:
+                    task.cancelled = True
+                    del self.pending[path]
+        for priority, (path, cxmlPath) in enumerate(reversed(items)):
+            if self.cachedImage(path) is not None:
+                continue
+            with self.lock:
+                if path in self.pending:
+                    continue
+                task = self.pending[path] = _Task(self._load, path, cxmlPath)
+            self.pool.start(task, priority)
+
+    def _decode(self, path):
+        try:
+            # Taken before reading, a file rewritten meanwhile is decoded again next time
+            mtime = os.stat(path).st_mtime_ns
+            with open(path, 'rb') as f:
+                image = QImage.fromData(f.read())
+        except OSError:
+            return QImage()
+        if not image.isNull():
+            self.images.put(path, (mtime, image))
+        return image
+
+    def _load(self, task):
+        with self.lock:
+            if task.cancelled:
+                return
+            task.started = True
+        try:
+            # Opened by tiles instead, the whole image may not even fit in memory
+            if not largeImage(task.path):
+                self._decode(task.path)
+            if task.cxmlPath is not None:
+                self.annotation(task.cxmlPath)
+        except CommonReaderError:
+            # Reported when the image is opened
+            pass
+        finally:
+            with self.lock:
+                self.pending.pop(task.path, None)
+            task.done.set()
+
+
+class VolumePrefetcher(object):
+    """ Read the next volumes with read3d in a background thread, keeping at most `capacity` of them """
+
+    def __init__(self, capacity=VOLUME_PREFETCH_COUNT):
+        self.capacity = capacity
+        self.futures = OrderedDict()    # path -> Future of Image3d
+        self.executor = ThreadPoolExecutor(max_workers=1)
+
+    def prefetch(self, paths):
+        """ Start reading `paths`, the volumes prefetched before and not in `paths` are dropped """
+        paths = paths[:self.capacity]
+        for path in list(self.futures):
+            if path not in paths:
+                self.futures.pop(path).cancel()
+        for path in paths:
+            if path not in self.futures:
+                self.futures[path] = self.executor.submit(read3d, path)
+
+    def take(self, path):
+        """ Return the prefetched Image3d of `path` (waiting for it if it is being read), or None """
+        future = self.futures.pop(path, None)
+        if future is None or future.cancelled():
+            return None
+        try:
+            return future.result()
+        except Exception as e:
+            print("Prefetch %s failed: %s" % (path, e))
+            return None
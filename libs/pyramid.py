@@ -0,0 +1,112 @@
+import threading
+
+import numpy as np
+
+try:
+    from PyQt5.QtGui import *
+    from PyQt5.QtCore import *
+except ImportError:
+    from PyQt4.QtGui import *
+    from PyQt4.QtCore import *
+
+"""
+    Mipmap pyramid of the image shown in the canvas.
+
+    Level k is the image downscaled by 2^k. When zoomed out the canvas draws the
+    visible part of the nearest level which is at least as large as the screen,
+    so zooming never rescales the full image.
+"""
+
+MIN_LEVEL_SIZE = 512                # No level smaller than this (longest side)
+BACKGROUND_PIXELS = 2048 * 2048     # Build the levels in a thread above this
+CHUNK_ROWS = 256                    # Rows halved at once, bounds the temporary memory
+
+
+def imageArray(image):
+    """
+    (h, w, 4) uint8 array of `image` in the byte order of ARGB32_Premultiplied,
+    a view of the pixels when the image is already 32 bits opaque or premultiplied
+    (the caller keeps `image` alive then)
+    """
+    fmt = image.format()
+    converted = fmt not in (QImage.Format_RGB32, QImage.Format_ARGB32_Premultiplied, QImage.Format_Grayscale8)
+    if converted:
+        # Holds the GIL in QImage.convertToFormat, but only for the less common formats
+        image = image.convertToFormat(QImage.Format_ARGB32_Premultiplied)
+        fmt = image.format()
+    ptr = image.constBits()
+    ptr.setsize(image.bytesPerLine() * image.height())
+    rows = np.frombuffer(ptr, np.uint8).reshape(image.height(), image.bytesPerLine())
+    if fmt == QImage.Format_Grayscale8:
+        gray = rows[:, :image.width()]
+        array = np.empty((image.height(), image.width(), 4), np.uint8)
+        array[..., :3] = gray[..., None]
+        array[..., 3] = 255
+        return array
+    array = rows[:, :image.width() * 4].reshape(image.height(), image.width(), 4)
+    # The converted image is freed on return
+    return array.copy() if converted else array
+
+
+def halve(array):
+    """
+    2x2 box filter of a (h, w, channels) uint8 array. Done with numpy in chunks
+    of rows, which unlike QImage.scaled() lets the GUI thread run meanwhile.
+    """
+    h, w = array.shape[0] // 2, array.shape[1] // 2
+    out = np.empty((h, w) + array.shape[2:], np.uint8)
+    for y in range(0, h, CHUNK_ROWS):
+        rows = array[2 * y:2 * min(h, y + CHUNK_ROWS), :2 * w]
+        acc = rows[0::2, 0::2].astype(np.uint16)
+        acc += rows[0::2, 1::2]
+        acc += rows[1::2, 0::2]
+        acc += rows[1::2, 1::2]
+        acc += 2
+        acc >>= 2
+        out[y:y + acc.shape[0]] = acc
+    return out
+
+
+class ImagePyramid(QObject):
+    # Emitted from the builder thread when a level is added
+    levelReady = pyqtSignal()
+
+    def __init__(self, image, parent=None):
+        super(ImagePyramid, self).__init__(parent)
+        self.levels = []            # QImage of level 1, 2, ...
+        self.width, self.height = image.width(), image.height()
+        self.cancelled = False
+        if max(image.width(), image.height()) <= MIN_LEVEL_SIZE * 2:
+            return
+        if image.width() * image.height() > BACKGROUND_PIXELS:
+            thread = threading.Thread(target=self.build, args=(image,))
+            thread.daemon = True
+            thread.start()
+        else:
+            self.build(image)
+
+    def build(self, image):
+        array = imageArray(image)
+        while max(array.shape[0], array.shape[1]) > MIN_LEVEL_SIZE * 2 and not self.cancelled:
+            # Halve from the previous level, the box filter does not alias at 2x
+            array = halve(array)
+            h, w = array.shape[:2]
+            level = QImage(array.data, w, h, w * 4, QImage.Format_ARGB32_Premultiplied).copy()
+            self.levels.append(level)
+            self.levelReady.emit()
+
+    def cancel(self):
+        self.cancelled = True
+
+    def level(self, scale):
+        """
+        Return (image, fx, fy) of the smallest built level which is at least `scale`
+        of the full image, or None if the full image should be drawn
+        """
+        levels = self.levels[:]     # The builder thread may append
+        best = None
+        for k, image in enumerate(levels, 1):
+            if 0.5 ** k < scale:
+                break
+            best = (image, image.width() / float(self.width), image.height() / float(self.height))
+        return best
@@ -0,0 +1,233 @@
+import itertools
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+
+import grpc
+import numpy as np
+import tensorflow as tf
+from tensorflow_serving.apis import predict_pb2, prediction_service_pb2_grpc
+
+"""
+    Client of the TensorFlow Serving models used by Image3d.seg_din().
+
+    Requests with the same model name and tensor shapes which are in flight
+    together within a small time window (the tile batches of a tiled inference,
+    the workers of a headless batch run, see libs.batch_seg) are coalesced into
+    one PredictRequest with batch > 1, and the outputs are split back to callers.
+    The window is off by default: the GUI sends one request at a time and calls
+    the server directly.
+"""
+
+HOST = "localhost"
+PORT = 8500
+MAX_MESSAGE_LENGTH = 50 * 1536 * 512 * 4
+# Coalescing window in seconds and the largest batch of a request. A longer
+# window gives larger batches (throughput) at the cost of latency, 0 disables it.
+BATCH_WINDOW = 0.
+BATCH_RUN_WINDOW = 0.005    # Default of the batch driver, which has concurrent requests
+MAX_BATCH = 8
+MAX_INFLIGHT = 4            # Requests sent to the server at the same time
+
+
+class ServingClient(object):
+    """ One gRPC channel shared by all the requests """
+
+    def __init__(self, host=HOST, port=PORT):
+        options = [('grpc.max_send_message_length', MAX_MESSAGE_LENGTH),
+                   ('grpc.max_receive_message_length', MAX_MESSAGE_LENGTH)]
+        self.channel = grpc.insecure_channel('{host}:{port}'.format(host=host, port=port), options=options)
+        self.stub = prediction_service_pb2_grpc.PredictionServiceStub(self.channel)
+
+    def predict(self, image, guide, name):
+        request = predict_pb2.PredictRequest()
+        request.model_spec.name = name
+        request.model_spec.signature_name = "serving_default"
+        request.inputs['image'].CopyFrom(tf.make_tensor_proto(image))
+        request.inputs['guide'].CopyFrom(tf.make_tensor_proto(guide))
+        result = self.stub.Predict(request)
+
+        # Reference:
+        # How to access nested values
+        # https://stackoverflow.com/questions/44785847/how-to-retrieve-float-val-from-a-predictresponse-object
+        return tf.make_ndarray(result.outputs["output_0"]).reshape(*guide.shape)
+
+
+class _Group(object):
+
+    def __init__(self, deadline):
+        self.deadline = deadline
+        self.size = 0
+        self.requests = []      # [(image, guide, future)]
+
+
+class MicroBatcher(object):
+
+    def __init__(self, client, window=BATCH_WINDOW, maxBatch=MAX_BATCH, maxInflight=MAX_INFLIGHT):
+        self.client = client
+        self.window = window
+        self.maxBatch = maxBatch
+        self.maxInflight = maxInflight
+        self.pending = {}       # (name, shapes and dtypes of the inputs) -> _Group
+        self.cond = threading.Condition()
+        self.executor = ThreadPoolExecutor(max_workers=maxInflight)
+        self.worker = None
+        self.closed = False
+
+    def submit(self, image, guide, name):
+        """ Queue a request and return a Future of its outputs """
+        if self.window <= 0:
+            return self.executor.submit(self.client.predict, image, guide, name)
+
+        future = Future()
+        key = (name, image.shape[1:], image.dtype.str, guide.shape[1:], guide.dtype.str)
+        n = image.shape[0]
+        with self.cond:
+            if self.closed:
+                raise RuntimeError("The batcher is closed")
+            if self.worker is None:
+                self.worker = threading.Thread(target=self._loop, name="MicroBatcher", daemon=True)
+                self.worker.start()
+            group = self.pending.get(key)
+            if group is not None and group.size + n > self.maxBatch:
+                self._dispatch(key)
+                group = None
+            if group is None:
+                group = self.pending[key] = _Group(time.monotonic() + self.window)
+            group.requests.append((image, guide, future))
+            group.size += n
+            if group.size >= self.maxBatch:
+                self._dispatch(key)
+            self.cond.notify()
+        return future
+
+    def predict(self, image, guide, name):
+        if self.window <= 0:
+            # Nothing to wait for, skip the thread hop
+            return self.client.predict(image, guide, name)
+        return self.submit(image, guide, name).result()
+
+    def close(self):
+        """ Send the pending requests and stop the threads once they are done """
+        with self.cond:
+            self.closed = True
+            for key in list(self.pending):
+                self._dispatch(key)
+            self.cond.notify()
+        self.executor.shutdown(wait=False)
+
+    def _loop(self):
+        with self.cond:
+            while not self.closed:
+                if not self.pending:
+                    self.cond.wait()
+                    continue
+                key = min(self.pending, key=lambda k: self.pending[k].deadline)
+                timeout = self.pending[key].deadline - time.monotonic()
+                if timeout > 0:
+                    self.cond.wait(timeout)
+                    continue
+                self._dispatch(key)
+
+    def _dispatch(self, key):
+        """ Send a pending group, must be called with `self.cond` held """
+        group = self.pending.pop(key)
+        self.executor.submit(self._send, key[0], group.requests)
+
+    def _send(self, name, requests):
+        try:
+            if len(requests) == 1:
+                outputs = [self.client.predict(requests[0][0], requests[0][1], name)]
+            else:
+                output = self.client.predict(np.concatenate([r[0] for r in requests]),
+                                             np.concatenate([r[1] for r in requests]), name)
+                outputs = np.split(output, np.cumsum([r[0].shape[0] for r in requests])[:-1])
+        except Exception as e:
+            for _, _, future in requests:
+                future.set_exception(e)
+            return
+        for (_, _, future), out in zip(requests, outputs):
+            future.set_result(out)
+
+
+class RelayClient(object):
+    """
+    Client of a worker process of the batch driver. The requests are sent to the
+    parent process (see relay()), where those of all the workers share one batcher.
+    """
+
+    def __init__(self, requests, responses, slot):
+        self.requests = requests        # Queue to the parent, shared by the workers
+        self.responses = responses      # Queue of this worker
+        self.slot = slot
+        self.futures = {}               # request id -> Future
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        reader = threading.Thread(target=self._read, name="RelayClient", daemon=True)
+        reader.start()
+
+    def predict(self, image, guide, name):
+        future = Future()
+        with self.lock:
+            i = next(self.ids)
+            self.futures[i] = future
+        self.requests.put((self.slot, i, image, guide, name))
+        return future.result()
+
+    def _read(self):
+        while True:
+            i, output, error = self.responses.get()
+            with self.lock:
+                future = self.futures.pop(i)
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(output)
+
+
+def relay(requests, responses, batcher):
+    """ Submit the requests of RelayClients to `batcher` until None is received """
+    while True:
+        request = requests.get()
+        if request is None:
+            return
+        slot, i, image, guide, name = request
+        batcher.submit(image, guide, name).add_done_callback(partial(_reply, responses[slot], i))
+
+
+def _reply(queue, i, future):
+    error = future.exception()
+    if error is not None:
+        # gRPC errors may not be picklable
+        queue.put((i, None, RuntimeError(str(error))))
+    else:
+        queue.put((i, future.result(), None))
+
+
+_batcher = None
+_lock = threading.Lock()
+
+
+def getBatcher():
+    global _batcher
+    with _lock:
+        if _batcher is None:
+            _batcher = MicroBatcher(ServingClient())
+        return _batcher
+
+
+def configure(host=HOST, port=PORT, window=BATCH_WINDOW, maxBatch=MAX_BATCH, client=None):
+    """ Replace the shared batcher, e.g. to trade latency for throughput in a batch run """
+    global _batcher
+    with _lock:
+        previous, _batcher = _batcher, MicroBatcher(client or ServingClient(host, port), window, maxBatch)
+        batcher = _batcher
+    if previous is not None:
+        previous.close()
+    return batcher
+
+
+def predict(image, guide, name):
+    """ Run model `name` on a batch, return the logits with the shape of `guide` """
+    return getBatcher().predict(image, guide, name)
@@ -25,10 +25,67 @@ MIN_Y_LABEL = 10
 DEFAULT_POINT_FILL_COLOR = QColor(255, 0, 0)
 DEFAULT_BG_FILL_COLOR = QColor(0, 0, 255)
 
+_pens = {}          # (rgba, width) -> QPen
+_labelFont = []
+_sprites = {}      # (rgba, fill rgba, pen width, scale) -> QPixmap
+
+
+def cachedPen(color, width):
+    """ Shared QPen of `color` and `width`, the shapes are painted with a few of them """
+    key = (color.rgba(), width)
+    pen = _pens.get(key)
+    if pen is None:
+        if len(_pens) > 256:
+            _pens.clear()
+        pen = _pens[key] = QPen(color)
+        pen.setWidth(width)
+    return pen
+
+
+def pointSprite(color, fillColor):
+    """ Pixmap of a point vertex painted like Point.paint() at the current Shape.scale """
+    width = max(1, int(round(2.0 / Shape.scale)))
+    key = (color.rgba(), fillColor.rgba(), width, Shape.scale)
+    sprite = _sprites.get(key)
+    if sprite is None:
+        if len(_sprites) > 256:
+            _sprites.clear()
+        radius = Shape.point_size / 2.0 + width * Shape.scale
+        size = int(2 * radius) + 2
+        sprite = QPixmap(size, size)
+        sprite.fill(Qt.transparent)
+        p = QPainter(sprite)
+        p.setRenderHint(QPainter.Antialiasing)
+        p.translate(size / 2.0, size / 2.0)
+        p.scale(Shape.scale, Shape.scale)
+        path = QPainterPath()
+        d = Shape.point_size / Shape.scale
+        path.addEllipse(QPointF(0, 0), d / 2.0, d / 2.0)
+        p.setPen(cachedPen(color, width))
+        p.drawPath(path)
+        p.fillPath(path, fillColor)
+        p.end()
+        sprite = _sprites[key] = sprite
+    return sprite
+
+
+def labelFont():
+    if not _labelFont:
+        font = QFont()
+        font.setPointSize(8)
+        font.setBold(True)
+        _labelFont.append((font, QFontMetricsF(font)))
+    return _labelFont[0]
+
 
 class Shape(object):
     """ Shape base class (Rectangle)
     """
+    # Thousands of them per volume, and changes are written through to the AnnotationStore
+    __slots__ = ('_label', '_points', 'fill', 'selected', 'paintLabel', '_highlightIndex', '_highlightMode',
+                 '_closed', '_line_color', '_fill_color', '_z1', '_z2', '_visible', '_path', '_bounds',
+                 '_store', '_row')
+
     P_SQUARE, P_ROUND = range(2)
 
     MOVE_VERTEX, NEAR_VERTEX = range(2)
@@ -38,8 +95,9 @@ class Shape(object):
     
     # The following class variables influence the drawing
     # of _all_ shape objects.
-    line_color = DEFAULT_LINE_COLOR
-    fill_color = DEFAULT_FILL_COLOR
+    # Colors of the shapes whose line_color/fill_color is not set
+    default_line_color = DEFAULT_LINE_COLOR
+    default_fill_color = DEFAULT_FILL_COLOR
     select_line_color = DEFAULT_SELECT_LINE_COLOR
     select_fill_color = DEFAULT_SELECT_FILL_COLOR
     vertex_fill_color = DEFAULT_VERTEX_FILL_COLOR
@@ -49,12 +107,18 @@ class Shape(object):
     scale = 1.0
     type_ = RECTANGLE
     bg_fill_color = DEFAULT_BG_FILL_COLOR
-
-    z1 = -1
-    z2 = -1
+    _highlightSettings = {
+        NEAR_VERTEX: (4, P_ROUND),
+        MOVE_VERTEX: (1.5, P_SQUARE),
+    }
 
     def __init__(self, label=None, line_color=None, paintLabel=False):
-        self.label = label
+        self._store = None      # AnnotationStore holding the shape, and its row there
+        self._row = None
+        self._label = label
+        self._z1 = -1
+        self._z2 = -1
+        self._visible = True
         self.points = []
         self.fill = False
         self.selected = False
@@ -62,18 +126,84 @@ class Shape(object):
 
         self._highlightIndex = None
         self._highlightMode = self.NEAR_VERTEX
-        self._highlightSettings = {
-            self.NEAR_VERTEX: (4, self.P_ROUND),
-            self.MOVE_VERTEX: (1.5, self.P_SQUARE),
-        }
 
         self._closed = False
 
-        if line_color is not None:
-            # Override the class line_color attribute
-            # with an object attribute. Currently this
-            # is used for drawing the pending line a different color.
-            self.line_color = line_color
+        # Override the class default_line_color, currently this
+        # is used for drawing the pending line a different color.
+        self._line_color = line_color
+        self._fill_color = None
+
+    def _sync(self):
+        if self._store is not None:
+            self._store.update(self)
+
+    @property
+    def points(self):
+        return self._points
+
+    @points.setter
+    def points(self, points):
+        self._points = points
+        self.invalidate()
+
+    @property
+    def label(self):
+        return self._label
+
+    @label.setter
+    def label(self, label):
+        self._label = label
+        self._sync()
+
+    @property
+    def z1(self):
+        return self._z1
+
+    @z1.setter
+    def z1(self, z1):
+        self._z1 = z1
+        self._sync()
+
+    @property
+    def z2(self):
+        return self._z2
+
+    @z2.setter
+    def z2(self, z2):
+        self._z2 = z2
+        self._sync()
+
+    @property
+    def visible(self):
+        return self._visible
+
+    @visible.setter
+    def visible(self, visible):
+        self._visible = visible
+        self._sync()
+
+    @property
+    def line_color(self):
+        return self.default_line_color if self._line_color is None else self._line_color
+
+    @line_color.setter
+    def line_color(self, color):
+        self._line_color = color
+
+    @property
+    def fill_color(self):
+        return self.default_fill_color if self._fill_color is None else self._fill_color
+
+    @fill_color.setter
+    def fill_color(self, color):
+        self._fill_color = color
+
+    def invalidate(self):
+        """ Reset the cached path and bounds after the points changed """
+        self._path = None
+        self._bounds = None
+        self._sync()
 
     def close(self):
         self._closed = True
@@ -86,9 +216,11 @@ class Shape(object):
     def addPoint(self, point):
         if not self.reachMaxPoints():
             self.points.append(point)
+            self.invalidate()
 
     def popPoint(self):
         if self.points:
+            self.invalidate()
             return self.points.pop()
         return None
 
@@ -110,14 +242,14 @@ class Shape(object):
             max_y = max(max_y, p.y())
         return min_x, min_y, max_x - min_x, max_y - min_y
 
+    def penWidth(self):
+        # Try using integer sizes for smoother drawing(?)
+        return max(1, int(round(2.0 / self.scale)))
+
     def paint(self, painter):
         if self.points:
             color = self.select_line_color if self.selected else self.line_color
-            
-            pen = QPen(color)
-            # Try using integer sizes for smoother drawing(?)
-            pen.setWidth(max(1, int(round(2.0 / self.scale))))
-            painter.setPen(pen)
+            painter.setPen(cachedPen(color, self.penWidth()))
 
             line_path = QPainterPath()
             vrtx_path = QPainterPath()
@@ -136,30 +268,43 @@ class Shape(object):
 
             painter.drawPath(line_path)
             painter.drawPath(vrtx_path)
-            painter.fillPath(vrtx_path, self.vertex_fill_color)
+            painter.fillPath(vrtx_path, self.vertexFillColor())
 
             # Draw text at the top-left
             if self.paintLabel:
-                min_x = sys.maxsize
-                min_y = sys.maxsize
-                for point in self.points:
-                    min_x = min(min_x, point.x())
-                    min_y = min(min_y, point.y())
-                if min_x != sys.maxsize and min_y != sys.maxsize:
-                    font = QFont()
-                    font.setPointSize(8)
-                    font.setBold(True)
-                    painter.setFont(font)
-                    if(self.label == None):
-                        self.label = ""
-                    if(min_y < MIN_Y_LABEL):
-                        min_y += MIN_Y_LABEL
-                    painter.drawText(min_x, min_y, self.label)
+                self.drawLabel(painter)
 
             if self.fill:
                 color = self.select_fill_color if self.selected else self.fill_color
                 painter.fillPath(line_path, color)
 
+    def drawLabel(self, painter):
+        if self.label is None:
+            self.label = ""
+        rect = self.bounds()
+        min_x, min_y = rect.left(), rect.top()
+        if min_y < MIN_Y_LABEL:
+            min_y += MIN_Y_LABEL
+        painter.setFont(labelFont()[0])
+        painter.drawText(QPointF(min_x, min_y), self.label)
+
+    def paintBounds(self, margin):
+        """ Rect covered by the painted shape with vertices of size up to `margin`, and its label """
+        rect = self.bounds().adjusted(-margin, -margin, margin, margin)
+        if self.paintLabel and self.label:
+            font, metrics = labelFont()
+            x, y = self.bounds().left(), self.bounds().top()
+            if y < MIN_Y_LABEL:
+                y += MIN_Y_LABEL
+            rect = rect.united(QRectF(x, y - metrics.ascent(), metrics.width(self.label), metrics.height()))
+        return rect
+
+    def highlighted(self):
+        return self._highlightIndex is not None
+
+    def vertexFillColor(self):
+        return self.hvertex_fill_color if self._highlightIndex is not None else self.vertex_fill_color
+
     def drawVertex(self, path, i):
         d = self.point_size / self.scale
         shape = self.point_type
@@ -167,10 +312,6 @@ class Shape(object):
         if i == self._highlightIndex:
             size, shape = self._highlightSettings[self._highlightMode]
             d *= size
-        if self._highlightIndex is not None:
-            self.vertex_fill_color = self.hvertex_fill_color
-        else:
-            self.vertex_fill_color = Shape.vertex_fill_color
         if shape == self.P_SQUARE:
             path.addRect(point.x() - d / 2, point.y() - d / 2, d, d)
         elif shape == self.P_ROUND:
@@ -191,19 +332,30 @@ class Shape(object):
         return self.makePath().contains(point)
 
     def makePath(self):
-        path = QPainterPath(self.points[0])
-        for p in self.points[1:]:
-            path.lineTo(p)
-        return path
+        if self._path is None:
+            path = QPainterPath(self.points[0])
+            for p in self.points[1:]:
+                path.lineTo(p)
+            self._path = path
+        return self._path
 
     def boundingRect(self):
         return self.makePath().boundingRect()
 
+    def bounds(self):
+        """ Bounding rect of the points, not empty for a single point unlike boundingRect() """
+        if self._bounds is None:
+            xs = [p.x() for p in self.points]
+            ys = [p.y() for p in self.points]
+            self._bounds = QRectF(min(xs), min(ys), max(xs) - min(xs), max(ys) - min(ys))
+        return self._bounds
+
     def moveBy(self, offset):
         self.points = [p + offset for p in self.points]
 
     def moveVertexBy(self, i, offset):
         self.points[i] = self.points[i] + offset
+        self.invalidate()
 
     def highlightVertex(self, i, action):
         self._highlightIndex = i
@@ -218,10 +370,8 @@ class Shape(object):
         shape.fill = self.fill
         shape.selected = self.selected
         shape._closed = self._closed
-        if self.line_color != Shape.line_color:
-            shape.line_color = self.line_color
-        if self.fill_color != Shape.fill_color:
-            shape.fill_color = self.fill_color
+        shape._line_color = self._line_color
+        shape._fill_color = self._fill_color
         return shape
 
     def __len__(self):
@@ -232,16 +382,31 @@ class Shape(object):
 
     def __setitem__(self, key, value):
         self.points[key] = value
+        self.invalidate()
 
 
 class Point(Shape):
+    __slots__ = ('_fg',)
+
     vertex_fill_color = DEFAULT_POINT_FILL_COLOR
+    type_ = Shape.POINT
 
     def __init__(self, label=None, paintLabel=False, foreground=True):
-        self.type_ = Shape.POINT
-        self.fg = foreground
+        self._fg = foreground
         super(Point, self).__init__(label, None, paintLabel)
-        
+
+    @property
+    def fg(self):
+        return self._fg
+
+    @fg.setter
+    def fg(self, fg):
+        self._fg = fg
+        self._sync()
+
+    def vertexFillColor(self):
+        return self.select_fill_color if self._highlightIndex is not None else self.vertex_fill_color
+
     def paint(self, painter):
         if self.points:
             if self.selected:
@@ -249,54 +414,40 @@ class Point(Shape):
                 self.highlightVertex(0, Shape.MOVE_VERTEX)
             else:
                 color = self.line_color
-            pen = QPen(color)
-            # Try using integer sizes for smoother drawing(?)
-            pen.setWidth(max(1, int(round(2.0 / self.scale))))
-            painter.setPen(pen)
-    
+            painter.setPen(cachedPen(color, self.penWidth()))
+
             vrtx_path = QPainterPath()
             for i, p in enumerate(self.points):
                 self.drawVertex(vrtx_path, i)
             painter.drawPath(vrtx_path)
-            painter.fillPath(vrtx_path, self.vertex_fill_color if self.fg else self.bg_fill_color)
+            painter.fillPath(vrtx_path, self.vertexFillColor() if self.fg else self.bg_fill_color)
             
             # Draw text at the top-left
             if self.paintLabel:
-                min_x = sys.maxsize
-                min_y = sys.maxsize
-                for point in self.points:
-                    min_x = min(min_x, point.x())
-                    min_y = min(min_y, point.y())
-                if min_x != sys.maxsize and min_y != sys.maxsize:
-                    font = QFont()
-                    font.setPointSize(8)
-                    font.setBold(True)
-                    painter.setFont(font)
-                    if(self.label == None):
-                        self.label = ""
-                    if(min_y < MIN_Y_LABEL):
-                        min_y += MIN_Y_LABEL
-                    painter.drawText(min_x, min_y, self.label)
+                self.drawLabel(painter)
+
+    @staticmethod
+    def paintBatch(painter, points):
+        """
+        Paint points which are neither selected nor highlighted by stamping one
+        pre-rendered sprite per (line color, foreground) instead of building a path per point
+        """
+        groups = {}
+        for shape in points:
+            groups.setdefault((shape.line_color.rgba(), shape.fg), []).append(shape)
+        # The sprites are rendered at the screen resolution, so undo the scale of the canvas
+        scale = 1.0 / Shape.scale
+        create = QPainter.PixmapFragment.create
+        for group in groups.values():
+            first = group[0]
+            sprite = pointSprite(first.line_color, Point.vertex_fill_color if first.fg else first.bg_fill_color)
+            source = QRectF(sprite.rect())
+            painter.drawPixmapFragments([create(shape.points[0], source, scale, scale) for shape in group], sprite)
+        for shape in points:
+            if shape.paintLabel:
+                shape.drawLabel(painter)
 
     def reachMaxPoints(self):
         if len(self.points) >= 1:
             return True
         return False
-
-    def drawVertex(self, path, i):
-        d = self.point_size / self.scale
-        shape = self.point_type
-        point = self.points[i]
-        if i == self._highlightIndex:
-            size, shape = self._highlightSettings[self._highlightMode]
-            d *= size
-        if self._highlightIndex is not None:
-            self.vertex_fill_color = self.select_fill_color
-        else:
-            self.vertex_fill_color = Point.vertex_fill_color
-        if shape == self.P_SQUARE:
-            path.addRect(point.x() - d / 2, point.y() - d / 2, d, d)
-        elif shape == self.P_ROUND:
-            path.addEllipse(point, d / 2.0, d / 2.0)
-        else:
-            assert False, "unsupported vertex shape"
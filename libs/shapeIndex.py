@@ -0,0 +1,92 @@
+import math
+
+"""
+    Uniform grid over the bounding rects of the shapes of a slice, so that the
+    canvas hit-tests only the shapes near the cursor instead of all of them.
+"""
+
+CELL_SIZE = 64      # In image pixels
+
+
+class ShapeGrid(object):
+    """
+    Each shape is registered in the cells overlapped by its bounding rect grown
+    by `pad`, so a point query only looks at the cell of the point.
+    """
+
+    def __init__(self, shapes, pad=0., cellSize=CELL_SIZE):
+        self.shapes = shapes        # The list of the canvas, to detect outside changes
+        self.pad = pad
+        self.cellSize = cellSize
+        self.cells = {}             # (i, j) -> set of shapes
+        self.shapeCells = {}        # shape -> [(i, j)]
+        self.order = {}             # shape -> insertion order, the last one is on top
+        self.counter = 0
+        for shape in shapes:
+            self.add(shape)
+
+    def __len__(self):
+        return len(self.shapeCells)
+
+    def __contains__(self, shape):
+        return shape in self.shapeCells
+
+    def _cellsOf(self, shape):
+        if not shape.points:
+            return []
+        # Not shape.boundingRect(), the path of a single point has an empty rect
+        xs = [p.x() for p in shape.points]
+        ys = [p.y() for p in shape.points]
+        size = self.cellSize
+        i1 = int(math.floor((min(xs) - self.pad) / size))
+        i2 = int(math.floor((max(xs) + self.pad) / size))
+        j1 = int(math.floor((min(ys) - self.pad) / size))
+        j2 = int(math.floor((max(ys) + self.pad) / size))
+        return [(i, j) for i in range(i1, i2 + 1) for j in range(j1, j2 + 1)]
+
+    def add(self, shape):
+        if shape in self.shapeCells:
+            self.move(shape)
+            return
+        cells = self._cellsOf(shape)
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(shape)
+        self.shapeCells[shape] = cells
+        self.order[shape] = self.counter
+        self.counter += 1
+
+    def remove(self, shape):
+        cells = self.shapeCells.pop(shape, None)
+        if cells is None:
+            return
+        for cell in cells:
+            bucket = self.cells[cell]
+            bucket.discard(shape)
+            if not bucket:
+                del self.cells[cell]
+        del self.order[shape]
+
+    def move(self, shape):
+        """ Update the cells of `shape` after its points changed """
+        old = self.shapeCells.get(shape)
+        if old is None:
+            return
+        cells = self._cellsOf(shape)
+        if cells == old:
+            return
+        for cell in old:
+            bucket = self.cells[cell]
+            bucket.discard(shape)
+            if not bucket:
+                del self.cells[cell]
+        for cell in cells:
+            self.cells.setdefault(cell, set()).add(shape)
+        self.shapeCells[shape] = cells
+
+    def candidates(self, point):
+        """ Shapes which may be hit at `point`, the top most first """
+        size = self.cellSize
+        bucket = self.cells.get((int(math.floor(point.x() / size)), int(math.floor(point.y() / size))))
+        if not bucket:
+            return []
+        return sorted(bucket, key=self.order.__getitem__, reverse=True)
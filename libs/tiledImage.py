@@ -0,0 +1,421 @@
+import math
+import threading
+
+import numpy as np
+
+try:
+    from PyQt5.QtGui import *
+    from PyQt5.QtCore import *
+except ImportError:
+    from PyQt4.QtGui import *
+    from PyQt4.QtCore import *
+
+try:
+    import tifffile
+except ImportError:
+    tifffile = None
+
+from libs.utils import LRUCache
+
+"""
+    2d images too large to be decoded at once (microscopy, satellite ...).
+
+    The image is split in TILE_SIZE tiles on each level of a 2x pyramid, level k
+    being downscaled by 2^k. The canvas asks for the tiles of the exposed area, the
+    missing ones are decoded in the background and kept in an LRU cache, so memory
+    is bounded by the cache whatever the size of the image. Meanwhile the canvas
+    draws them from a coarser tile; the PINNED_LEVELS coarsest levels, a few tiles,
+    are kept outside of the cache for that.
+
+    Tiles are read with QImageReader clip rects for the formats whose plugin decodes
+    a part of the image (jpeg), or with tifffile (optional) for tiled TIFFs. The
+    levels missing from a TIFF are read from a finer level by keeping every 2^k-th
+    pixel, which decodes only the TIFF tiles with such pixels.
+"""
+
+TILE_SIZE = 512
+TILE_CACHE_SIZE = 256               # Tiles, up to 256 MB with 32 bits pixels
+PINNED_LEVELS = 2                   # Coarsest levels never evicted, 5 tiles at most
+TILED_PIXELS = 8192 * 8192          # Larger images are opened as tiles
+TIFF_EXT = ('.tif', '.tiff')
+
+
+def levelSize(size, level):
+    """ Size of `level` of an image of `size`, rounded up """
+    return QSize(-(-size.width() >> level), -(-size.height() >> level))
+
+
+def arrayImage(array):
+    """ QImage copy of a (h, w, channels) uint8 array, channels being 1, 3 (RGB) or 4 (RGBA) """
+    array = np.ascontiguousarray(array)
+    h, w, channels = array.shape
+    fmt = {1: QImage.Format_Grayscale8, 3: QImage.Format_RGB888, 4: QImage.Format_RGBA8888}[channels]
+    return QImage(array.data, w, h, array.strides[0], fmt).copy()
+
+
+def largeImage(path):
+    """ Whether the image at `path` is too large to be decoded at once """
+    size = QImageReader(path).size()
+    return size.width() * size.height() > TILED_PIXELS
+
+
+def imageShape(path):
+    """ [height, width, channels] of the image at `path`, read from its header """
+    if tifffile is not None and path.lower().endswith(TIFF_EXT):
+        try:
+            with tifffile.TiffFile(path) as tif:
+                page = tif.pages[0]
+                return [page.imagelength, page.imagewidth, 1 if page.samplesperpixel == 1 else 3]
+        except (OSError, ValueError):
+            pass
+    reader = QImageReader(path)
+    if not reader.size().isValid():
+        # No size in the header
+        image = reader.read()
+        return [image.height(), image.width(), 1 if image.isGrayscale() else 3]
+    return [reader.size().height(), reader.size().width(),
+            1 if reader.imageFormat() == QImage.Format_Grayscale8 else 3]
+
+
+class QtTileReader(object):
+    """ Parts of the images whose Qt plugin decodes a clip rect (jpeg), at any level """
+
+    def __init__(self, path):
+        reader = QImageReader(path)
+        if not all(reader.supportsOption(option) for option in
+                   (QImageIOHandler.ClipRect, QImageIOHandler.ScaledSize, QImageIOHandler.ScaledClipRect)):
+            raise ValueError("%s can not be read by parts" % path)
+        self.path = path
+        self.size = reader.size()
+        self.grayscale = reader.imageFormat() == QImage.Format_Grayscale8
+
+    def hasLevel(self, level):
+        return True
+
+    def close(self):
+        pass
+
+    def read(self, level, rect):
+        """ QImage of `rect`, in the pixels of `level` """
+        # A reader per call, the handler keeps the state of the previous read
+        reader = QImageReader(self.path)
+        if level:
+            reader.setScaledSize(levelSize(self.size, level))
+            reader.setScaledClipRect(rect)
+        else:
+            reader.setClipRect(rect)
+        return reader.read()
+
+
+class TiffTileReader(object):
+    """ Tiles of an 8 bits tiled TIFF, and of its reduced levels if it is pyramidal """
+
+    def __init__(self, path):
+        self.tif = tifffile.TiffFile(path)
+        self.lock = threading.Lock()        # Of the file handle
+        base = self.tif.series[0].levels[0].keyframe
+        if not base.is_tiled or base.dtype != np.uint8 or base.imagedepth != 1 \
+                or base.planarconfig != 1 or base.samplesperpixel not in (1, 3, 4):
+            self.tif.close()
+            raise ValueError("%s is not an 8 bits tiled TIFF" % path)
+        self.size = QSize(base.imagewidth, base.imagelength)
+        self.grayscale = base.samplesperpixel == 1
+        self.pages = {}                     # level -> page
+        for series in self.tif.series[0].levels:
+            page = series.keyframe
+            level = int(round(math.log(base.imagewidth / float(page.imagewidth), 2)))
+            size = levelSize(self.size, level)
+            # Reduced levels may be rounded down
+            if page.is_tiled and abs(size.width() - page.imagewidth) <= 1 \
+                    and abs(size.height() - page.imagelength) <= 1 \
+                    and page.samplesperpixel == base.samplesperpixel:
+                self.pages.setdefault(level, page)
+
+    def hasLevel(self, level):
+        return level in self.pages
+
+    def close(self):
+        with self.lock:
+            self.tif.close()
+
+    def readTile(self, page, index):
+        """ (h, w, samples) array of the tile `index` of `page` """
+        with self.lock:
+            self.tif.filehandle.seek(page.dataoffsets[index])
+            data = self.tif.filehandle.read(page.databytecounts[index])
+        return page.decode(data, index, jpegtables=page.jpegtables)[0][0]
+
+    def read(self, level, rect, step=1):
+        """
+        QImage of `rect`, in the pixels of `level`, keeping every `step`-th pixel
+        and row. The tiles without any kept pixel are not decoded.
+        """
+        page = self.pages[level]
+        tw, th = page.tilewidth, page.tilelength
+        across = -(-page.imagewidth // tw)
+        x1, y1 = rect.x(), rect.y()
+        x2 = min(rect.x() + rect.width(), page.imagewidth)
+        y2 = min(rect.y() + rect.height(), page.imagelength)
+        out = np.zeros((-(-rect.height() // step), -(-rect.width() // step), page.samplesperpixel), np.uint8)
+        # First kept pixel of a tile, the kept ones are at x1 + k * step
+        firstX = lambda tx: x1 + -(-(max(x1, tx) - x1) // step) * step
+        firstY = lambda ty: y1 + -(-(max(y1, ty) - y1) // step) * step
+        for row in range(y1 // th, (y2 - 1) // th + 1):
+            ty = row * th
+            ay1, ay2 = firstY(ty), min(y2, ty + th)
+            if ay1 >= ay2:
+                continue
+            for col in range(x1 // tw, (x2 - 1) // tw + 1):
+                tx = col * tw
+                ax1, ax2 = firstX(tx), min(x2, tx + tw)
+                index = row * across + col
+                if ax1 >= ax2 or not page.databytecounts[index]:
+                    continue
+                part = self.readTile(page, index)[ay1 - ty:ay2 - ty:step, ax1 - tx:ax2 - tx:step]
+                oy, ox = (ay1 - y1) // step, (ax1 - x1) // step
+                out[oy:oy + part.shape[0], ox:ox + part.shape[1]] = part
+        return arrayImage(out)
+
+    def finerLevel(self, level):
+        """ The stored level to read `level` from, with step 2^(level - finer level) """
+        return max(k for k in self.pages if k < level)
+
+
+def openTiled(path):
+    """ TiledImage of `path` if it is larger than TILED_PIXELS and can be read by parts, else None """
+    reader = None
+    if tifffile is not None and path.lower().endswith(TIFF_EXT):
+        try:
+            reader = TiffTileReader(path)
+        except (OSError, ValueError):
+            pass
+    if reader is None:
+        try:
+            reader = QtTileReader(path)
+        except ValueError:
+            return None
+    if reader.size.width() * reader.size.height() <= TILED_PIXELS:
+        reader.close()
+        return None
+    return TiledImage(reader)
+
+
+class _TileTask(QRunnable):
+
+    def __init__(self, func, level, row, cols):
+        super(_TileTask, self).__init__()
+        self.func = func
+        self.level = level
+        self.row = row
+        self.cols = cols
+        self.started = False
+        self.cancelled = False
+
+    def run(self):
+        self.func(self)
+
+
+class TiledImage(QObject):
+    # Emitted from the worker threads when tiles were decoded
+    tileReady = pyqtSignal()
+
+    def __init__(self, reader, cacheSize=TILE_CACHE_SIZE, parent=None):
+        super(TiledImage, self).__init__(parent)
+        self.reader = reader
+        self.topLevel = 0           # The level of a single tile
+        while max(self.width(), self.height()) > TILE_SIZE << self.topLevel:
+            self.topLevel += 1
+        self.cache = LRUCache(cacheSize)    # (level, col, row) -> QImage
+        self.pinned = {}                    # The same for the levels from `pinnedLevel`
+        self.pinnedLevel = max(0, self.topLevel - PINNED_LEVELS + 1)
+        self.pending = {}                   # (level, row) -> _TileTask
+        self.lock = threading.Lock()
+        self.cancelled = False
+
+    # QImage-like, so the main window can use it as its image
+
+    def width(self):
+        return self.reader.size.width()
+
+    def height(self):
+        return self.reader.size.height()
+
+    def size(self):
+        return QSize(self.reader.size)
+
+    def isNull(self):
+        return False
+
+    def isGrayscale(self):
+        return self.reader.grayscale
+
+    def pixelColor(self, x, y):
+        """ Color at (x, y) read from the finest cached tile, black if none is cached """
+        x, y = int(x), int(y)
+        for level in range(self.topLevel + 1):
+            span = TILE_SIZE << level
+            image = self.cached((level, x // span, y // span))
+            if image is not None:
+                return image.pixelColor(min((x % span) >> level, image.width() - 1),
+                                        min((y % span) >> level, image.height() - 1))
+        return QColor(0, 0, 0)
+
+    def cached(self, key):
+        """ Decoded tile (level, col, row), None if it is not cached """
+        if key[0] >= self.pinnedLevel:
+            return self.pinned.get(key)
+        return self.cache.get(key)
+
+    def keep(self, key, image):
+        if key[0] >= self.pinnedLevel:
+            self.pinned[key] = image
+        else:
+            self.cache.put(key, image)
+
+    def levelFor(self, scale):
+        """ The coarsest level with at least `scale` of the full resolution """
+        level = int(math.floor(math.log(1.0 / scale, 2) + 1e-9)) if scale < 1 else 0
+        return max(0, min(level, self.topLevel))
+
+    def tileRect(self, level, col, row):
+        """ Area of a tile, in image pixels """
+        span = TILE_SIZE << level
+        x, y = col * span, row * span
+        return QRectF(x, y, min(span, self.width() - x), min(span, self.height() - y))
+
+    def tiles(self, level, rect):
+        """
+        [(target, image, source)] drawing the part `rect` (image pixels) of the image
+        from the tiles of `level`: target in image pixels, source in pixels of `image`.
+        The missing tiles are requested and drawn from a coarser cached tile meanwhile.
+        """
+        span = TILE_SIZE << level
+        c1, r1 = max(0, int(rect.left()) // span), max(0, int(rect.top()) // span)
+        c2 = min(int(math.ceil(rect.right())), self.width() - 1) // span
+        r2 = min(int(math.ceil(rect.bottom())), self.height() - 1) // span
+        parts = []
+        missing = {}
+        for row in range(r1, r2 + 1):
+            for col in range(c1, c2 + 1):
+                image = self.cached((level, col, row))
+                if image is not None:
+                    parts.append((self.tileRect(level, col, row), image,
+                                  QRectF(0, 0, image.width(), image.height())))
+                    continue
+                missing.setdefault((level, row), []).append(col)
+                coarser = self.coarserTile(level, col, row)
+                if coarser is not None:
+                    parts.append(coarser)
+        # The single tile of the top level is the fallback of all the others, requested
+        # once: it is pinned when decoded, and request() keeps it while pending
+        if self.cached((self.topLevel, 0, 0)) is None and (self.topLevel, 0) not in self.pending:
+            missing.setdefault((self.topLevel, 0), [0])
+        self.request(missing)
+        return parts
+
+    def coarserTile(self, level, col, row):
+        """ (target, image, source) drawing a tile of `level` from a cached tile of a coarser level """
+        target = self.tileRect(level, col, row)
+        for k in range(level + 1, self.topLevel + 1):
+            shift = k - level
+            image = self.cached((k, col >> shift, row >> shift))
+            if image is None:
+                continue
+            origin = self.tileRect(k, col >> shift, row >> shift).topLeft()
+            f = 1.0 / (1 << k)
+            return target, image, QRectF((target.x() - origin.x()) * f, (target.y() - origin.y()) * f,
+                                         target.width() * f, target.height() * f)
+        return None
+
+    def request(self, missing):
+        """
+        Decode the tiles {(level, row): [col]} in the background, coarsest first.
+        Queued requests which are not in `missing` are dropped, they scrolled out of view,
+        except the fallback top level.
+        """
+        with self.lock:
+            for key, task in list(self.pending.items()):
+                if not task.started and key not in missing and key[0] != self.topLevel:
+                    task.cancelled = True
+                    del self.pending[key]
+            for key, cols in missing.items():
+                task = self.pending.get(key)
+                if task is not None:
+                    if not task.started:
+                        task.cols = cols
+                    # Else the rest is requested again by the repaint once it is done
+                    continue
+                task = self.pending[key] = _TileTask(self._decode, key[0], key[1], cols)
+                QThreadPool.globalInstance().start(task, key[0])
+
+    def cancel(self):
+        with self.lock:
+            self.cancelled = True
+            for task in self.pending.values():
+                task.cancelled = True
+            self.pending = {}
+        self.reader.close()
+
+    def _decode(self, task):
+        with self.lock:
+            if task.cancelled:
+                return
+            task.started = True
+            cols = task.cols
+        try:
+            self._decodeRow(task.level, task.row, cols)
+        except Exception as e:
+            # The reader is closed when the image is cancelled
+            if not self.cancelled:
+                print("Tile decode failed: %s" % e)
+        finally:
+            with self.lock:
+                if self.pending.get((task.level, task.row)) is task:
+                    del self.pending[(task.level, task.row)]
+        if not self.cancelled:
+            self.tileReady.emit()
+
+    def _levelRect(self, level, col, row):
+        """ Area of a tile, in pixels of `level` """
+        size = levelSize(self.reader.size, level)
+        x, y = col * TILE_SIZE, row * TILE_SIZE
+        return QRect(x, y, min(TILE_SIZE, size.width() - x), min(TILE_SIZE, size.height() - y))
+
+    def _decodeRow(self, level, row, cols):
+        if not self.reader.hasLevel(level):
+            for col in cols:
+                self._tile(level, col, row)
+            return
+        # One read for the adjacent tiles, a jpeg is decoded from its first row whatever the clip
+        cols = sorted(cols)
+        runs = [[cols[0], cols[0]]]
+        for col in cols[1:]:
+            if col == runs[-1][1] + 1:
+                runs[-1][1] = col
+            else:
+                runs.append([col, col])
+        for first, last in runs:
+            rect = self._levelRect(level, first, row).united(self._levelRect(level, last, row))
+            strip = self.reader.read(level, rect)
+            if strip.isNull():
+                continue
+            for col in range(first, last + 1):
+                tileRect = self._levelRect(level, col, row).translated(-rect.x(), -rect.y())
+                self.keep((level, col, row), strip.copy(tileRect))
+
+    def _tile(self, level, col, row):
+        """ Tile of a level, read from a finer level if the reader does not have it """
+        image = self.cached((level, col, row))
+        if image is not None or self.cancelled:
+            return image
+        rect = self._levelRect(level, col, row)
+        if self.reader.hasLevel(level):
+            image = self.reader.read(level, rect)
+        else:
+            finer = self.reader.finerLevel(level)
+            f = 1 << (level - finer)
+            image = self.reader.read(finer, QRect(rect.x() * f, rect.y() * f, rect.width() * f, rect.height() * f), f)
+        if image.isNull():
+            return None
+        self.keep((level, col, row), image)
+        return image
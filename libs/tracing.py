@@ -0,0 +1,103 @@
+import json
+import os
+import threading
+import time
+from functools import wraps
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+"""
+    Light-weight span tracer for the interactive segmentation pipeline.
+
+    Usage:
+        with tracer.span("preprocess"):
+            ...
+
+    Spans are kept in a bounded buffer and can be summarized for the status bar
+    or exported in the Chrome trace event format (chrome://tracing, Perfetto).
+"""
+
+MAX_EVENTS = 100000
+
+
+class Tracer(object):
+
+    def __init__(self, maxEvents=MAX_EVENTS):
+        self.events = deque(maxlen=maxEvents)
+        self.lock = threading.Lock()
+        self.count = 0      # Number of spans recorded since the last reset
+        self.origin = time.perf_counter()
+
+    def reset(self):
+        with self.lock:
+            self.events.clear()
+            self.count = 0
+            self.origin = time.perf_counter()
+
+    @contextmanager
+    def span(self, name, **args):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            end = time.perf_counter()
+            event = (name, start - self.origin, end - start, threading.get_ident(), args)
+            with self.lock:
+                self.events.append(event)
+                self.count += 1
+
+    def mark(self):
+        """ Return a marker which can be passed to summary() """
+        with self.lock:
+            return self.count
+
+    def summary(self, mark=0):
+        """
+            Return an OrderedDict {name: total milliseconds} of the spans recorded
+            after `mark`, in order of their first appearance.
+        """
+        with self.lock:
+            n = min(self.count - mark, len(self.events))
+            events = list(self.events)[len(self.events) - n:] if n > 0 else []
+        # Spans are appended when they are closed, so sort them by start time
+        events.sort(key=lambda e: e[1])
+        total = OrderedDict()
+        for name, _, dur, _, _ in events:
+            total[name] = total.get(name, 0.) + dur * 1000
+        return total
+
+    def exportChrome(self, path):
+        """ Dump all the recorded spans to `path` as Chrome trace JSON """
+        pid = os.getpid()
+        with self.lock:
+            events = list(self.events)
+        traceEvents = []
+        for name, start, dur, tid, args in events:
+            traceEvents.append({
+                "name": name,
+                "cat": "seg",
+                "ph": "X",
+                "ts": round(start * 1e6, 3),
+                "dur": round(dur * 1e6, 3),
+                "pid": pid,
+                "tid": tid,
+                "args": {k: str(v) for k, v in args.items()},
+            })
+        with open(path, "w") as f:
+            json.dump({"traceEvents": traceEvents, "displayTimeUnit": "ms"}, f)
+        return len(traceEvents)
+
+
+tracer = Tracer()
+span = tracer.span
+
+
+def traced(name):
+    """ Decorator version of `span` """
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
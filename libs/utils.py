@@ -1,8 +1,10 @@
+from collections import OrderedDict
 from math import sqrt
 from libs.ustr import ustr
 import hashlib
 import re
 import sys
+import threading
 
 try:
     from PyQt5.QtGui import *
@@ -85,6 +87,82 @@ def generateColorByText(text):
     b = int((hashCode / 16581375)  % 255)
     return QColor(r, g, b, 100)
 
+
+class LRUCache(object):
+    """ Thread-safe dict which keeps the `capacity` most recently used items """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.items = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        with self.lock:
+            self.items[key] = value
+            self.items.move_to_end(key)
+            while len(self.items) > self.capacity:
+                self.items.popitem(last=False)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+
+
+class LabelColors(object):
+    """
+    Memoized generateColorByText() of the `capacity` most recently used labels.
+    Colors set by the user override the generated ones.
+    """
+
+    def __init__(self, capacity=1024):
+        self.capacity = capacity
+        self.cache = OrderedDict()
+        self.userColors = {}
+
+    def get(self, label):
+        color = self.cache.get(label)
+        if color is not None:
+            self.cache.move_to_end(label)
+            return color
+        color = self.userColors.get(label)
+        if color is None:
+            color = generateColorByText(label)
+        self.cache[label] = color
+        if len(self.cache) > self.capacity:
+            self.cache.popitem(last=False)
+        return color
+
+    def setColor(self, label, color):
+        """ Override the color of `label`, None restores the generated one """
+        if color is None:
+            self.userColors.pop(label, None)
+        else:
+            self.userColors[label] = QColor(color)
+        self.cache.pop(label, None)
+
+    def palette(self):
+        """ {label: (r, g, b, a)} of the user colors, for the settings """
+        return {label: color.getRgb() for label, color in self.userColors.items()}
+
+    def setPalette(self, palette):
+        self.userColors = {label: QColor(*rgba) for label, rgba in palette.items()}
+        self.cache.clear()
+
+
+labelColors = LabelColors()
+
+
 def have_qstring():
     '''p3/qt5 get rid of QString wrapper as py3 has native unicode str type'''
     return not (sys.version_info.major >= 3 or QT_VERSION_STR.startswith('5.'))
@@ -92,12 +170,18 @@ def have_qstring():
 def util_qt_strlistclass():
     return QStringList if have_qstring() else list
 
+_DIGITS = re.compile('([0-9]+)')
+
+
+def natural_sort_key(s):
+    """
+    Key of the natural alphanumeric order, 'img10' -> ('img', 10, '')
+    """
+    return tuple(int(c) if i % 2 else c for i, c in enumerate(_DIGITS.split(s)))
+
+
 def natural_sort(list, key=lambda s:s):
     """
     Sort the list into natural alphanumeric order.
     """
-    def get_alphanum_key_func(key):
-        convert = lambda text: int(text) if text.isdigit() else text
-        return lambda s: [convert(c) for c in re.split('([0-9]+)', key(s))]
-    sort_key = get_alphanum_key_func(key)
-    list.sort(key=sort_key)
+    list.sort(key=lambda s: natural_sort_key(key(s)))
@@ -0,0 +1,26 @@
+try:
+    from PyQt5.QtCore import QPointF
+except ImportError:
+    from PyQt4.QtCore import QPointF
+
+from libs.shape import Shape, Point
+
+"""
+    Shape factories shared by the tests.
+"""
+
+
+def makeRect(x1, y1, x2, y2, z1=None, z2=None, label='rect'):
+    shape = Shape(label=label)
+    for x, y in [(x1, y1), (x2, y1), (x2, y2), (x1, y2)]:
+        shape.addPoint(QPointF(x, y))
+    shape.close()
+    if z1 is not None:
+        shape.z1, shape.z2 = z1, z2
+    return shape
+
+
+def makePoint(x, y, fg=True, label='point'):
+    shape = Point(label=label, foreground=fg)
+    shape.addPoint(QPointF(x, y))
+    return shape
@@ -0,0 +1,109 @@
+import unittest
+
+try:
+    from PyQt5.QtCore import QPointF
+except ImportError:
+    from PyQt4.QtCore import QPointF
+
+from libs.annotationStore import AnnotationStore
+from libs.shape import Shape
+from tests.shapes import makeRect, makePoint
+
+try:
+    from libs.image3d import gather_seg_inputs
+except ImportError:
+    gather_seg_inputs = None
+
+
+class TestAnnotationStore(unittest.TestCase):
+
+    def setUp(self):
+        self.store = AnnotationStore()
+        self.rect = makeRect(10, 20, 110, 220, 3, 9)
+        self.fg = makePoint(50.7, 60.2)
+        self.bg = makePoint(70, 80, fg=False)
+        self.store.add(self.rect, 0, 5)
+        self.store.add(self.fg, 0, 5)
+        # Beyond the 10000 slices of the former integer keys
+        self.store.add(self.bg, 2, 12000)
+
+    def test_slices(self):
+        store = self.store
+        self.assertEqual(store.shapes(0, 5), [self.rect, self.fg])
+        self.assertIs(store.shapes(0, 5), store.shapes(0, 5))
+        self.assertEqual(store.shapes(1, 0), [])
+        self.assertEqual([key for key, _ in store.items()], [(0, 5), (2, 12000)])
+        self.assertEqual(store.place(self.bg), (2, 12000))
+        self.assertEqual(len(store), 3)
+
+    def test_writeThrough(self):
+        self.rect.moveBy(QPointF(5, 5))
+        self.rect.z2 = 12
+        self.fg.fg = False
+        self.fg.label = 'tumor'
+        rect = self.store.columns(Shape.RECTANGLE)[0]
+        self.assertEqual((rect['x1'], rect['y1'], rect['x2'], rect['y2'], rect['z1'], rect['z2']),
+                         (15, 25, 115, 225, 3, 12))
+        points = self.store.columns(Shape.POINT)
+        self.assertEqual(list(points['fg']), [False, False])
+        self.assertEqual(self.store.labels[points['label'][0]], 'tumor')
+
+        self.bg.visible = False
+        self.assertEqual(len(self.store.columns(Shape.POINT, visibleOnly=True)), 1)
+
+    def test_remove(self):
+        self.assertEqual(self.store.remove(self.fg), (0, 5))
+        self.assertEqual(self.store.shapes(0, 5), [self.rect])
+        self.assertEqual(len(self.store.columns(Shape.POINT)), 1)
+        # No longer written through
+        self.fg.fg = False
+        self.assertRaises(ValueError, self.store.remove, self.fg)
+
+    def test_compact(self):
+        points = [makePoint(i, i) for i in range(3000)]
+        for point in points:
+            self.store.add(point, 1, 1)
+        for point in points[:2500]:
+            self.store.remove(point)
+        # Compacted once the removed rows outnumbered the alive ones
+        self.assertEqual((self.store.counts[Shape.POINT], self.store.removed[Shape.POINT]), (1500, 998))
+        points[-1].label = 'last'
+        columns = self.store.columns(Shape.POINT)
+        self.assertEqual(len(columns), 502)
+        self.assertEqual((columns['x'][-1], self.store.labels[columns['label'][-1]]), (2999, 'last'))
+
+    def test_activeRect(self):
+        later = makeRect(0, 0, 10, 10, 1, 2)
+        self.store.add(later, 1, 0)
+        self.assertEqual(self.store.activeRect()['z2'], 2)
+        later.visible = False
+        self.assertEqual(self.store.activeRect()['z2'], 9)
+        later.visible = True
+        self.store.remove(later)
+        self.assertEqual(self.store.activeRect()['z2'], 9)
+        self.store.remove(self.rect)
+        self.assertIsNone(self.store.activeRect())
+
+    def test_guides(self):
+        guides = self.store.guides()
+        self.assertEqual(guides['fg'].tolist(), [[5, 60, 50]])
+        self.assertEqual(guides['bg'].tolist(), [[12000, 80, 70]])
+        # Cached until a point changes
+        self.rect.z1 = 4
+        self.assertIs(self.store.guides(), guides)
+        self.fg.moveBy(QPointF(10, 0))
+        self.bg.fg = True
+        self.assertEqual(self.store.guides()['fg'].tolist(), [[5, 60, 60], [12000, 80, 70]])
+        self.store.remove(self.fg)
+        self.assertEqual(self.store.guides()['fg'].tolist(), [[12000, 80, 70]])
+
+    @unittest.skipIf(gather_seg_inputs is None, "libs.image3d dependencies are not installed")
+    def test_gatherSegInputs(self):
+        bbox, centers, stddevs = gather_seg_inputs(self.store, 5.)
+        self.assertEqual(bbox, [3, 20, 10, 10, 220, 110])
+        self.assertEqual(centers['fg'].tolist(), [[5, 60, 50]])
+        self.assertEqual(centers['bg'].tolist(), [[12000, 80, 70]])
+        self.assertEqual(stddevs['fg'].tolist(), [[2., 5., 5.]])
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+import csv
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import nibabel as nib
+
+try:
+    from libs import batch_eval
+except ImportError:
+    batch_eval = None
+
+
+def writeMask(path, mask, spacing=(1., 1., 1.)):
+    nib.save(nib.Nifti1Image(mask.astype(np.uint8), np.diag(list(spacing) + [1.])), path)
+
+
+@unittest.skipIf(batch_eval is None, "libs.image3d dependencies are not installed")
+class TestBatchEval(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.predDir = os.path.join(self.dir, "pred")
+        self.refDir = os.path.join(self.dir, "ref")
+        os.mkdir(self.predDir)
+        os.mkdir(self.refDir)
+        ref = np.zeros((6, 6, 10), np.uint8)
+        ref[1:5, 1:5, 0:6] = 1
+        pred = np.zeros((6, 6, 10), np.uint8)
+        pred[1:5, 1:5, 2:8] = 1
+        writeMask(os.path.join(self.predDir, "case_img1.nii.gz"), pred, (2., 1., 1.))
+        writeMask(os.path.join(self.refDir, "case_mask1.nii.gz"), ref, (2., 1., 1.))
+        writeMask(os.path.join(self.predDir, "volume-2.nii"), ref)
+        writeMask(os.path.join(self.refDir, "segmentation-2.nii"), ref)
+        # No reference, a reference of another shape and a file which is not a volume
+        writeMask(os.path.join(self.predDir, "img3.nii.gz"), ref)
+        writeMask(os.path.join(self.predDir, "img4.nii.gz"), ref)
+        writeMask(os.path.join(self.refDir, "mask4.nii.gz"), ref[:, :, :5])
+        writeMask(os.path.join(self.refDir, "mask5.nii.gz"), ref)
+        open(os.path.join(self.predDir, "notes.txt"), "w").close()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_pairCases(self):
+        pairs, missing = batch_eval.pairCases(self.predDir, self.refDir)
+        self.assertEqual([(os.path.basename(p), os.path.basename(r)) for p, r in pairs],
+                         [("case_img1.nii.gz", "case_mask1.nii.gz"), ("img4.nii.gz", "mask4.nii.gz"),
+                          ("volume-2.nii", "segmentation-2.nii")])
+        self.assertEqual(missing, ["img3.nii.gz"])
+
+    def test_evaluateOne(self):
+        row = batch_eval.evaluateOne(os.path.join(self.predDir, "case_img1.nii.gz"),
+                                     os.path.join(self.refDir, "case_mask1.nii.gz"))
+        # TP 64, FP 32, FN 32, the shift of 2 voxels is along the 1 mm axis
+        self.assertEqual(row["case"], "case_img1.nii.gz")
+        self.assertEqual((row["dice"], row["vd"], row["rvd"]), (0.6667, 0., 64 / 192))
+        self.assertEqual(row["hd"], 2.)
+        self.assertRaises(ValueError, batch_eval.evaluateOne, os.path.join(self.predDir, "img4.nii.gz"),
+                          os.path.join(self.refDir, "mask4.nii.gz"))
+
+    def test_csvSink(self):
+        output = os.path.join(self.dir, "metrics.csv")
+        sink = batch_eval.CsvSink(output)
+        sink.write({"case": "a", "dice": 1., "vd": 0., "rvd": 0., "hd": 0., "assd": 0.})
+        # Rows are readable before the sink is closed
+        with open(output) as f:
+            self.assertEqual(len(list(csv.DictReader(f))), 1)
+        sink.close()
+
+    def test_main(self):
+        output = os.path.join(self.dir, "metrics.csv")
+        # The case of another shape fails, the others are written
+        self.assertEqual(batch_eval.main([self.predDir, self.refDir, "-o", output, "-j", "2"]), 1)
+        with open(output) as f:
+            rows = sorted(csv.DictReader(f), key=lambda row: row["case"])
+        self.assertEqual([row["case"] for row in rows], ["case_img1.nii.gz", "volume-2.nii"])
+        self.assertEqual(list(rows[0]), batch_eval.FIELDS)
+        self.assertEqual((float(rows[1]["dice"]), float(rows[1]["hd"])), (1., 0.))
+
+if __name__ == '__main__':
+    unittest.main()
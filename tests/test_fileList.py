@@ -0,0 +1,162 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+try:
+    from PyQt5.QtCore import QPersistentModelIndex, Qt
+except ImportError:
+    from PyQt4.QtCore import QPersistentModelIndex, Qt
+
+from libs.fileList import DirScanner, FileListModel, FileFilterProxyModel
+
+
+class TestDirScanner(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        for name in ['a.png', 'B.JPG', 'notes.txt', 'vol.nii.gz', 'sub/c.png', 'sub/x.nii', 'sub/deep/d.jpeg',
+                     'sub/deep/e.gz', 'sub10/f.png', 'sub2/g.png']:
+            path = os.path.join(self.dir, name)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            open(path, 'w').close()
+        # Symbolic links to directories are not followed
+        os.symlink(os.path.join(self.dir, 'sub'), os.path.join(self.dir, 'link'))
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def scan(self, batchSize=1000):
+        scanner = DirScanner(self.dir, ['.png', '.jpg', '.jpeg'], ['.nii', '.nii.gz'], batchSize)
+        batches = []
+        scanner.found.connect(batches.append, Qt.DirectConnection)
+        scanner.start()
+        self.assertTrue(scanner.wait(5000))
+        return batches
+
+    def test_found(self):
+        batches = self.scan()
+        self.assertEqual(len(batches), 1)
+        found = sorted((os.path.relpath(path, self.dir), is3d) for path, is3d in batches[0])
+        self.assertEqual(found, [('B.JPG', False), ('a.png', False), ('sub/c.png', False),
+                                 ('sub/deep/d.jpeg', False), ('sub/x.nii', True), ('sub10/f.png', False),
+                                 ('sub2/g.png', False), ('vol.nii.gz', True)])
+        self.assertTrue(all(os.path.isabs(path) for path, _ in batches[0]))
+
+    def test_batches(self):
+        batches = self.scan(batchSize=2)
+        # Emitted after each directory once the batch is full, the rest at the end
+        self.assertEqual(sum(len(batch) for batch in batches), 8)
+        self.assertTrue(all(len(batch) >= 2 for batch in batches[:-1]))
+        self.assertEqual([os.path.relpath(os.path.dirname(path), self.dir) for path, _ in batches[0]],
+                         ['.'] * 3)
+        # Sub-directories in natural order
+        dirs = [os.path.relpath(os.path.dirname(path), self.dir) for batch in batches[1:] for path, _ in batch]
+        self.assertEqual(dirs, ['sub', 'sub', 'sub/deep', 'sub2', 'sub10'])
+
+    def test_missing(self):
+        shutil.rmtree(self.dir)
+        self.assertEqual(self.scan(), [])
+        os.mkdir(self.dir)
+        self.assertEqual(self.scan(), [])
+
+
+class TestFileListModel(unittest.TestCase):
+
+    def setUp(self):
+        self.model = FileListModel()
+        self.model.addPaths([('/d/img10.png', False), ('/d/vol1.nii', True), ('/d/img2.png', False)])
+
+    def assertRows(self, model):
+        self.assertEqual(model.rows, {path: i for i, path in enumerate(model.paths)})
+        for i, path in enumerate(model.paths):
+            self.assertEqual(model.indexOf(path), i)
+
+    def test_sorted(self):
+        model = self.model
+        # Natural order, 2d images before 3d images
+        self.assertEqual(model.paths, ['/d/img2.png', '/d/img10.png', '/d/vol1.nii'])
+        self.assertEqual(model.rowCount(), 3)
+        self.assertEqual(model.data(model.index(1)), '/d/img10.png')
+        self.assertEqual(model.indexOf('/d/img3.png'), -1)
+        self.assertRows(model)
+
+    def test_append(self):
+        model = self.model
+        inserted = []
+        model.rowsInserted.connect(lambda parent, first, last: inserted.append((first, last)))
+        model.addPaths([('/d/vol12.nii', True), ('/d/vol2.nii', True)])
+        self.assertEqual(model.paths[3:], ['/d/vol2.nii', '/d/vol12.nii'])
+        self.assertEqual(inserted, [(3, 4)])
+        model.addPaths([])
+        self.assertEqual(inserted, [(3, 4)])
+        self.assertRows(model)
+
+    def test_merge(self):
+        model = self.model
+        model.setCurrentRow(model.indexOf('/d/img10.png'))
+        persistent = QPersistentModelIndex(model.index(model.indexOf('/d/vol1.nii')))
+        model.addPaths([('/d/img11.png', False), ('/d/IMG1.png', False), ('/d/vol0.nii', True)])
+        self.assertEqual(model.paths, ['/d/IMG1.png', '/d/img2.png', '/d/img10.png', '/d/img11.png',
+                                       '/d/vol0.nii', '/d/vol1.nii'])
+        self.assertRows(model)
+        # The opened image and the selection follow their paths
+        self.assertEqual(model.currentRow, 2)
+        self.assertTrue(model.data(model.index(2), Qt.FontRole).bold())
+        self.assertIsNone(model.data(model.index(1), Qt.FontRole))
+        self.assertEqual(persistent.row(), 5)
+
+    def test_clear(self):
+        self.model.setCurrentRow(0)
+        self.model.clear()
+        self.assertEqual((self.model.rowCount(), self.model.rows, self.model.currentRow), (0, {}, -1))
+
+
+class TestFileFilterProxyModel(unittest.TestCase):
+
+    def setUp(self):
+        self.model = FileListModel()
+        self.model.addPaths([('/d/img%d.png' % i, False) for i in range(5)])
+        self.proxy = FileFilterProxyModel()
+        self.proxy.setSourceModel(self.model)
+
+    def shown(self):
+        return [self.proxy.data(self.proxy.index(row, 0)) for row in range(self.proxy.rowCount())]
+
+    def test_setFilter(self):
+        proxy = self.proxy
+        self.assertFalse(proxy.isActive())
+        self.assertEqual(len(self.shown()), 5)
+        proxy.setFilter({'/d/img1.png', '/d/img3.png'})
+        self.assertTrue(proxy.isActive())
+        self.assertEqual(self.shown(), ['/d/img1.png', '/d/img3.png'])
+        proxy.setFilter({'/d/img1.png', '/d/img3.png'}, exclude=True)
+        self.assertEqual(self.shown(), ['/d/img0.png', '/d/img2.png', '/d/img4.png'])
+        proxy.setFilter(None)
+        self.assertEqual(len(self.shown()), 5)
+
+    def test_setContains(self):
+        proxy = self.proxy
+        proxy.setFilter({'/d/img1.png'})
+        proxy.setContains('/d/img4.png', True)
+        proxy.setContains('/d/img1.png', False)
+        self.assertEqual(self.shown(), ['/d/img4.png'])
+        # Paths added later are filtered when they are inserted
+        self.model.addPaths([('/d/img5.png', False)])
+        proxy.setContains('/d/img6.png', True)
+        self.model.addPaths([('/d/img6.png', False)])
+        self.assertEqual(self.shown(), ['/d/img4.png', '/d/img6.png'])
+
+        # The paths of an excluding filter are hidden
+        proxy.setFilter({'/d/img4.png'}, exclude=True)
+        proxy.setContains('/d/img0.png', True)
+        proxy.setContains('/d/img4.png', False)
+        self.assertEqual(self.shown(), ['/d/img%d.png' % i for i in range(1, 7)])
+        # Without a filter nothing is tracked
+        proxy.setFilter(None)
+        proxy.setContains('/d/img0.png', True)
+        self.assertIsNone(proxy.paths)
+        self.assertEqual(len(self.shown()), 7)
+
+if __name__ == '__main__':
+    unittest.main()
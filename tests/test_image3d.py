@@ -0,0 +1,297 @@
+import unittest
+from types import SimpleNamespace
+from unittest import mock
+
+import numpy as np
+from scipy import ndimage as ndi
+
+try:
+    from libs import image3d
+except ImportError:
+    image3d = None
+
+
+def postprocessLoop(mask, slice_idx, min_size=10):
+    """ The former implementation: one find_objects loop, holes filled on one slice """
+    labeled, n_objs = ndi.label(mask)
+    slices = ndi.find_objects(labeled)
+    for i, sli in enumerate(slices, start=1):
+        patch = labeled[sli] == i
+        if np.count_nonzero(patch) < min_size:
+            labeled[sli] -= patch * i
+    labeled = np.clip(labeled, 0, 1)
+    struct = ndi.generate_binary_structure(2, 1)
+    labeled[slice_idx] = ndi.binary_fill_holes(labeled[slice_idx], struct)
+    return labeled
+
+
+def labelledVolume():
+    """ Two large objects with holes, two small ones and a 10 voxel one """
+    mask = np.zeros((6, 24, 24), np.uint8)
+    mask[1:5, 2:10, 2:10] = 1
+    mask[3, 5:7, 5:7] = 0           # Hole inside one slice
+    mask[1:5, 12:20, 12:22] = 1
+    mask[2, 15, 15] = 0
+    mask[0, 22, 0:3] = 1            # 3 voxels
+    mask[5, 0, 20:23] = 1
+    mask[5, 0, 23] = 1              # 4 voxels, separate from the above
+    mask[0:2, 0, 12:17] = 1         # 10 voxels, kept
+    return mask
+
+
+class ConstantClient(object):
+    """ Serving client whose logits favour the foreground everywhere """
+
+    def __init__(self):
+        self.shapes = []
+
+    def predict(self, image, guide, name):
+        self.shapes.append(image.shape)
+        logits = np.zeros(guide.shape, np.float32)
+        logits[..., 1] = 1
+        return logits
+
+
+class IdentityClient(object):
+    """ Serving client which returns the guide as the logits, fails for model 'bad' """
+
+    def __init__(self):
+        self.shapes = []
+
+    def predict(self, image, guide, name):
+        self.shapes.append(image.shape)
+        if name == "bad":
+            raise ValueError("bad model")
+        return guide.copy()
+
+
+@unittest.skipIf(image3d is None, "libs.image3d dependencies are not installed")
+class TestPostprocess(unittest.TestCase):
+
+    def setUp(self):
+        self.image = image3d.Image3d.__new__(image3d.Image3d)
+
+    def test_formerImplementation(self):
+        mask = labelledVolume()
+        # Holes on slices 2 and 3: the former code filled one slice per call
+        expected = postprocessLoop(postprocessLoop(mask, 2), 3)
+        result = self.image.postprocess(mask.copy())
+        self.assertEqual(result.dtype, mask.dtype)
+        np.testing.assert_array_equal(result, expected)
+        self.assertEqual(int(result[0, 0, 12:17].sum()), 5)
+        self.assertEqual(int(result[0, 22].sum() + result[5, 0].sum()), 0)
+
+    def test_bbox(self):
+        mask = labelledVolume()
+        mask[:, 0] = 0
+        mask[0, 22] = 0
+        bbox = (slice(1, 5), slice(2, 20), slice(2, 22))
+        whole = self.image.postprocess(mask.copy())
+        result = mask.copy()
+        self.assertIs(self.image.postprocess(result, bbox), result)
+        np.testing.assert_array_equal(result, whole)
+
+    def test_minSize(self):
+        mask = labelledVolume()
+        expected = postprocessLoop(postprocessLoop(mask, 2, min_size=40), 3, min_size=40)
+        np.testing.assert_array_equal(self.image.postprocess(mask.copy(), min_size=40), expected)
+        self.assertFalse(self.image.postprocess(np.zeros((2, 4, 4), np.uint8)).any())
+
+
+@unittest.skipIf(image3d is None, "libs.image3d dependencies are not installed")
+class TestResize(unittest.TestCase):
+
+    def test_centreAligned(self):
+        arr = np.arange(10)
+        for n in [1, 2, 3, 4, 7, 10, 13, 25]:
+            # Output pixel k samples the input pixel under its centre (k + 0.5) * 10 / n
+            expected = np.floor((np.arange(n) + 0.5) * 10 / n).astype(int)
+            np.testing.assert_array_equal(image3d.resize_nearest(arr, (n,)), expected)
+        np.testing.assert_array_equal(image3d.resize_nearest(np.arange(2), (5,)), [0, 0, 1, 1, 1])
+        np.testing.assert_array_equal(image3d.resize_nearest(np.arange(4), (2,)), [1, 3])
+
+    def test_shape(self):
+        arr = np.arange(3 * 8 * 5, dtype=np.uint8).reshape(3, 8, 5)
+        for shape in [(3, 8, 5), (3, 20, 11), (3, 3, 2), (6, 8, 1)]:
+            result = image3d.resize_nearest(arr, shape)
+            self.assertEqual(result.shape, shape)
+            self.assertEqual(result.dtype, arr.dtype)
+        self.assertIs(image3d.resize_nearest(arr, arr.shape), arr)
+
+
+@unittest.skipIf(image3d is None, "libs.image3d dependencies are not installed")
+@mock.patch.object(image3d, "tile_height_", 16)
+@mock.patch.object(image3d, "tile_width_", 16)
+class TestTiling(unittest.TestCase):
+
+    def setUp(self):
+        self.client = IdentityClient()
+        self.batcher = image3d.serving.configure(window=0., client=self.client)
+        self.image = image3d.Image3d.__new__(image3d.Image3d)
+
+    def tearDown(self):
+        self.batcher.close()
+        image3d.serving._batcher = None
+
+    def test_tileStarts(self):
+        for size, tile in [(16, 16), (40, 16), (48, 16), (100, 32), (17, 16)]:
+            starts = image3d.tile_starts(size, tile, 0.25)
+            covered = np.zeros(size, bool)
+            for start in starts:
+                covered[start:start + tile] = True
+            self.assertTrue(covered.all())
+            self.assertEqual((starts[0], starts[-1]), (0, size - tile))
+            self.assertEqual(starts, sorted(set(starts)))
+        self.assertEqual(image3d.tile_starts(40, 16, 0.25), [0, 12, 24])
+
+    def test_gaussianWindow(self):
+        weight = image3d.gaussian_window(15, 12)
+        self.assertEqual(weight.shape, (15, 12))
+        self.assertAlmostEqual(weight[7, 5], weight.max())
+        self.assertAlmostEqual(image3d.gaussian_window(15, 11)[7, 5], 1)
+        self.assertGreater(weight.min(), 0)
+        np.testing.assert_allclose(weight, weight[::-1, ::-1])
+
+    def test_identity(self):
+        guide = np.random.RandomState(0).rand(1, 2, 48, 40, 2).astype(np.float32)
+        image = np.zeros(guide.shape[:-1] + (1,), np.float32)
+        logits = self.image.run_tf_serving_tiled(image, guide, "din")
+        # Every pixel is covered and the blend weights sum to one
+        self.assertEqual(logits.shape, guide.shape)
+        np.testing.assert_allclose(logits, guide, rtol=1e-5)
+        # 4 x 3 tiles of 16 x 16, tile_batch_ per request
+        self.assertEqual([shape[0] for shape in self.client.shapes], [4, 4, 4])
+        self.assertEqual(self.client.shapes[0][1:], (2, 16, 16, 1))
+
+    def test_constant(self):
+        guide = np.ones((1, 1, 30, 50, 2), np.float32)
+        logits = self.image.run_tf_serving_tiled(np.zeros((1, 1, 30, 50, 1), np.float32), guide, "din")
+        np.testing.assert_allclose(logits, 1, rtol=1e-5)
+
+    def test_smallPatch(self):
+        guide = np.random.RandomState(1).rand(1, 1, 8, 12, 2).astype(np.float32)
+        logits = self.image.run_tf_serving_tiled(np.zeros((1, 1, 8, 12, 1), np.float32), guide, "din")
+        np.testing.assert_allclose(logits, guide, rtol=1e-5)
+        self.assertEqual(self.client.shapes, [(1, 1, 8, 12, 1)])
+
+    def test_error(self):
+        guide = np.ones((1, 1, 48, 48, 2), np.float32)
+        self.assertIsNone(self.image.run_tf_serving_tiled(np.zeros((1, 1, 48, 48, 1), np.float32), guide, "bad"))
+
+
+@unittest.skipIf(image3d is None, "libs.image3d dependencies are not installed")
+class TestSegCache(unittest.TestCase):
+
+    def setUp(self):
+        volume = np.random.RandomState(0).randint(0, 200, (4, 40, 400)).astype(np.int16)
+        self.image = image3d.Image3d(volume, SimpleNamespace(unit=1.), "test_segCache.nii")
+        self.client = ConstantClient()
+        self.batcher = image3d.serving.configure(window=0., client=self.client)
+
+    def tearDown(self):
+        self.batcher.close()
+        image3d.serving._batcher = None
+        image3d.patch_cache.clear()
+
+    def test_updateSegCache(self):
+        image = self.image
+        first = (slice(0, 2), slice(5, 15), slice(10, 30))
+        image.updateSegCache(first, 1)
+        self.assertEqual((image.segCache.shape, image.segCache.dtype), (image.shape, np.uint8))
+        self.assertEqual(int(image.segCache.sum()), 2 * 10 * 20)
+        second = (slice(1, 4), slice(0, 4), slice(0, 5))
+        image.updateSegCache(second, np.ones((3, 4, 5), np.uint8))
+        # The region written first is cleared
+        self.assertEqual(int(image.segCache.sum()), 3 * 4 * 5)
+        self.assertTrue(image.segCache[second].all())
+
+    def test_zoomedBbox(self):
+        image = self.image
+        # Wider than max_width_, so the patch is downsampled and the mask resized back
+        bbox = [1, 4, 2, 3, 36, 382]
+        centers = {'fg': np.array([[2, 20, 200]]), 'bg': np.array([[2, 5, 5]])}
+        stddevs = {'fg': np.array([[2., 5., 5.]]), 'bg': np.array([[2., 5., 5.]])}
+        self.assertEqual(image.seg_din(bbox, centers, stddevs, "din"), 0)
+        self.assertEqual(self.client.shapes[0][3], image3d.max_width_)
+        self.assertEqual(image.segCache.shape, image.shape)
+        region = (slice(1, 3), slice(4, 36), slice(2, 382))
+        self.assertTrue(image.segCache[region].all())
+        self.assertEqual(int(image.segCache.sum()), 2 * 32 * 380)
+
+@unittest.skipIf(image3d is None, "libs.image3d dependencies are not installed")
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.whole = (slice(None),) * 3
+
+    def test_overlap(self):
+        ref = np.zeros((1, 1, 10), np.uint8)
+        pred = np.zeros((1, 1, 10), np.uint8)
+        ref[..., 0:6] = 1
+        pred[..., 2:8] = 1
+        # TP 4, FP 2, FN 2
+        dice, vd, rvd = image3d.computeMetrics(ref, pred, self.whole, 0.5)
+        self.assertEqual(dice, 0.6667)
+        self.assertEqual(vd, 0)
+        self.assertAlmostEqual(rvd, 4 / 12)
+
+    def test_underSegmented(self):
+        # Labels other than 1 count as foreground, uint8 must not wrap around
+        ref = np.zeros((2, 2, 2), np.uint8)
+        ref[0] = 2
+        pred = np.zeros((2, 2, 2), np.uint8)
+        pred[0, 0] = 1
+        # TP 2, FP 0, FN 2
+        dice, vd, rvd = image3d.computeMetrics(ref, pred, self.whole, 2.)
+        self.assertEqual(dice, 0.6667)
+        self.assertEqual(vd, 4.)
+        self.assertAlmostEqual(rvd, 2 / 6)
+        dice, vd, rvd = image3d.computeMetrics(pred, ref, self.whole, 2.)
+        self.assertEqual(vd, -4.)
+
+    def test_bbox(self):
+        ref = np.zeros((1, 4, 4), np.uint8)
+        pred = np.ones((1, 4, 4), np.uint8)
+        ref[0, :2, :2] = 1
+        self.assertEqual(image3d.computeMetrics(ref, pred, (slice(None), slice(0, 2), slice(0, 2)), 1.), (1., 0, 0.))
+
+    def test_empty(self):
+        empty = np.zeros((2, 3, 3), np.uint8)
+        full = np.ones((2, 3, 3), np.uint8)
+        self.assertEqual(image3d.computeMetrics(empty, empty, self.whole, 1.), (0., 0, 0.))
+        self.assertEqual(image3d.computeMetrics(full, empty, self.whole, 1.), (0., 18, 1.))
+        self.assertEqual(image3d.computeMetrics(empty, full, self.whole, 1.), (0., -18, 1.))
+        self.assertEqual(image3d.computeMetrics(empty, np.zeros((2, 3, 2)), self.whole, 1.), -1)
+
+    def test_surfaceDistances(self):
+        ref = np.zeros((5, 5, 6), np.uint8)
+        pred = np.zeros((5, 5, 6), np.uint8)
+        ref[1:4, 1:4, 1:4] = 1
+        pred[1:4, 1:4, 2:5] = 1
+        # 26 border voxels per cube: the 9 of the outer face and the centre of the other
+        # cube are 1 voxel away, all the others lie on the other border
+        hd, assd = image3d.computeSurfaceDistances(ref, pred)
+        self.assertEqual(hd, 1.)
+        self.assertAlmostEqual(assd, 20 / 52)
+        hd, assd = image3d.computeSurfaceDistances(ref, pred, spacing=(1., 1., 2.))
+        self.assertEqual(hd, 2.)
+        # The centres are still 1 voxel away along z
+        self.assertAlmostEqual(assd, 38 / 52)
+        self.assertEqual(image3d.computeSurfaceDistances(ref, ref), (0., 0.))
+
+    def test_surfaceDistancesVoxels(self):
+        ref = np.zeros((1, 4, 5), np.uint8)
+        pred = np.zeros((1, 4, 5), np.uint8)
+        ref[0, 0, 0] = 1
+        pred[0, 3, 4] = 1
+        self.assertEqual(image3d.computeSurfaceDistances(ref, pred), (5., 5.))
+
+    def test_surfaceDistancesEmpty(self):
+        empty = np.zeros((3, 3, 3), np.uint8)
+        full = np.ones((3, 3, 3), np.uint8)
+        for ref, pred in [(empty, full), (full, empty), (empty, empty)]:
+            hd, assd = image3d.computeSurfaceDistances(ref, pred)
+            self.assertTrue(np.isnan(hd) and np.isnan(assd))
+
+if __name__ == '__main__':
+    unittest.main()
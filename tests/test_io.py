@@ -1,7 +1,18 @@
 import os
+import shutil
 import sys
+import tempfile
 import unittest
 
+try:
+    from PyQt5.QtCore import Qt
+except ImportError:
+    from PyQt4.QtCore import Qt
+
+from libs.common_io import CommonWriter, CommonReader, CommonReaderError, COMM_EXT, \
+    CommonNpzReader, cxml2npz, npz2cxml, sidecarPath, latestAnnotation
+from libs.shape import Shape
+
 class TestPascalVocRW(unittest.TestCase):
 
     def test_upper(self):
@@ -28,5 +39,108 @@ class TestPascalVocRW(unittest.TestCase):
         self.assertEqual(face[0], 'face')
         self.assertEqual(face[1], [(113, 40), (450, 40), (450, 403), (113, 403)])
 
+class TestCommonRW(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'test' + COMM_EXT)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_readWrite(self):
+        writer = CommonWriter('tests', 'test.nii.gz', (512, 512, 40), localImgPath='tests/test.nii.gz')
+        writer.verified = True
+        writer.addBndBox(60, 40, 430, 504, 'liver', z1=3, z2=20, axis=0, slice=3)
+        writer.addPnt(100, 120, 'liver', fg=True, axis=0, slice=5)
+        writer.addPnt(10, 20, 'tumor', fg=False, axis=0, slice=6)
+        writer.save(self.path)
+
+        reader = CommonReader(self.path)
+        shapes = reader.getShapes()
+        self.assertTrue(reader.verified)
+        self.assertEqual(len(shapes), 3)
+        self.assertEqual(shapes[0]['type'], Shape.RECTANGLE)
+        self.assertEqual(shapes[0]['label'], 'liver')
+        self.assertEqual(shapes[0]['shape'], [(60, 40), (430, 40), (430, 504), (60, 504)])
+        self.assertEqual((shapes[0]['z1'], shapes[0]['z2'], shapes[0]['slice']), (3, 20, 3))
+        self.assertEqual(shapes[1]['shape'], [(100, 120)])
+        self.assertEqual((shapes[1]['fg'], shapes[1]['slice']), (True, 5))
+        self.assertEqual((shapes[2]['label'], shapes[2]['fg']), ('tumor', False))
+
+    def test_malformed(self):
+        writer = CommonWriter('tests', 'test.png', (512, 512, 3))
+        writer.addPnt(1, 2, 'a', fg=True)
+        writer.save(self.path)
+        with open(self.path) as f:
+            text = f.read()
+        with open(self.path, 'w') as f:
+            f.write(text.replace('<y>2</y>', '<y>2</x>'))
+        with self.assertRaisesRegex(CommonReaderError, r'test\.cxml:\d+:'):
+            CommonReader(self.path)
+
+    def test_npzRoundTrip(self):
+        writer = CommonWriter('tests', 'test.nii.gz', (512, 512, 40), localImgPath='tests/test.nii.gz')
+        writer.addBndBox(60, 40, 430, 504, 'liver', z1=3, z2=20, axis=0, slice=3)
+        for i in range(100):
+            writer.addPnt(i, 2 * i, 'tumor' if i % 3 else 'liver', fg=bool(i % 2), axis=0, slice=i % 40)
+        writer.save(self.path)
+
+        cxml2npz(self.path)
+        npzPath = sidecarPath(self.path)
+        self.assertEqual(CommonNpzReader(npzPath).getShapes(), CommonReader(self.path).getShapes())
+        self.assertEqual(latestAnnotation(self.path)[0], npzPath)
+
+        npz2cxml(npzPath, self.path + '2' + COMM_EXT)
+        self.assertEqual(CommonReader(self.path + '2' + COMM_EXT).getShapes(), CommonReader(self.path).getShapes())
+
+class TestAnnotationIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def writeCases(self, labels):
+        paths = []
+        for i, label in enumerate(labels):
+            writer = CommonWriter('tests', 'case%d.nii.gz' % i, (512, 512, 40))
+            if label is not None:
+                writer.addBndBox(60, 40, 430, 504, label, z1=3, z2=20, axis=0, slice=3)
+                writer.addPnt(100, 120, label, fg=True, axis=0, slice=5)
+            paths.append(os.path.join(self.tmpdir, 'case%d' % i + COMM_EXT))
+            writer.save(paths[-1])
+        return paths
+
+    def test_update(self):
+        from libs.annotationIndex import AnnotationIndex
+        paths = self.writeCases(['liver', 'tumor', None])
+        index = AnnotationIndex(self.tmpdir, dbPath=os.path.join(self.tmpdir, 'index.sqlite'))
+        self.assertEqual(index.update(), 3)
+        self.assertEqual(index.labelCounts(), [('liver', 2, 1), ('tumor', 2, 1)])
+        self.assertEqual(index.annotatedFiles(), set(paths[:2]))
+        self.assertEqual(index.filesWithLabel('tumor'), {paths[1]})
+        self.assertEqual(index.fileLabels(paths[1:]), {paths[1]: {'tumor'}, paths[2]: set()})
+        # Unchanged files are not parsed again
+        self.assertEqual(index.update(), 0)
+        os.remove(paths[0])
+        index.update()
+        self.assertEqual(index.filesWithLabel('liver'), set())
+
+    def test_updater(self):
+        from libs.annotationIndex import AnnotationIndex, IndexUpdater
+        paths = self.writeCases(['liver', 'tumor'])
+        index = AnnotationIndex(self.tmpdir, dbPath=os.path.join(self.tmpdir, 'index.sqlite'))
+        updater = IndexUpdater(index, [paths[0]])
+        emitted = []
+        updater.updated.connect(lambda *args: emitted.append(args), Qt.DirectConnection)
+        # Queued onto the same thread
+        self.assertTrue(updater.enqueue([paths[1]]))
+        updater.start()
+        updater.wait()
+        self.assertEqual(emitted, [(2, [('liver', 2, 1), ('tumor', 2, 1)], {paths[0]: {'liver'}, paths[1]: {'tumor'}})])
+        self.assertFalse(updater.enqueue([paths[0]]))
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,49 @@
+import unittest
+
+from libs.labelTable import LabelTableModel
+from libs.shape import Shape, Point
+from libs.utils import labelColors
+
+try:
+    from PyQt5.QtCore import Qt
+except ImportError:
+    from PyQt4.QtCore import Qt
+
+
+class TestLabelTableModel(unittest.TestCase):
+
+    def setUp(self):
+        self.model = LabelTableModel(['Axis', 'Slice', 'Z1', 'Z2', 'Label'])
+        self.rect = Shape(label='liver')
+        self.point = Point(label='tumor')
+        self.model.addShapes([(self.rect, 0, 3), (self.point, 0, 5)])
+
+    def test_addShapes(self):
+        model = self.model
+        self.assertEqual(model.rowCount(), 2)
+        self.assertEqual((self.rect.z1, self.rect.z2), (3, 3))
+        self.assertEqual(model.data(model.index(1, LabelTableModel.SLICE)), '5')
+        self.assertEqual(model.data(model.index(0, LabelTableModel.LABEL)), 'liver')
+        self.assertEqual(model.data(model.index(0, LabelTableModel.LABEL), Qt.CheckStateRole), Qt.Checked)
+        self.assertIs(model.data(model.index(0, 0), Qt.BackgroundRole), labelColors.get('liver'))
+
+    def test_edit(self):
+        model = self.model
+        edited = []
+        model.shapeEdited.connect(lambda shape, col: edited.append((shape, col)))
+        self.assertTrue(model.setData(model.index(0, LabelTableModel.Z2), '9'))
+        self.assertFalse(model.setData(model.index(0, LabelTableModel.Z1), 'x'))
+        self.assertFalse(model.setData(model.index(0, LabelTableModel.AXIS), '1'))
+        self.assertTrue(model.setData(model.index(1, LabelTableModel.LABEL), Qt.Unchecked, Qt.CheckStateRole))
+        self.assertEqual(self.rect.z2, 9)
+        self.assertEqual(model.checked, [True, False])
+        self.assertEqual(edited, [(self.rect, LabelTableModel.Z2), (self.point, LabelTableModel.VISIBLE)])
+
+    def test_removeShape(self):
+        self.model.removeShape(self.rect)
+        self.assertEqual(self.model.rowOf(self.point), 0)
+        self.assertEqual(self.model.rowOf(self.rect), -1)
+        self.assertEqual(self.model.place(self.point), (0, 5))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,146 @@
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+try:
+    from PyQt5.QtGui import QImage, QColor
+except ImportError:
+    from PyQt4.QtGui import QImage, QColor
+
+try:
+    from libs import prefetch
+except ImportError:
+    prefetch = None
+
+
+@unittest.skipIf(prefetch is None, "libs.image3d dependencies are not installed")
+class TestPrefetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.prefetcher = prefetch.Prefetcher()
+
+    def tearDown(self):
+        self.prefetcher.pool.waitForDone()
+        shutil.rmtree(self.dir)
+
+    def png(self, name, w, h, mtime=None):
+        image = QImage(w, h, QImage.Format_RGB32)
+        image.fill(QColor(255, 0, 0))
+        path = os.path.join(self.dir, name)
+        image.save(path, "PNG")
+        if mtime is not None:
+            os.utime(path, ns=(mtime, mtime))
+        return path
+
+    def test_hit(self):
+        path = self.png("a.png", 20, 10)
+        image = self.prefetcher.image(path)
+        self.assertEqual((image.width(), image.height()), (20, 10))
+        self.assertIs(self.prefetcher.cachedImage(path), image)
+        self.assertIs(self.prefetcher.image(path), image)
+
+    def test_miss(self):
+        path = os.path.join(self.dir, "missing.png")
+        self.assertIsNone(self.prefetcher.cachedImage(path))
+        self.assertTrue(self.prefetcher.image(path).isNull())
+        self.assertNotIn(path, self.prefetcher.images)
+
+    def test_invalidation(self):
+        path = self.png("a.png", 20, 10, mtime=10 ** 18)
+        image = self.prefetcher.image(path)
+        # Rewritten under the same path
+        self.png("a.png", 30, 15, mtime=10 ** 18 + 1)
+        self.assertIsNone(self.prefetcher.cachedImage(path))
+        image = self.prefetcher.image(path)
+        self.assertEqual((image.width(), image.height()), (30, 15))
+        self.assertIs(self.prefetcher.cachedImage(path), image)
+        os.remove(path)
+        self.assertIsNone(self.prefetcher.cachedImage(path))
+
+    def test_prefetch(self):
+        paths = [self.png("%d.png" % i, 8 + i, 8) for i in range(3)]
+        self.prefetcher.prefetch([(path, None) for path in paths])
+        self.prefetcher.pool.waitForDone()
+        self.assertEqual([self.prefetcher.cachedImage(path).width() for path in paths], [8, 9, 10])
+        self.assertEqual(self.prefetcher.pending, {})
+
+        # Only the changed image is loaded again
+        self.png("1.png", 5, 5, mtime=os.stat(paths[1]).st_mtime_ns + 10 ** 9)
+        cached = self.prefetcher.cachedImage(paths[0])
+        self.prefetcher.prefetch([(path, None) for path in paths])
+        self.prefetcher.pool.waitForDone()
+        self.assertIs(self.prefetcher.cachedImage(paths[0]), cached)
+        self.assertEqual(self.prefetcher.cachedImage(paths[1]).width(), 5)
+
+
+class FakeLoader(object):
+    """ Stands for read3d, records the paths read and blocks until `release` is set """
+
+    def __init__(self):
+        self.loaded = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def __call__(self, path):
+        self.release.wait(5)
+        self.loaded.append(path)
+        if path.startswith("bad"):
+            raise IOError("cannot read " + path)
+        return "volume of " + path
+
+
+@unittest.skipIf(prefetch is None, "libs.image3d dependencies are not installed")
+class TestVolumePrefetcher(unittest.TestCase):
+
+    def setUp(self):
+        self.loader = FakeLoader()
+        patcher = mock.patch.object(prefetch, "read3d", self.loader)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def prefetcher(self, capacity):
+        prefetcher = prefetch.VolumePrefetcher(capacity)
+        self.addCleanup(prefetcher.executor.shutdown)
+        return prefetcher
+
+    def test_dedupe(self):
+        prefetcher = self.prefetcher(2)
+        prefetcher.prefetch(["a", "b"])
+        prefetcher.prefetch(["a", "b"])
+        self.assertEqual(prefetcher.take("a"), "volume of a")
+        self.assertEqual(prefetcher.take("b"), "volume of b")
+        self.assertEqual(self.loader.loaded, ["a", "b"])
+        # Taken once, then read by the caller
+        self.assertIsNone(prefetcher.take("a"))
+
+    def test_neighbours(self):
+        prefetcher = self.prefetcher(1)
+        # Only the first `capacity` neighbours are read
+        prefetcher.prefetch(["b", "c", "d"])
+        self.assertEqual(list(prefetcher.futures), ["b"])
+        self.assertEqual(prefetcher.take("b"), "volume of b")
+        self.assertIsNone(prefetcher.take("c"))
+        self.assertEqual(self.loader.loaded, ["b"])
+
+    def test_dropped(self):
+        prefetcher = self.prefetcher(2)
+        self.loader.release.clear()
+        prefetcher.prefetch(["a", "b"])
+        # "b" is still queued behind "a" and no longer a neighbour
+        prefetcher.prefetch(["a", "c"])
+        self.loader.release.set()
+        self.assertEqual(prefetcher.take("c"), "volume of c")
+        self.assertEqual(self.loader.loaded, ["a", "c"])
+        self.assertIsNone(prefetcher.take("b"))
+
+    def test_error(self):
+        prefetcher = self.prefetcher(1)
+        prefetcher.prefetch(["bad"])
+        self.assertIsNone(prefetcher.take("bad"))
+
+if __name__ == '__main__':
+    unittest.main()
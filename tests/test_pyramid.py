@@ -0,0 +1,40 @@
+import unittest
+
+try:
+    from PyQt5.QtGui import QImage, QColor
+except ImportError:
+    from PyQt4.QtGui import QImage, QColor
+
+from libs.pyramid import ImagePyramid
+
+
+class TestImagePyramid(unittest.TestCase):
+
+    def test_levels(self):
+        image = QImage(1800, 1200, QImage.Format_RGB32)
+        image.fill(QColor(10, 20, 30))
+        pyramid = ImagePyramid(image)
+        self.assertEqual([(l.width(), l.height()) for l in pyramid.levels], [(900, 600)])
+        self.assertIsNone(pyramid.level(1.0))
+        self.assertIsNone(pyramid.level(0.6))
+        level, fx, fy = pyramid.level(0.2)
+        self.assertEqual((level.width(), fx, fy), (900, 0.5, 0.5))
+        self.assertEqual(level.pixelColor(450, 300), QColor(10, 20, 30))
+
+    def test_box_filter(self):
+        image = QImage(2400, 4, QImage.Format_Grayscale8)
+        image.fill(QColor(0, 0, 0))
+        for x in range(0, 2400, 2):
+            image.setPixelColor(x, 0, QColor(200, 200, 200))
+        level = ImagePyramid(image).levels[0]
+        self.assertEqual((level.width(), level.height()), (1200, 2))
+        self.assertEqual(level.pixelColor(7, 0), QColor(50, 50, 50))
+        self.assertEqual(level.pixelColor(7, 1), QColor(0, 0, 0))
+
+    def test_small(self):
+        pyramid = ImagePyramid(QImage(512, 512, QImage.Format_RGB32))
+        self.assertEqual(pyramid.levels, [])
+        self.assertIsNone(pyramid.level(0.1))
+
+if __name__ == '__main__':
+    unittest.main()
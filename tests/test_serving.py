@@ -0,0 +1,153 @@
+import queue
+import threading
+import time
+import unittest
+
+import numpy as np
+
+try:
+    from libs import serving
+except ImportError:
+    serving = None
+
+
+class FakeClient(object):
+    """ Records the batch sizes, returns the guide so each caller can recognize its slice """
+
+    def __init__(self, delay=0.):
+        self.delay = delay
+        self.batches = []
+        self.threads = []
+        self.active = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+
+    def predict(self, image, guide, name):
+        with self.lock:
+            self.batches.append(image.shape[0])
+            self.threads.append(threading.current_thread())
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(self.delay)
+        with self.lock:
+            self.active -= 1
+        if name == "bad":
+            raise ValueError("bad model")
+        return guide.copy()
+
+
+def request(k, n=1, size=4):
+    """ (image, guide) of batch `n` whose guide is filled with `k` """
+    return np.zeros((n, size, 1), np.float32), np.full((n, size, 2), k, np.float32)
+
+
+@unittest.skipIf(serving is None, "grpc or tensorflow is not installed")
+class TestMicroBatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.batchers = []
+
+    def tearDown(self):
+        for batcher in self.batchers:
+            batcher.close()
+
+    def batcher(self, client, **kwargs):
+        batcher = serving.MicroBatcher(client, **kwargs)
+        self.batchers.append(batcher)
+        return batcher
+
+    def test_coalesce(self):
+        client = FakeClient()
+        batcher = self.batcher(client, window=0.05, maxBatch=8)
+        futures = [batcher.submit(*request(k, n=1 + k % 2), name="din") for k in range(3)]
+        # Each caller gets its own slice back
+        for k, future in enumerate(futures):
+            output = future.result(1)
+            self.assertEqual(output.shape, (1 + k % 2, 4, 2))
+            self.assertTrue((output == k).all())
+        self.assertEqual(client.batches, [4])
+
+    def test_keys(self):
+        client = FakeClient()
+        batcher = self.batcher(client, window=0.05)
+        futures = [batcher.submit(*request(0), name="din"), batcher.submit(*request(1, size=8), name="din"),
+                   batcher.submit(*request(2), name="gdt")]
+        for k, future in enumerate(futures):
+            self.assertTrue((future.result(1) == k).all())
+        # Different shapes or models are not combined
+        self.assertEqual(client.batches, [1, 1, 1])
+
+    def test_maxBatch(self):
+        client = FakeClient()
+        batcher = self.batcher(client, window=0.05, maxBatch=2)
+        futures = [batcher.submit(*request(k), name="din") for k in range(5)]
+        for k, future in enumerate(futures):
+            self.assertTrue((future.result(1) == k).all())
+        self.assertEqual(sorted(client.batches), [1, 2, 2])
+
+    def test_maxInflight(self):
+        client = FakeClient(delay=0.05)
+        batcher = self.batcher(client, window=0., maxInflight=2)
+        futures = [batcher.submit(*request(k), name="din") for k in range(6)]
+        for k, future in enumerate(futures):
+            self.assertTrue((future.result(1) == k).all())
+        self.assertEqual(client.peak, 2)
+
+    def test_direct(self):
+        client = FakeClient()
+        batcher = self.batcher(client, window=0.)
+        self.assertTrue((batcher.predict(*request(3), name="din") == 3).all())
+        # No thread hop without a window
+        self.assertEqual(client.threads, [threading.current_thread()])
+
+    def test_error(self):
+        batcher = self.batcher(FakeClient(), window=0.05)
+        futures = [batcher.submit(*request(k), name="bad") for k in range(2)]
+        for future in futures:
+            self.assertRaises(ValueError, future.result, 1)
+
+    def test_close(self):
+        client = FakeClient()
+        batcher = self.batcher(client, window=10.)
+        future = batcher.submit(*request(1), name="din")
+        batcher.close()
+        # The pending request is sent at once
+        self.assertTrue((future.result(1) == 1).all())
+        batcher.worker.join(1)
+        self.assertFalse(batcher.worker.is_alive())
+        self.assertRaises(RuntimeError, batcher.submit, *request(2), name="din")
+
+
+@unittest.skipIf(serving is None, "grpc or tensorflow is not installed")
+class TestRelay(unittest.TestCase):
+
+    def test_roundTrip(self):
+        client = FakeClient()
+        batcher = serving.MicroBatcher(client, window=0.05)
+        requests, responses = queue.Queue(), [queue.Queue(), queue.Queue()]
+        relay = threading.Thread(target=serving.relay, args=(requests, responses, batcher))
+        relay.start()
+        try:
+            workers = [serving.RelayClient(requests, responses[slot], slot) for slot in range(2)]
+            outputs = [None] * 4
+
+            def call(k):
+                outputs[k] = workers[k % 2].predict(*request(k), name="din")
+
+            threads = [threading.Thread(target=call, args=(k,)) for k in range(4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join(1)
+            for k, output in enumerate(outputs):
+                self.assertTrue((output == k).all())
+            # The requests of both workers share the batcher
+            self.assertEqual(client.batches, [4])
+            self.assertRaises(RuntimeError, workers[0].predict, *request(0), name="bad")
+        finally:
+            requests.put(None)
+            relay.join(1)
+            batcher.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+import unittest
+
+try:
+    from PyQt5.QtCore import QPointF
+except ImportError:
+    from PyQt4.QtCore import QPointF
+
+from libs.shapeIndex import ShapeGrid
+from tests.shapes import makeRect, makePoint
+
+
+class TestShapeGrid(unittest.TestCase):
+
+    def setUp(self):
+        self.big = makeRect(10, 10, 300, 300)
+        self.small = makeRect(100, 100, 120, 120)
+        self.point = makePoint(500, 500)
+        self.shapes = [self.big, self.small, self.point]
+        self.grid = ShapeGrid(self.shapes, pad=3.0)
+
+    def test_candidates(self):
+        self.assertEqual(self.grid.candidates(QPointF(110, 110)), [self.small, self.big])
+        self.assertEqual(self.grid.candidates(QPointF(250, 250)), [self.big])
+        # The point is found within the padding
+        self.assertEqual(self.grid.candidates(QPointF(502, 498)), [self.point])
+        self.assertEqual(self.grid.candidates(QPointF(900, 900)), [])
+
+    def test_moveRemove(self):
+        self.point.moveBy(QPointF(-400, -400))
+        self.grid.move(self.point)
+        self.assertEqual(self.grid.candidates(QPointF(500, 500)), [])
+        self.assertEqual(self.grid.candidates(QPointF(100, 100))[0], self.point)
+        self.grid.remove(self.big)
+        self.assertEqual(self.grid.candidates(QPointF(250, 250)), [])
+        self.assertEqual(len(self.grid), 2)
+
+    def test_pathCache(self):
+        path = self.small.makePath()
+        self.assertIs(self.small.makePath(), path)
+        self.assertTrue(self.small.containsPoint(QPointF(110, 110)))
+        self.small.moveBy(QPointF(100, 0))
+        self.assertFalse(self.small.containsPoint(QPointF(110, 110)))
+        self.small[0] = QPointF(0, 0)
+        self.assertEqual(self.small.boundingRect().topLeft(), QPointF(0, 0))
+
+if __name__ == '__main__':
+    unittest.main()
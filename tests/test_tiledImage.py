@@ -0,0 +1,136 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+try:
+    from PyQt5.QtGui import QImage, QColor
+    from PyQt5.QtCore import QRect, QRectF, QThreadPool
+except ImportError:
+    from PyQt4.QtGui import QImage, QColor
+    from PyQt4.QtCore import QRect, QRectF, QThreadPool
+
+from libs import tiledImage
+from libs.tiledImage import QtTileReader, TiffTileReader, TiledImage, imageShape, openTiled
+
+
+class TestTiledImage(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def jpeg(self, w, h):
+        # Left half red, right half blue
+        image = QImage(w, h, QImage.Format_RGB32)
+        image.fill(QColor(255, 0, 0))
+        for x in range(w // 2, w):
+            for y in range(h):
+                image.setPixelColor(x, y, QColor(0, 0, 255))
+        path = os.path.join(self.dir, "big.jpg")
+        image.save(path, "JPEG", 95)
+        return path
+
+    def assertColor(self, color, rgb):
+        for a, b in zip((color.red(), color.green(), color.blue()), rgb):
+            self.assertLess(abs(a - b), 16)
+
+    def test_tiles(self):
+        tiles = TiledImage(QtTileReader(self.jpeg(1300, 600)))
+        self.assertEqual((tiles.width(), tiles.height(), tiles.topLevel), (1300, 600, 2))
+        self.assertEqual(tiles.levelFor(1.5), 0)
+        self.assertEqual(tiles.levelFor(0.3), 1)
+        self.assertEqual(tiles.levelFor(0.01), 2)
+
+        # Nothing is cached yet, the tiles and the top level fallback are requested
+        self.assertEqual(tiles.tiles(0, QRectF(0, 0, 1300, 600)), [])
+        QThreadPool.globalInstance().waitForDone()
+        parts = tiles.tiles(0, QRectF(0, 0, 1300, 600))
+        self.assertEqual(len(parts), 6)
+        target, image, source = parts[-1]
+        self.assertEqual(target, QRectF(1024, 512, 276, 88))
+        self.assertEqual((image.width(), image.height()), (276, 88))
+        self.assertColor(tiles.pixelColor(100, 100), (255, 0, 0))
+        self.assertColor(tiles.pixelColor(1200, 550), (0, 0, 255))
+
+        # A missing tile is drawn from the top level meanwhile
+        target, image, source = tiles.tiles(1, QRectF(700, 0, 10, 10))[0]
+        self.assertEqual(target, QRectF(0, 0, 1024, 600))
+        self.assertEqual(source, QRectF(0, 0, 256, 150))
+        self.assertEqual(image.width(), 325)
+        tiles.cancel()
+        QThreadPool.globalInstance().waitForDone()
+
+    @unittest.skipIf(tiledImage.tifffile is None, "tifffile is not installed")
+    def test_tiff(self):
+        array = np.zeros((600, 1300, 3), np.uint8)
+        array[:, :650, 0] = 255
+        array[:, 650:, 2] = 255
+        path = os.path.join(self.dir, "big.tif")
+        tiledImage.tifffile.imwrite(path, array, tile=(256, 256))
+        self.assertEqual(imageShape(path), [600, 1300, 3])
+        reader = TiffTileReader(path)
+        self.assertEqual((reader.hasLevel(0), reader.hasLevel(1)), (True, False))
+        tiles = TiledImage(reader)
+        # Level 2 is halved twice from the tiles of level 0
+        image = tiles._tile(2, 0, 0)
+        self.assertEqual((image.width(), image.height()), (325, 150))
+        self.assertColor(image.pixelColor(10, 10), (255, 0, 0))
+        self.assertColor(image.pixelColor(320, 145), (0, 0, 255))
+        self.assertColor(tiles.pixelColor(1299, 599), (0, 0, 255))
+        tiles.cancel()
+
+    @unittest.skipIf(tiledImage.tifffile is None, "tifffile is not installed")
+    def test_tiffOverview(self):
+        array = (np.arange(2048)[None, :] // 8 + np.zeros((2048, 1), int)).astype(np.uint8)
+        path = os.path.join(self.dir, "flat.tif")
+        tiledImage.tifffile.imwrite(path, array, tile=(64, 64))
+        reads = []
+
+        class CountingReader(TiffTileReader):
+            def readTile(self, page, index):
+                reads.append(index)
+                return TiffTileReader.readTile(self, page, index)
+
+        reader = CountingReader(path)
+        # Every 128th pixel: only the tiles with such pixels are decoded
+        image = reader.read(0, QRect(0, 0, 2048, 2048), 128)
+        self.assertEqual((image.width(), image.height(), len(reads)), (16, 16, 256))
+        self.assertEqual(image.pixelColor(3, 5).red(), array[5 * 128, 3 * 128])
+
+        # 1024 TIFF tiles, 16 tiles of level 0 for a cache of 4
+        tiles = TiledImage(reader, cacheSize=4)
+        counts = []
+        for paint in range(4):
+            del reads[:]
+            tiles.tiles(0, QRectF(0, 0, 1000, 1000))
+            QThreadPool.globalInstance().waitForDone()
+            counts.append(len(reads))
+        # The view once and the top level once, which is not read from the cached tiles
+        self.assertEqual(counts, [256 + 1024, 0, 0, 0])
+        self.assertEqual(len(tiles.tiles(0, QRectF(0, 0, 1000, 1000))), 4)
+        top = tiles.cached((2, 0, 0))
+        self.assertEqual((top.width(), top.height()), (512, 512))
+        self.assertEqual(top.pixelColor(100, 0).red(), array[0, 400])
+        tiles.cancel()
+
+    def test_open(self):
+        path = self.jpeg(300, 200)
+        self.assertEqual(imageShape(path), [200, 300, 3])
+        self.assertIsNone(openTiled(path))
+        threshold, tiledImage.TILED_PIXELS = tiledImage.TILED_PIXELS, 100 * 100
+        try:
+            self.assertIsInstance(openTiled(path), TiledImage)
+            png = os.path.join(self.dir, "big.png")
+            QImage(path).save(png)
+            # Decoded at once, the png plugin can not read a clip rect
+            self.assertIsNone(openTiled(png))
+        finally:
+            tiledImage.TILED_PIXELS = threshold
+
+if __name__ == '__main__':
+    unittest.main()
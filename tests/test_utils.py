@@ -1,7 +1,12 @@
 import os
 import sys
 import unittest
-from libs.utils import struct, newAction, newIcon, addActions, fmtShortcut, generateColorByText, natural_sort
+from libs.utils import struct, newAction, newIcon, addActions, fmtShortcut, generateColorByText, natural_sort, \
+    LabelColors
+try:
+    from PyQt5.QtGui import QColor
+except ImportError:
+    from PyQt4.QtGui import QColor
 
 class TestUtils(unittest.TestCase):
 
@@ -18,5 +23,21 @@ class TestUtils(unittest.TestCase):
         for idx, val in enumerate(l1):
             self.assertTrue(val == exptected_l1[idx])
 
+    def test_labelColors(self):
+        colors = LabelColors(capacity=2)
+        self.assertEqual(colors.get('liver'), generateColorByText('liver'))
+        self.assertIs(colors.get('liver'), colors.get('liver'))
+        colors.get('tumor')
+        colors.get('vessel')
+        self.assertEqual(list(colors.cache), ['tumor', 'vessel'])
+        colors.setColor('tumor', QColor(1, 2, 3))
+        self.assertEqual(colors.get('tumor').getRgb(), (1, 2, 3, 255))
+        palette = colors.palette()
+        colors = LabelColors()
+        colors.setPalette(palette)
+        self.assertEqual(colors.get('tumor').getRgb(), (1, 2, 3, 255))
+        colors.setColor('tumor', None)
+        self.assertEqual(colors.get('tumor'), generateColorByText('tumor'))
+
 if __name__ == '__main__':
     unittest.main()